@@ -0,0 +1,362 @@
+# FILE: bench/fleet_bench.py
+"""
+Fleet load test for the CoolMove web app.
+
+Starts the Flask app in-process against a local Postgres, registers a bench
+user and N synthetic trackers through the normal /register and /devices/add
+forms, then for --duration seconds:
+
+  - every tracker POSTs to /api/data every --interval seconds, using the exact
+    JSON the ESP32 firmware builds in esp32-coolmove/src/main.cpp (including
+    the -999 GPS/sensor failure sentinels);
+  - --dashboard-users logged-in sessions poll /api/latest every --poll-interval
+    seconds, like dashboard.html.
+
+It reports throughput, p50/p95/p99 latency and DB queries per request for
+each endpoint, and saves the results as JSON so runs can be compared:
+
+    python bench/fleet_bench.py --database-url postgresql://localhost/coolmove_bench \\
+        --setup-schema --devices 200 --interval 5 --duration 60 --output bench/results/base.json
+    python bench/fleet_bench.py ... --compare bench/results/base.json
+
+--setup-schema runs web/database_setup.sql, which DROPS all tables: only use
+it on a throwaway database.
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import queue
+import random
+import argparse
+import threading
+import http.client
+import http.cookiejar
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+
+WEB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'web')
+
+# Sentinels sent by the firmware on GPS / temperature sensor failure (main.cpp)
+ERROR_LAT = -999.000
+ERROR_LON = -999.000
+ERROR_TEMP = -999.00
+
+
+# ----------------------------------------------------------------------
+# 1. MEASUREMENT
+# ----------------------------------------------------------------------
+
+class Stats:
+    """Latency samples and DB query counts per endpoint (thread-safe)."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.status_codes = defaultdict(lambda: defaultdict(int))
+        self.queries = defaultdict(int)
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            self.latencies[endpoint].append(seconds)
+            self.status_codes[endpoint][status] += 1
+            if status >= 400 or status == 0:
+                self.errors[endpoint] += 1
+
+    def count_query(self, endpoint):
+        with self._lock:
+            self.queries[endpoint] += 1
+
+    def summary(self, elapsed):
+        result = {}
+        for endpoint, samples in sorted(self.latencies.items()):
+            ordered = sorted(samples)
+            result[endpoint] = {
+                'requests': len(ordered),
+                'throughput_rps': round(len(ordered) / elapsed, 2),
+                'errors': self.errors[endpoint],
+                'status_codes': dict(self.status_codes[endpoint]),
+                'p50_ms': round(percentile(ordered, 50) * 1000, 2),
+                'p95_ms': round(percentile(ordered, 95) * 1000, 2),
+                'p99_ms': round(percentile(ordered, 99) * 1000, 2),
+                'db_queries_per_request': round(self.queries[endpoint] / len(ordered), 2) if ordered else None,
+            }
+        if self.queries.get('(background)'):
+            result['(background)'] = {'db_queries': self.queries['(background)']}
+        return result
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+# Carries the client-side label of a request so its queries are counted
+# under the same key as its latency
+LABEL_HEADER = 'X-Bench-Label'
+
+
+def install_query_counter(app, stats):
+    """Counts every psycopg execute, attributed to the bench request (label) running on that thread."""
+    import psycopg
+    from flask import request
+
+    current = threading.local()
+
+    @app.before_request
+    def _mark_endpoint():
+        rule = request.url_rule.rule if request.url_rule else request.path
+        current.endpoint = request.headers.get(LABEL_HEADER) or f"{request.method} {rule}"
+
+    @app.teardown_request
+    def _clear_endpoint(exc):
+        current.endpoint = None
+
+    def wrap(method):
+        def counted(self, *args, **kwargs):
+            stats.count_query(getattr(current, 'endpoint', None) or '(background)')
+            return method(self, *args, **kwargs)
+        return counted
+
+    psycopg.Cursor.execute = wrap(psycopg.Cursor.execute)
+    psycopg.Cursor.executemany = wrap(psycopg.Cursor.executemany)
+
+
+# ----------------------------------------------------------------------
+# 2. APP AND FIXTURES
+# ----------------------------------------------------------------------
+
+def setup_schema(database_url):
+    import psycopg
+    with open(os.path.join(WEB_DIR, 'database_setup.sql')) as f:
+        script = f.read()
+    with psycopg.connect(database_url, autocommit=True) as conn:
+        conn.execute(script)
+
+
+def start_app(database_url, port, stats):
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, os.path.abspath(WEB_DIR))
+    from werkzeug.serving import make_server
+    from app import app
+
+    install_query_counter(app, stats)
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+    return server
+
+
+class Session:
+    """Cookie-keeping HTTP client for the form-based pages (register/login/add device)."""
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+
+    def post_form(self, path, fields):
+        data = urllib.parse.urlencode(fields).encode()
+        with self.opener.open(self.base_url + path, data=data) as response:
+            return response.status
+
+    def cookie_header(self):
+        """Session cookie for the raw http.client connections used while measuring."""
+        return '; '.join(f"{c.name}={c.value}" for c in self.cookies)
+
+
+def register_fleet(base_url, run_id, devices):
+    """Creates the bench user and registers the synthetic IMEIs via /devices/add."""
+    email = f"bench-{run_id}@example.com"
+    password = 'bench-password'
+    session = Session(base_url)
+    session.post_form('/register', {'email': email, 'name': f"Bench {run_id}", 'password': password})
+
+    imeis = [f"99{run_id % 100000:05d}{i:08d}" for i in range(devices)]
+    for i, imei in enumerate(imeis):
+        session.post_form('/devices/add', {'device_name': f"Bench Truck {i:04d}", 'unique_imei': imei})
+    return email, password, imeis
+
+
+# ----------------------------------------------------------------------
+# 3. TRAFFIC
+# ----------------------------------------------------------------------
+
+class Tracker:
+    """Simulated ESP32: drifting position and temperature, with occasional sentinels."""
+    def __init__(self, imei, gps_failure_rate, temp_failure_rate):
+        self.imei = imei
+        self.lat = random.uniform(5.5, 5.7)
+        self.lon = random.uniform(-0.3, -0.1)
+        self.temp = random.uniform(3.0, 6.0)
+        self.gps_failure_rate = gps_failure_rate
+        self.temp_failure_rate = temp_failure_rate
+
+    def payload(self):
+        self.lat += random.gauss(0, 0.0002)
+        self.lon += random.gauss(0, 0.0002)
+        self.temp += random.gauss(0, 0.05)
+        gps_ok = random.random() >= self.gps_failure_rate
+        temp_ok = random.random() >= self.temp_failure_rate
+        lat = self.lat if gps_ok else ERROR_LAT
+        lon = self.lon if gps_ok else ERROR_LON
+        temp = self.temp if temp_ok else ERROR_TEMP
+        # Same string the firmware concatenates: lat/lon with 6 decimals, temp with 2
+        return '{"imei":"%s","lat":%.6f,"lon":%.6f,"temp":%.2f}' % (self.imei, lat, lon, temp)
+
+
+def timed_request(conn, stats, label, method, path, body=None, headers=None):
+    start = time.perf_counter()
+    status = 0
+    try:
+        conn.request(method, path, body=body, headers=dict(headers or {}, **{LABEL_HEADER: label}))
+        response = conn.getresponse()
+        response.read()
+        status = response.status
+    except (OSError, http.client.HTTPException):
+        conn.close()
+    stats.record(label, time.perf_counter() - start, status)
+
+
+def run_trackers(host, port, trackers, interval, deadline, concurrency, stats):
+    """Schedules each tracker every `interval` seconds and sends from `concurrency` client threads."""
+    jobs = queue.Queue()
+
+    def sender():
+        conn = http.client.HTTPConnection(host, port, timeout=30)
+        while True:
+            tracker = jobs.get()
+            if tracker is None:
+                return
+            timed_request(conn, stats, 'POST /api/data', 'POST', '/api/data',
+                          body=tracker.payload(), headers={'Content-Type': 'application/json'})
+
+    threads = [threading.Thread(target=sender, daemon=True) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+
+    # Spread first sends over one interval, like trackers booting at different times
+    now = time.monotonic()
+    schedule = [(now + random.uniform(0, interval), i) for i in range(len(trackers))]
+    heapq.heapify(schedule)
+    while schedule:
+        due, i = heapq.heappop(schedule)
+        if due >= deadline:
+            break
+        time.sleep(max(0.0, due - time.monotonic()))
+        jobs.put(trackers[i])
+        heapq.heappush(schedule, (due + interval, i))
+
+    for _ in threads:
+        jobs.put(None)
+    for t in threads:
+        t.join(timeout=30)
+
+
+def run_dashboard_user(host, port, base_url, email, password, poll_interval, deadline, stats):
+    session = Session(base_url)
+    session.post_form('/login', {'email': email, 'password': password})
+    headers = {'Cookie': session.cookie_header()}
+    conn = http.client.HTTPConnection(host, port, timeout=30)
+    time.sleep(random.uniform(0, poll_interval))
+    while time.monotonic() < deadline:
+        timed_request(conn, stats, 'GET /api/latest', 'GET', '/api/latest', headers=headers)
+        time.sleep(poll_interval)
+
+
+# ----------------------------------------------------------------------
+# 4. REPORTING
+# ----------------------------------------------------------------------
+
+def print_report(results, baseline=None):
+    print(f"\n{'endpoint':<22}{'reqs':>8}{'rps':>9}{'err':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'q/req':>7}")
+    for endpoint, r in results['endpoints'].items():
+        if 'requests' not in r:
+            print(f"{endpoint:<22} {r}")
+            continue
+        print(f"{endpoint:<22}{r['requests']:>8}{r['throughput_rps']:>9}{r['errors']:>6}"
+              f"{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}{r['db_queries_per_request'] or 0:>7}")
+        base = (baseline or {}).get('endpoints', {}).get(endpoint)
+        if base and 'requests' in base:
+            deltas = ' '.join(
+                f"{key}={(r[key] - base[key]) / base[key] * 100:+.1f}%"
+                for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms') if base[key]
+            )
+            print(f"{'  vs baseline':<22}{deltas}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'), required='DATABASE_URL' not in os.environ)
+    parser.add_argument('--setup-schema', action='store_true', help="DROP and recreate all tables first")
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--interval', type=float, default=5.0, help="seconds between posts per tracker")
+    parser.add_argument('--duration', type=float, default=60.0)
+    parser.add_argument('--concurrency', type=int, default=16, help="tracker client threads")
+    parser.add_argument('--dashboard-users', type=int, default=5)
+    parser.add_argument('--poll-interval', type=float, default=10.0)
+    parser.add_argument('--gps-failure-rate', type=float, default=0.05)
+    parser.add_argument('--temp-failure-rate', type=float, default=0.01)
+    parser.add_argument('--output', help="save results JSON here")
+    parser.add_argument('--compare', help="baseline results JSON to compare against")
+    args = parser.parse_args()
+
+    if args.setup_schema:
+        setup_schema(args.database_url)
+
+    stats = Stats()
+    server = start_app(args.database_url, args.port, stats)
+    host, port = '127.0.0.1', args.port
+    base_url = f"http://{host}:{port}"
+
+    run_id = int(time.time())
+    print(f"Registering {args.devices} trackers...")
+    email, password, imeis = register_fleet(base_url, run_id, args.devices)
+    trackers = [Tracker(imei, args.gps_failure_rate, args.temp_failure_rate) for imei in imeis]
+
+    # Only measure the traffic phase
+    stats.__init__()
+    print(f"Running for {args.duration:.0f}s: {args.devices} trackers every {args.interval}s, "
+          f"{args.dashboard_users} dashboard users every {args.poll_interval}s")
+    started = time.monotonic()
+    deadline = started + args.duration
+    users = [
+        threading.Thread(target=run_dashboard_user, daemon=True,
+                         args=(host, port, base_url, email, password, args.poll_interval, deadline, stats))
+        for _ in range(args.dashboard_users)
+    ]
+    for u in users:
+        u.start()
+    run_trackers(host, port, trackers, args.interval, deadline, args.concurrency, stats)
+    for u in users:
+        u.join(timeout=args.poll_interval + 30)
+    elapsed = time.monotonic() - started
+    server.shutdown()
+
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {k: v for k, v in vars(args).items() if k not in ('database_url', 'output', 'compare')},
+        'elapsed_s': round(elapsed, 2),
+        'endpoints': stats.summary(elapsed),
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The app modules import each other by their bare names (run from web/)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'web'))
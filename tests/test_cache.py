@@ -0,0 +1,54 @@
+import time
+
+from cache import TTLCache, MISSING
+
+
+def test_get_and_set():
+    cache = TTLCache('test')
+    assert cache.get('a') is MISSING
+    assert cache.get('a', 'default') == 'default'
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+
+
+def test_none_is_a_cached_negative_entry():
+    cache = TTLCache('test')
+    cache.set('unknown-imei', None)
+    assert cache.get('unknown-imei') is None
+
+
+def test_entries_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = TTLCache('test', ttl=10, negative_ttl=2)
+    cache.set('a', 1)
+    cache.set('b', None)
+    now[0] += 2
+    assert cache.get('a') == 1
+    assert cache.get('b') is MISSING # Negative entries use their own, shorter TTL
+    now[0] += 8
+    assert cache.get('a') is MISSING
+    assert cache.stats()['size'] == 0
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = TTLCache('test', maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_invalidate_and_clear():
+    cache = TTLCache('test')
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.invalidate('a')
+    cache.invalidate('missing')
+    assert cache.get('a') is MISSING and cache.get('b') == 2
+    cache.clear()
+    assert cache.get('b') is MISSING
@@ -0,0 +1,41 @@
+import math
+
+from cell_grid import cell_for, cell_ranges, COLUMNS, ROWS
+
+
+def test_cell_for_numbers_cells_row_by_row():
+    assert cell_for(-90.0, -180.0) == 0
+    assert cell_for(-89.95, -179.85) == 1
+    assert cell_for(-89.85, -180.0) == COLUMNS
+
+
+def test_cell_for_keeps_the_pole_and_antimeridian_on_the_grid():
+    assert cell_for(90.0, 0.0) // COLUMNS == ROWS - 1
+    assert cell_for(0.0, 180.0) % COLUMNS == 0
+
+
+def test_cell_for_rejects_impossible_positions():
+    for lat, lon in ((math.nan, 0.0), (0.0, math.inf), (91.0, 0.0), (0.0, -181.0)):
+        assert cell_for(lat, lon) is None
+
+
+def test_cell_ranges_cover_the_point():
+    lows, highs = cell_ranges(52.5, 13.4, 20)
+    cell = cell_for(52.5, 13.4)
+    assert any(low <= cell <= high for low, high in zip(lows, highs))
+    assert all(low // COLUMNS == high // COLUMNS for low, high in zip(lows, highs)) # One range per row
+
+
+def test_cell_ranges_stop_at_the_last_row_near_the_pole():
+    lows, highs = cell_ranges(89.99, 0.0, 50)
+    assert max(highs) < ROWS * COLUMNS
+    assert max(high // COLUMNS for high in highs) == ROWS - 1
+    assert min(lows) >= 0
+
+
+def test_cell_ranges_split_at_the_antimeridian():
+    lows, highs = cell_ranges(0.0, 179.99, 20)
+    row = cell_for(0.0, 179.99) // COLUMNS
+    spans = {(low - row * COLUMNS, high - row * COLUMNS) for low, high in zip(lows, highs) if low // COLUMNS == row}
+    assert len(spans) == 2
+    assert any(west == 0 for west, _ in spans) and any(east == COLUMNS - 1 for _, east in spans)
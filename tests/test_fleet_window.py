@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from fleet_window import Window, out_of_range, WINDOW_SECONDS, BUCKET_SECONDS, MAX_SAMPLE_GAP_SECONDS
+
+NOW = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+LIMITS = SimpleNamespace(temp_min=2.0, temp_max=8.0)
+
+
+def add(window, at, temp, now=NOW):
+    window.add(at, 1, 1, temp, temp, temp, out_of_range(LIMITS, temp, temp), now)
+
+
+def test_running_statistics():
+    window = Window()
+    for minutes, temp in ((30, 5.0), (20, 3.0), (10, 7.0)):
+        add(window, NOW - timedelta(minutes=minutes), temp)
+    summary = window.summary(NOW)
+    assert summary['samples'] == 3
+    assert (summary['temp_min'], summary['temp_max'], summary['temp_avg']) == (3.0, 7.0, 5.0)
+    assert summary['minutes_out_of_range'] == 0
+
+
+def test_samples_from_before_the_window_are_ignored():
+    window = Window()
+    add(window, NOW - timedelta(seconds=WINDOW_SECONDS + 60), 20.0)
+    assert window.summary(NOW)['samples'] == 0
+
+
+def test_old_buckets_expire_and_extremes_are_recomputed():
+    window = Window()
+    start = NOW - timedelta(hours=23)
+    add(window, start, 1.0)                          # Holds the minimum
+    add(window, start + timedelta(hours=1), 9.0)     # Holds the maximum
+    add(window, start + timedelta(hours=2), 5.0)
+    assert window.summary(NOW)['temp_min'] == 1.0
+
+    later = NOW + timedelta(hours=1, seconds=BUCKET_SECONDS)
+    summary = window.summary(later)
+    assert summary['samples'] == 2
+    assert (summary['temp_min'], summary['temp_max']) == (5.0, 9.0)
+
+    summary = window.summary(later + timedelta(hours=1))
+    assert summary['samples'] == 1
+    assert (summary['temp_min'], summary['temp_max'], summary['temp_avg']) == (5.0, 5.0, 5.0)
+
+
+def test_out_of_range_time_runs_until_the_next_sample():
+    window = Window()
+    add(window, NOW - timedelta(minutes=30), 10.0)   # Too warm ...
+    add(window, NOW - timedelta(minutes=20), 5.0)    # ... for 10 minutes
+    assert window.summary(NOW)['minutes_out_of_range'] == 10.0
+
+    add(window, NOW - timedelta(minutes=5), 0.0)     # Too cold and still is
+    assert window.summary(NOW)['minutes_out_of_range'] == 15.0
+
+
+def test_out_of_range_gaps_are_capped():
+    window = Window()
+    add(window, NOW - timedelta(hours=5), 10.0)
+    add(window, NOW - timedelta(hours=1), 5.0)
+    assert window.summary(NOW)['minutes_out_of_range'] == MAX_SAMPLE_GAP_SECONDS / 60
+
+
+def test_late_sample_lands_in_its_own_bucket():
+    window = Window()
+    add(window, NOW - timedelta(minutes=5), 5.0)
+    add(window, NOW - timedelta(hours=3), 9.0)       # Buffered upload
+    assert [b.start for b in window.buckets] == sorted(b.start for b in window.buckets)
+    assert window.summary(NOW)['temp_max'] == 9.0
+    # It doesn't count as the newest sample, so no out-of-range time is attributed
+    assert window.summary(NOW)['minutes_out_of_range'] == 0
+
+
+def test_watermark_only_moves_forward():
+    window = Window()
+    window.seen(NOW)
+    window.seen(NOW - timedelta(minutes=1))
+    window.seen(None)
+    assert window.last_seen == NOW
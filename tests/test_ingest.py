@@ -0,0 +1,103 @@
+import struct
+from datetime import datetime, timezone
+
+import pytest
+
+from ingest import (parse_reading, parse_frame, encode_frame, PayloadError,
+                    FRAME_VERSION, FRAME_TEMP_SENTINEL, MAX_FRAME_BYTES)
+
+TOKEN = b'\x01\x02\x03\x04\x05\x06\x07\x08'
+AT = datetime(2026, 5, 1, 12, 30, tzinfo=timezone.utc)
+
+
+# --- JSON readings ---
+
+def test_parse_reading_accepts_firmware_payload():
+    assert parse_reading({'imei': '86', 'lat': '6.524379', 'lon': 3.379206, 'temp': 4.25}) == \
+        ('86', 6.524379, 3.379206, 4.25, None)
+
+
+def test_parse_reading_keeps_sentinels():
+    assert parse_reading({'imei': '86', 'lat': -999, 'lon': -999, 'temp': -999}) == \
+        ('86', -999.0, -999.0, -999.0, None)
+
+
+def test_parse_reading_uses_default_imei_and_gsm_time():
+    imei, _, _, _, gsm_time = parse_reading({'lat': 1, 'lon': 2, 'temp': 3, 'gsm_time': AT.timestamp()}, '42')
+    assert imei == '42'
+    assert gsm_time == AT
+
+
+@pytest.mark.parametrize('data', [
+    [],
+    {'lat': 1, 'lon': 2, 'temp': 3},
+    {'imei': '86', 'lat': 'north', 'lon': 2, 'temp': 3},
+    {'imei': '86', 'lat': float('nan'), 'lon': 2, 'temp': 3},
+    {'imei': '86', 'lat': 1, 'lon': 2, 'temp': 'Infinity'},
+    {'imei': '86', 'lat': 90.5, 'lon': 2, 'temp': 3},
+    {'imei': '86', 'lat': 1, 'lon': -180.5, 'temp': 3},
+    {'imei': '86', 'lat': 1e9, 'lon': 2, 'temp': 3},
+    {'imei': '86', 'lat': 1, 'lon': 2, 'temp': 3, 'gsm_time': 'yesterday'},
+])
+def test_parse_reading_rejects_invalid_payloads(data):
+    with pytest.raises(PayloadError):
+        parse_reading(data)
+
+
+# --- Binary frames ---
+
+def test_frame_round_trip():
+    samples = [
+        (6.524379, 3.379206, 4.25, AT),
+        (-33.925839, 18.423218, -18.5, None),
+        (-999.0, -999.0, -999.0, AT),
+    ]
+    token, decoded = parse_frame(encode_frame(TOKEN, samples))
+    assert token == TOKEN
+    for (lat, lon, temp, at), (dlat, dlon, dtemp, dat) in zip(samples, decoded):
+        assert dlat == pytest.approx(lat, abs=1e-6)
+        assert dlon == pytest.approx(lon, abs=1e-6)
+        assert dtemp == pytest.approx(temp, abs=0.005)
+        assert dat == at
+
+
+def test_frame_sizes():
+    assert len(encode_frame(TOKEN, [(0.0, 0.0, 0.0, None)])) == 24
+    assert len(encode_frame(TOKEN, [(0.0, 0.0, 0.0, None)] * 255)) == MAX_FRAME_BYTES
+
+
+def test_frame_extremes_round_trip():
+    samples = [(90.0, 180.0, 327.67, None), (-90.0, -180.0, -327.67, None)]
+    _, decoded = parse_frame(encode_frame(TOKEN, samples))
+    assert [s[:3] for s in decoded] == [s[:3] for s in samples]
+
+
+def test_frame_temperature_sentinel():
+    body = struct.pack('<B8sB', FRAME_VERSION, TOKEN, 1) + struct.pack('<iihI', 0, 0, FRAME_TEMP_SENTINEL, 0)
+    assert parse_frame(body)[1][0][2] == -999.0
+
+
+def test_encode_frame_sample_count_limits():
+    with pytest.raises(ValueError):
+        encode_frame(TOKEN, [])
+    with pytest.raises(ValueError):
+        encode_frame(TOKEN, [(0.0, 0.0, 0.0, None)] * 256)
+
+
+@pytest.mark.parametrize('body', [
+    b'',
+    b'\x01' + TOKEN, # Header cut short
+    struct.pack('<B8sB', 2, TOKEN, 1) + bytes(14), # Unknown version
+    struct.pack('<B8sB', FRAME_VERSION, TOKEN, 0), # No samples
+    struct.pack('<B8sB', FRAME_VERSION, TOKEN, 2) + bytes(14), # Fewer samples than announced
+    struct.pack('<B8sB', FRAME_VERSION, TOKEN, 1) + bytes(15), # Trailing garbage
+])
+def test_parse_frame_rejects_malformed_frames(body):
+    with pytest.raises(PayloadError):
+        parse_frame(body)
+
+
+def test_parse_frame_rejects_off_globe_positions():
+    body = struct.pack('<B8sB', FRAME_VERSION, TOKEN, 1) + struct.pack('<iihI', 2_000_000_000, 0, 0, 0)
+    with pytest.raises(PayloadError):
+        parse_frame(body)
@@ -0,0 +1,60 @@
+import pytest
+
+for module in ('psycopg', 'psycopg_pool', 'flask_login'):
+    pytest.importorskip(module)
+
+import psycopg
+import ingest_queue as ingest_queue_module
+from ingest_queue import IngestQueue
+from models import Reading
+
+BATCH = [(f"imei-{i}", 52.0, 13.0, 5.0, None) for i in range(10)]
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(ingest_queue_module.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def test_outage_is_retried_until_the_batch_goes_in(monkeypatch, no_sleep):
+    calls = []
+
+    def insert_readings(readings, raise_errors=False):
+        calls.append(len(readings))
+        if len(calls) <= 50: # Far longer than any fixed number of attempts
+            raise psycopg.OperationalError("connection refused")
+        return [(True, "Reading saved")] * len(readings)
+
+    monkeypatch.setattr(Reading, 'insert_readings', staticmethod(insert_readings))
+    q = IngestQueue(maxsize=100)
+    q._write(list(BATCH))
+
+    assert calls == [len(BATCH)] * 51 # Never split or dropped while the database is down
+    assert (q.written, q.dropped) == (len(BATCH), 0)
+    assert max(no_sleep) == ingest_queue_module.INGEST_MAX_BACKOFF
+
+
+def test_full_queue_pushes_back_on_submitters():
+    q = IngestQueue(maxsize=len(BATCH))
+    q._ensure_writer = lambda: None # Nothing drains the queue, as during an outage
+    assert q.submit_many(BATCH)
+    assert not q.submit_many(BATCH[:1])
+    assert not q.submit(BATCH[0])
+    assert q.stats()['rejected_full'] == 2
+
+
+def test_bad_reading_is_isolated_and_dropped(monkeypatch):
+    bad = BATCH[3]
+
+    def insert_readings(readings, raise_errors=False):
+        if bad in readings:
+            raise psycopg.DataError("value out of range")
+        return [(True, "Reading saved")] * len(readings)
+
+    monkeypatch.setattr(Reading, 'insert_readings', staticmethod(insert_readings))
+    q = IngestQueue(maxsize=100)
+    q._write(list(BATCH))
+
+    assert (q.written, q.dropped) == (len(BATCH) - 1, 1)
@@ -0,0 +1,79 @@
+import math
+
+import pytest
+
+from simplify import simplify_route, zoom_tolerance_m, MAX_ZOOM
+
+
+def point(lat, lon, temp=5.0):
+    return {'lat': lat, 'lon': lon, 'temp': temp}
+
+
+def test_short_routes_are_returned_as_is():
+    route = [point(0, 0), point(0, 1)]
+    assert simplify_route(route, tolerance_m=10) == route
+
+
+def test_no_options_means_no_simplification():
+    route = [point(0, i * 0.001) for i in range(10)]
+    assert simplify_route(route) == route
+
+
+def test_straight_line_keeps_only_its_ends():
+    route = [point(0, i * 0.001) for i in range(20)]
+    assert simplify_route(route, tolerance_m=1) == [route[0], route[-1]]
+
+
+def test_corner_is_kept():
+    route = [point(0, 0), point(0, 0.001), point(0, 0.002), point(0.001, 0.002), point(0.002, 0.002)]
+    assert simplify_route(route, tolerance_m=1) == [route[0], route[2], route[-1]]
+
+
+def test_sentinel_positions_are_dropped():
+    route = [point(0, 0), point(-999, -999), point(0, 0.001)]
+    assert simplify_route(route, tolerance_m=1) == [route[0], route[2]]
+
+
+def test_excursion_points_are_always_kept():
+    route = [point(0, i * 0.001) for i in range(10)]
+    route[4]['temp'] = route[5]['temp'] = 35.0
+    route[6]['temp'] = 40.0
+    route[7]['temp'] = 31.0
+    kept = simplify_route(route, tolerance_m=1000)
+    assert kept == [route[0], route[4], route[6], route[7], route[-1]]
+
+
+def test_sentinel_temperatures_are_not_excursions():
+    route = [point(0, i * 0.001, temp=-999.0) for i in range(10)]
+    assert simplify_route(route, tolerance_m=1000) == [route[0], route[-1]]
+
+
+def test_rollup_points_use_the_bucket_maximum():
+    route = [point(0, i * 0.001) for i in range(10)]
+    route[3]['temp_max'] = 35.0
+    assert route[3] in simplify_route(route, tolerance_m=1000)
+
+
+def test_target_count_keeps_the_most_significant_vertices():
+    route = [point(0, 0), point(0.0001, 0.001), point(0.002, 0.002), point(0, 0.003), point(0, 0.004)]
+    assert simplify_route(route, target_count=3) == [route[0], route[2], route[-1]]
+    assert simplify_route(route, target_count=100) == route
+    # Never fewer than the two ends
+    assert simplify_route(route, target_count=0) == [route[0], route[-1]]
+
+
+def test_tolerance_and_target_count_rank_vertices_consistently():
+    route = [point(math.sin(i / 3) * 0.01, i * 0.001) for i in range(60)]
+    by_count = simplify_route(route, target_count=10)
+    assert len(by_count) == 10
+    assert by_count[0] is route[0] and by_count[-1] is route[-1]
+
+
+def test_zoom_tolerance_halves_per_zoom_level():
+    assert zoom_tolerance_m(11, 0) == pytest.approx(zoom_tolerance_m(10, 0) / 2)
+    assert zoom_tolerance_m(10, 60) == pytest.approx(zoom_tolerance_m(10, 0) / 2)
+
+
+def test_zoom_tolerance_is_clamped_to_leaflet_levels():
+    assert zoom_tolerance_m(1e6, 0) == zoom_tolerance_m(MAX_ZOOM, 0)
+    assert zoom_tolerance_m(-5, 0) == zoom_tolerance_m(0, 0)
@@ -0,0 +1,56 @@
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+SCHEMA = os.path.join(os.path.dirname(__file__), os.pardir, 'web', 'database_setup.sql')
+NOW = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+
+
+class FakeCursor:
+    """Records statements; SELECT NOW() is the only query that returns rows."""
+    def __init__(self):
+        self.calls = []
+
+    def execute(self, query, params=None):
+        self.calls.append((query, params))
+
+    def executemany(self, query, params_seq):
+        self.calls.append((query, list(params_seq)))
+
+    def fetchone(self):
+        return (NOW,)
+
+    def fetchall(self):
+        return []
+
+
+def test_fully_suppressed_batch_updates_latest_state(monkeypatch):
+    for module in ('psycopg', 'psycopg_pool', 'flask_login'):
+        pytest.importorskip(module)
+    from models import Reading, ReadingRollup, DeviceCell, DeviceDeadband
+
+    monkeypatch.setattr(DeviceDeadband, 'filter', classmethod(lambda cls, cur, rows: [False] * len(rows)))
+    monkeypatch.setattr(ReadingRollup, 'accumulate', classmethod(lambda cls, cur, readings: None))
+    monkeypatch.setattr(DeviceCell, 'accumulate', classmethod(lambda cls, cur, readings: None))
+    monkeypatch.setattr(Reading, '_processors', [])
+    cur = FakeCursor()
+
+    readings = Reading._store(cur, [(7, 52.0, 13.0, 5.0, None), (7, 52.0, 13.0, 5.1, None)])
+
+    assert [r.id for r in readings] == [None, None]
+    assert not any(query is Reading._INSERT_SQL for query, _ in cur.calls)
+    (rows,) = [params for query, params in cur.calls if query is Reading._UPSERT_LATEST_SQL]
+    assert len(rows) == 1
+    device_id, reading_id, *_, suppressed = rows[0]
+    # No stored row: reading_id is NULL (kept by the upsert's COALESCE), both samples counted
+    assert (device_id, reading_id, suppressed) == (7, None, 2)
+
+
+def test_device_latest_reading_id_is_nullable():
+    with open(SCHEMA) as f:
+        schema = f.read()
+    table = schema[schema.index('CREATE TABLE device_latest'):]
+    table = table[:table.index(');')]
+    line = next(l for l in table.splitlines() if l.strip().startswith('reading_id'))
+    assert 'NOT NULL' not in line
@@ -2,7 +2,10 @@
 
 import os
 import json 
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, abort
+import math
+import queue
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify, abort, session
 import psycopg
 from dotenv import load_dotenv
 from flask_login import (
@@ -15,18 +18,56 @@ from flask_login import (
 
 # Relative import from models.py
 # ADDED DeviceShare
-from models import User, Device, Reading, DeviceShare, get_db_connection 
+from models import (User, Device, Reading, DeviceShare, ReadingRollup, DeviceThresholds, ExcursionEvent, Trip,
+                    DeviceDeadband, DeviceCell, deadband_cache,
+                    SENTINEL_VALUE, latest_reading_json, latest_validators,
+                    get_db_connection, release_db_connection, get_db_pool, get_replica_pools,
+                    begin_request, last_write_at, DATABASE_REPLICA_URLS, DB_READ_YOUR_WRITES_SECONDS,
+                    imei_cache, token_cache, user_cache, device_access_cache, latest_version_cache)
+from ingest import (parse_reading, parse_frame, parse_timestamp, encode_cursor, decode_cursor, PayloadError,
+                    MAX_BATCH_SIZE, FRAME_CONTENT_TYPE, MAX_FRAME_BYTES)
+from live import broadcaster, sse_event, SSE_HEARTBEAT_SECONDS
+from simplify import simplify_route, MIN_ZOOM, MAX_ZOOM
+from ingest_queue import ingest_queue, INGEST_MODE, INGEST_RETRY_AFTER
+from excursions import excursion_engine # Registers the rule engine on Reading.on_storing
+import trips # Registers the trip segmenter on Reading.on_storing
+from fleet_overview import fleet_overview # Registers the 24h windows on Reading.on_stored
+from partitions import start_maintenance_scheduler
+from export import csv_chunks, parquet_chunks, EXPORT_FORMATS
+from metrics import instrument_app, register_collector, render_metrics, record_ingest, record_rejected, METRICS_TOKEN
 
 load_dotenv()
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'a-very-secret-default-key') 
 
+# Keeps future readings partitions created (and applies retention) in the background
+start_maintenance_scheduler()
+
+# Request latency, DB round-trips and connection times for /metrics
+instrument_app(app)
+Reading.on_stored(record_ingest)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login' 
 login_manager.login_message = 'Please log in to access this page.'
 
+# --- Read-Your-Writes with Read Replicas ---
+# Read-only queries may go to a replica (see models.py). After a logged-in user
+# changes something, their next requests keep reading from the primary for
+# DB_READ_YOUR_WRITES_SECONDS so they never see the page without their change.
+@app.before_request
+def route_reads():
+    begin_request(session.get('_primary_until'))
+
+@app.after_request
+def remember_write(response):
+    wrote_at = last_write_at()
+    if DATABASE_REPLICA_URLS and wrote_at is not None and current_user.is_authenticated:
+        session['_primary_until'] = wrote_at + DB_READ_YOUR_WRITES_SECONDS
+    return response
+
 # --- USER LOADER ---
 @login_manager.user_loader
 def load_user(user_id):
@@ -80,6 +121,7 @@ def register():
             )
             new_user_id = cur.fetchone()[0]
             conn.commit()
+            User.invalidate(new_user_id)
             
             new_user = User(new_user_id, email, password_hash, name)
             login_user(new_user)
@@ -89,7 +131,7 @@ def register():
             conn.rollback()
             flash(f'An error occurred during registration. Details: {e}', 'error')
         finally:
-            if conn: conn.close()
+            release_db_connection(conn)
 
     return render_template('register.html')
 
@@ -149,21 +191,117 @@ def device_history(device_id):
         flash("Device not found or you do not have permission to view it.", 'error')
         return redirect(url_for('dashboard'))
     
-    readings = Device.get_readings(device_id, limit=50) 
-    readings.reverse() # Oldest to newest for correct route drawing
-    
-    route_data = [
-        {'lat': r.latitude, 'lon': r.longitude, 'temp': r.temperature, 'time': r.received_at.strftime('%Y-%m-%d %H:%M:%S')}
-        for r in readings
-    ]
+    # Without a time range, show the last 50 raw points as before
+    if not any(k in request.args for k in ('since', 'until', 'hours')):
+        readings = Device.get_readings(device_id, limit=50) 
+        readings.reverse() # Oldest to newest for correct route drawing
+        route_data = [reading_point_json(r) for r in readings]
+        resolution = 'raw'
+    else:
+        try:
+            since, until, max_points = parse_history_range(request.args)
+        except PayloadError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('device_history', device_id=device_id))
+        resolution, route_data = history_points(device_id, since, until, max_points)
+
+    # Only ship the vertices the map can actually show
+    try:
+        route_data = simplify_points(route_data, request.args, default_zoom=ROUTE_DEFAULT_ZOOM)
+    except PayloadError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('device_history', device_id=device_id))
     
     route_data_json = json.dumps(route_data)
 
     return render_template('device_history.html', 
                             device=device,
+                            resolution=resolution,
+                            hours=request.args.get('hours'),
                             route_data_json=route_data_json)
 
 
+# --- History Helpers (shared by the history page and API) ---
+HISTORY_DEFAULT_POINTS = 500
+HISTORY_MAX_POINTS = 5000
+# Longest ?hours= window (about ten years)
+HISTORY_MAX_HOURS = 24 * 3660
+
+def parse_history_range(args):
+    """Reads since/until (ISO 8601 or epoch) or hours, and the point budget, from query args."""
+    until = parse_timestamp(args.get('until'), 'until') or datetime.now(timezone.utc)
+    since = parse_timestamp(args.get('since'), 'since')
+    if since is None:
+        try:
+            hours = float(args.get('hours', 24))
+            if not 0 < hours <= HISTORY_MAX_HOURS: # Also false for NaN
+                raise ValueError(hours)
+            since = until - timedelta(hours=hours)
+        except (ValueError, OverflowError):
+            raise PayloadError(f"hours must be a number in (0, {HISTORY_MAX_HOURS}]")
+    if since >= until:
+        raise PayloadError("since must be before until")
+    try:
+        max_points = min(int(args.get('points', HISTORY_DEFAULT_POINTS)), HISTORY_MAX_POINTS)
+    except ValueError:
+        raise PayloadError("Invalid points")
+    return since, until, max(max_points, 2)
+
+
+def history_points(device_id, since, until, max_points):
+    """
+    Returns (resolution, points) for [since, until): raw readings if they fit in
+    the point budget, otherwise the finest rollup resolution that does.
+    """
+    bucket_seconds = ReadingRollup.pick_resolution(device_id, since, until, max_points)
+    if bucket_seconds == 0:
+        readings = Device.get_readings(device_id, limit=max_points, since=since, until=until)
+        readings.reverse()
+        return 'raw', [reading_point_json(r) for r in readings]
+
+    buckets = ReadingRollup.get_range(device_id, bucket_seconds, since, until)
+    return f'{bucket_seconds // 60}m' if bucket_seconds < 3600 else f'{bucket_seconds // 3600}h', [
+        rollup_point_json(b) for b in buckets
+    ]
+
+
+# Street-level zoom: simplification at this tolerance is invisible on the history map
+ROUTE_DEFAULT_ZOOM = 17
+
+def simplify_points(points, args, default_zoom=None):
+    """
+    Applies route simplification from ?zoom= (Leaflet zoom level) or ?vertices=
+    (target count). Raises PayloadError for a non-finite zoom.
+    """
+    zoom = args.get('zoom', type=float)
+    vertices = args.get('vertices', type=int)
+    if zoom is None and vertices is None:
+        zoom = default_zoom
+    if zoom is not None:
+        if not math.isfinite(zoom):
+            raise PayloadError("zoom must be a number")
+        zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+    return simplify_route(points, zoom=zoom, target_count=vertices)
+
+
+def reading_point_json(r):
+    return {'lat': r.latitude, 'lon': r.longitude, 'temp': r.temperature, 'time': r.received_at.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def rollup_point_json(b):
+    # Buckets without any valid fix/temperature use the firmware sentinel, like raw readings
+    return {
+        'lat': b.last_latitude if b.last_latitude is not None else SENTINEL_VALUE,
+        'lon': b.last_longitude if b.last_longitude is not None else SENTINEL_VALUE,
+        'temp': round(b.temp_avg, 2) if b.temp_avg is not None else SENTINEL_VALUE,
+        'temp_min': b.temp_min,
+        'temp_max': b.temp_max,
+        'samples': b.sample_count,
+        'failures': {'temp': b.temp_failures, 'gps': b.gps_failures},
+        'time': b.bucket_start.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+
 # --- Device Management Route (Updated to handle DeviceShare) ---
 @app.route('/devices/add', methods=['GET', 'POST'])
 @login_required
@@ -197,6 +335,7 @@ def add_device():
                 )
                 device_id = cur.fetchone()[0]
                 conn.commit() # Commit the new device creation
+                Device.invalidate_imei(full_imei) # Drop any cached "unknown IMEI" entry
                 
                 # Re-fetch the device object (or just use the data)
                 device = Device(device_id, device_name, full_imei)
@@ -212,6 +351,7 @@ def add_device():
                 )
                 device_id = device.id
                 conn.commit()
+                Device.invalidate_imei(full_imei)
 
                 flash_message = f'Device "{device_name}" (IMEI {device.imei_suffix}) was already registered by someone else. You have now been linked to it.'
 
@@ -229,7 +369,7 @@ def add_device():
             conn.rollback()
             flash(f'Database error during device linking: {e}', 'error')
         finally:
-            if conn: conn.close()
+            release_db_connection(conn)
 
     return render_template('add_device.html')
 
@@ -242,54 +382,636 @@ def add_device():
 @app.route('/api/latest/<int:device_id>')
 @login_required # Protects the real-time API endpoint
 def api_latest_reading(device_id):
-    # 1. Ensure the device is linked to the current user
-    device = Device.get_by_id_and_user(device_id, current_user.id)
-    if not device:
+    # 1. Ensure the device is linked to the current user (cached device_shares lookup)
+    if not DeviceShare.user_can_access(current_user.id, device_id):
         return jsonify({"error": "Device not authorized"}), 403
 
-    # 2. Fetch the latest reading
+    # 2. Unchanged since the client's copy? Answer 304 from the cached latest-state version
+    if request.if_none_match:
+        not_modified = not_modified_response(*latest_validators(Reading.get_latest_versions([device_id])))
+        if not_modified:
+            return not_modified
+
+    # 3. Fetch the latest reading
     reading = Reading.get_latest_reading(device_id)
+    validators = latest_validators({device_id: reading.received_at if reading else None})
 
     if reading:
-        data = {
-            'temp': round(reading.temperature, 1),
-            'lat': reading.latitude,
-            'lon': reading.longitude,
-            'time': reading.received_at.strftime('%Y-%m-%d %H:%M:%S'),
-            'status': 'OK'
-        }
-        return jsonify(data), 200
+        return with_validators(jsonify(latest_reading_json(reading)), *validators), 200
     else:
-        return jsonify({"status": "NoData", "message": "No readings found for this device"}), 200
+        return with_validators(jsonify({"status": "NoData", "message": "No readings found for this device"}),
+                               *validators), 200
+
+
+# --- API for Dashboard Refresh of All Devices in One Request ---
+@app.route('/api/latest')
+@login_required
+def api_latest_readings():
+    """Latest reading for every device shared with the current user, keyed by device id."""
+    device_ids = DeviceShare.get_device_ids_for_user(current_user.id)
+    if request.if_none_match:
+        not_modified = not_modified_response(*latest_validators(Reading.get_latest_versions(device_ids)))
+        if not_modified:
+            return not_modified
+
+    readings = Reading.get_latest_readings_for_user(current_user.id)
+    devices = {}
+    for device_id in device_ids | readings.keys():
+        reading = readings.get(device_id)
+        devices[str(device_id)] = (
+            latest_reading_json(reading) if reading
+            else {"status": "NoData", "message": "No readings found for this device"}
+        )
+    validators = latest_validators({
+        device_id: readings[device_id].received_at if device_id in readings else None
+        for device_id in device_ids | readings.keys()
+    })
+    return with_validators(jsonify({"devices": devices}), *validators), 200
+
+
+# --- Conditional GET (ETag / Last-Modified from the latest-state versions) ---
+def not_modified_response(etag, last_modified):
+    """A 304 when the client's If-None-Match already has this ETag, otherwise None."""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    return with_validators(Response(status=304), etag, last_modified)
+
+
+def with_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    # Browsers may keep the body but must revalidate it every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# --- Fleet Map APIs (Latest Positions in a Box, Devices Near a Point) ---
+@app.route('/api/fleet/positions')
+@login_required
+def api_fleet_positions():
+    """Last GPS fix of the user's devices, optionally within ?bbox=south,west,north,east."""
+    bbox = request.args.get('bbox')
+    try:
+        south, west, north, east = [float(v) for v in bbox.split(',')] if bbox else (-90.0, -180.0, 90.0, 180.0)
+    except ValueError:
+        return jsonify({"message": "bbox must be south,west,north,east in degrees"}), 400
+    if not (-90 <= south <= north <= 90 and -180 <= west <= 180 and -180 <= east <= 180):
+        return jsonify({"message": "bbox out of range"}), 400
+
+    devices = [
+        {
+            'device_id': reading.device_id,
+            'device_name': name,
+            'lat': reading.last_fix_latitude,
+            'lon': reading.last_fix_longitude,
+            'fix_time': reading.last_fix_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'latest': latest_reading_json(reading),
+        }
+        for name, reading in Reading.get_latest_in_bbox(current_user.id, south, west, north, east)
+    ]
+    return jsonify({'devices': devices}), 200
+
+
+@app.route('/api/fleet/overview')
+@login_required
+def api_fleet_overview():
+    """Rolling 24h temperature statistics, last-seen age and online status of all the user's devices."""
+    devices = Device.get_user_devices(current_user.id)
+    counts, entries = fleet_overview.overview(devices, Reading.get_latest_readings_for_user(current_user.id))
+    return jsonify({'summary': counts, 'devices': entries}), 200
+
+
+@app.route('/api/fleet/near')
+@login_required
+def api_fleet_near():
+    """Devices that passed within ?km= of ?lat=&lon= during ?since=&until= (or ?hours=, default 24)."""
+    try:
+        lat = float(request.args['lat'])
+        lon = float(request.args['lon'])
+        radius_km = float(request.args.get('km', 1))
+    except (KeyError, ValueError):
+        return jsonify({"message": "lat and lon are required (degrees), km must be a number"}), 400
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or not 0 < radius_km <= DeviceCell.MAX_RADIUS_KM:
+        return jsonify({"message": f"Position out of range or km not in (0, {DeviceCell.MAX_RADIUS_KM:g}]"}), 400
+    try:
+        since, until, _ = parse_history_range(request.args)
+    except PayloadError as e:
+        return jsonify({"message": str(e)}), 400
+
+    devices = DeviceCell.find_devices_near(current_user.id, lat, lon, radius_km, since, until)
+    for device in devices:
+        device['min_distance_km'] = round(device['min_distance_km'], 3)
+        device['first_at'] = device['first_at'].isoformat()
+        device['last_at'] = device['last_at'].isoformat()
+    return jsonify({
+        'lat': lat, 'lon': lon, 'km': radius_km,
+        'since': since.isoformat(), 'until': until.isoformat(),
+        'devices': devices,
+    }), 200
+
+
+# --- Server-Sent Events Stream of New Readings ---
+@app.route('/api/stream')
+@login_required
+def api_stream():
+    """
+    Pushes every new reading of the user's devices as an SSE "reading" event.
+    Clients resume after a disconnect with the standard Last-Event-ID header
+    (or ?last_id=), which replays readings stored since that id.
+    """
+    device_ids = DeviceShare.get_device_ids_for_user(current_user.id)
+    try:
+        last_id = int(request.headers.get('Last-Event-ID') or request.args.get('last_id') or 0)
+    except ValueError:
+        last_id = 0
+
+    # Subscribe before replaying so nothing stored in between is missed
+    sub = broadcaster.subscribe(device_ids)
+    if sub is None:
+        response = jsonify({"message": "Too many live streams, poll /api/latest instead"})
+        response.headers['Retry-After'] = str(int(SSE_HEARTBEAT_SECONDS))
+        return response, 503
+
+    def generate():
+        # Replayed readings may also arrive live; ids are only comparable to these,
+        # since concurrent transactions commit (and notify) out of id order
+        replayed = set()
+        try:
+            yield "retry: 5000\n\n"
+            if last_id:
+                for reading in Reading.get_readings_after(device_ids, last_id):
+                    event = latest_reading_json(reading)
+                    event.update(id=reading.id, device_id=reading.device_id)
+                    replayed.add(reading.id)
+                    yield sse_event(event, event='reading', event_id=reading.id)
+
+            while not sub.overflowed:
+                try:
+                    event = sub.queue.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                event_id = event['id'] # None for dead-band suppressed samples (not stored)
+                if event_id in replayed:
+                    replayed.discard(event_id) # Already sent during the replay
+                    continue
+                yield sse_event(event, event='reading', event_id=event_id)
+        finally:
+            broadcaster.unsubscribe(sub)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# --- API for Device History over a Time Range ---
+@app.route('/api/history/<int:device_id>')
+@login_required
+def api_device_history(device_id):
+    """History for ?since=&until= (or ?hours=), downsampled to at most ?points= points."""
+    if not DeviceShare.user_can_access(current_user.id, device_id):
+        return jsonify({"error": "Device not authorized"}), 403
+    try:
+        since, until, max_points = parse_history_range(request.args)
+    except PayloadError as e:
+        return jsonify({"message": str(e)}), 400
+
+    # The body only changes with new readings, except that a window ending "now"
+    # also slides: such responses are only reused within the same minute.
+    window = sorted(request.args.items(multi=True))
+    if 'until' not in request.args:
+        window.append(('minute', int(until.timestamp() // 60)))
+    validators = latest_validators(Reading.get_latest_versions([device_id]), window)
+    not_modified = not_modified_response(*validators)
+    if not_modified:
+        return not_modified
+
+    resolution, points = history_points(device_id, since, until, max_points)
+    if 'zoom' in request.args or 'vertices' in request.args:
+        try:
+            points = simplify_points(points, request.args)
+        except PayloadError as e:
+            return jsonify({"message": str(e)}), 400
+    return with_validators(jsonify({
+        'device_id': device_id,
+        'since': since.isoformat(),
+        'until': until.isoformat(),
+        'resolution': resolution,
+        'points': points,
+    }), *validators), 200
+
+
+# --- API for Paging Through Raw Readings ---
+READINGS_PAGE_DEFAULT = 100
+READINGS_PAGE_MAX = 1000
+
+@app.route('/api/readings/<int:device_id>')
+@login_required
+def api_device_readings(device_id):
+    """
+    Raw readings of a device, optionally bounded by ?since=&until=, newest first
+    (or ?order=asc). Pass the returned next_cursor as ?cursor= to get the next page.
+    """
+    if not DeviceShare.user_can_access(current_user.id, device_id):
+        return jsonify({"error": "Device not authorized"}), 403
+    try:
+        since = parse_timestamp(request.args.get('since'), 'since')
+        until = parse_timestamp(request.args.get('until'), 'until')
+        after = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except PayloadError as e:
+        return jsonify({"message": str(e)}), 400
+    limit = min(max(request.args.get('limit', READINGS_PAGE_DEFAULT, type=int), 1), READINGS_PAGE_MAX)
+    ascending = request.args.get('order', 'desc').lower() == 'asc'
+
+    # One extra row tells us whether another page exists
+    readings = Device.get_readings_page(device_id, limit=limit + 1, since=since, until=until,
+                                        after=after, ascending=ascending)
+    next_cursor = None
+    if len(readings) > limit:
+        readings = readings[:limit]
+        next_cursor = encode_cursor(readings[-1].received_at, readings[-1].id)
+
+    return jsonify({
+        'device_id': device_id,
+        'readings': [
+            {
+                'id': r.id,
+                'lat': r.latitude,
+                'lon': r.longitude,
+                'temp': r.temperature,
+                'gsm_time': r.gsm_time.isoformat() if r.gsm_time else None,
+                'received_at': r.received_at.isoformat(),
+            }
+            for r in readings
+        ],
+        'next_cursor': next_cursor,
+    }), 200
+
+
+# --- API for Streaming Exports (CSV / Parquet) ---
+@app.route('/api/export')
+@app.route('/api/export/<int:device_id>')
+@login_required
+def api_export(device_id=None):
+    """
+    Streams raw readings of one device (or of all the user's devices) within
+    ?since=&until= as ?format=csv (default) or parquet, chunk by chunk.
+    """
+    device_ids = DeviceShare.get_device_ids_for_user(current_user.id)
+    if device_id is not None:
+        if device_id not in device_ids:
+            return jsonify({"error": "Device not authorized"}), 403
+        device_ids = {device_id}
+
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({"message": f"Unsupported format (use {', '.join(EXPORT_FORMATS)})"}), 400
+    try:
+        since = parse_timestamp(request.args.get('since'), 'since')
+        until = parse_timestamp(request.args.get('until'), 'until')
+    except PayloadError as e:
+        return jsonify({"message": str(e)}), 400
+
+    chunks = Reading.iter_export(device_ids, since=since, until=until)
+    body = parquet_chunks(chunks) if fmt == 'parquet' else csv_chunks(chunks)
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    filename = f"readings_{device_id if device_id is not None else 'all'}.{extension}"
+    return Response(body, mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+
+# --- API for Cold-Chain Excursion Events ---
+@app.route('/api/excursions')
+@login_required
+def api_excursions():
+    """Recent excursion events of the user's devices (?device_id= to filter, ?active=1 for open ones)."""
+    device_ids = DeviceShare.get_device_ids_for_user(current_user.id)
+    device_id = request.args.get('device_id', type=int)
+    if device_id is not None:
+        if device_id not in device_ids:
+            return jsonify({"error": "Device not authorized"}), 403
+        device_ids = {device_id}
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    events = ExcursionEvent.get_for_devices(device_ids, active_only=request.args.get('active') == '1', limit=limit)
+
+    return jsonify({'events': [
+        {
+            'id': e.id,
+            'device_id': e.device_id,
+            'kind': e.kind,
+            'started_at': e.started_at.isoformat(),
+            'ended_at': e.ended_at.isoformat() if e.ended_at else None,
+            'peak': e.peak_value,
+            'threshold': e.threshold,
+        }
+        for e in events
+    ]}), 200
+
+
+# --- API for Trips and Per-Trip Cold-Chain Summaries ---
+@app.route('/api/trips')
+@login_required
+def api_trips():
+    """
+    Trips of the user's devices that started within ?since=&until= (both optional),
+    newest first, plus compliance totals over the same trips (?device_id= to filter).
+    """
+    device_ids = DeviceShare.get_device_ids_for_user(current_user.id)
+    device_id = request.args.get('device_id', type=int)
+    if device_id is not None:
+        if device_id not in device_ids:
+            return jsonify({"error": "Device not authorized"}), 403
+        device_ids = {device_id}
+    try:
+        since = parse_timestamp(request.args.get('since'), 'since')
+        until = parse_timestamp(request.args.get('until'), 'until')
+    except PayloadError as e:
+        return jsonify({"message": str(e)}), 400
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+
+    return jsonify({
+        'summary': Trip.get_summary(device_ids, since, until),
+        'trips': [
+            {
+                'id': t.id,
+                'device_id': t.device_id,
+                'started_at': t.started_at.isoformat(),
+                'ended_at': t.ended_at.isoformat() if t.ended_at else None,
+                'in_progress': t.ended_at is None,
+                'duration_minutes': round(t.duration_seconds / 60, 1),
+                'distance_km': round(t.distance_m / 1000, 3),
+                'start': {'lat': t.start_latitude, 'lon': t.start_longitude},
+                'end': {'lat': t.end_latitude, 'lon': t.end_longitude},
+                'temp_min': t.temp_min,
+                'temp_max': t.temp_max,
+                'temp_avg': round(t.temp_avg, 2) if t.temp_avg is not None else None,
+                'temp_threshold': t.temp_threshold,
+                'minutes_above_threshold': round(t.seconds_above_threshold / 60, 1),
+                'sensor_failure_minutes': round(t.sensor_failure_seconds / 60, 1),
+                'gps_failure_minutes': round(t.gps_failure_seconds / 60, 1),
+            }
+            for t in Trip.get_for_devices(device_ids, since, until, limit)
+        ],
+    }), 200
+
+
+# --- API for Per-Device Alert Thresholds ---
+@app.route('/api/thresholds/<int:device_id>', methods=['GET', 'POST'])
+@login_required
+def api_device_thresholds(device_id):
+    if not DeviceShare.user_can_access(current_user.id, device_id):
+        return jsonify({"error": "Device not authorized"}), 403
+
+    thresholds = DeviceThresholds.get_for_device(device_id)
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"message": "Expected JSON payload"}), 400
+        try:
+            for field in DeviceThresholds.FIELDS:
+                if field in data:
+                    value = data[field]
+                    if value is None and field in ('temp_max', 'temp_min', 'max_rate_per_minute'):
+                        setattr(thresholds, field, None) # Disables that rule
+                    elif field in ('min_duration_seconds', 'sensor_failure_streak', 'gps_loss_streak'):
+                        setattr(thresholds, field, max(int(value), 0))
+                    else:
+                        setattr(thresholds, field, float(value))
+        except (TypeError, ValueError):
+            return jsonify({"message": "Invalid threshold value"}), 400
+
+        success, message = thresholds.save()
+        if not success:
+            return jsonify({"message": message}), 500
+        excursion_engine.invalidate_thresholds(device_id)
+
+    return jsonify(dict(thresholds.to_dict(), device_id=device_id)), 200
+
+
+# --- API for Per-Device Dead-Band Storage Policy ---
+@app.route('/api/deadband/<int:device_id>', methods=['GET', 'POST'])
+@login_required
+def api_device_deadband(device_id):
+    if not DeviceShare.user_can_access(current_user.id, device_id):
+        return jsonify({"error": "Device not authorized"}), 403
+
+    policy = DeviceDeadband.get_for_device(device_id)
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({"message": "Expected JSON payload"}), 400
+        try:
+            if 'enabled' in data:
+                policy.enabled = bool(data['enabled'])
+            for field in ('temp_delta', 'distance_m'):
+                if field in data:
+                    setattr(policy, field, max(float(data[field]), 0.0))
+            if 'heartbeat_seconds' in data:
+                policy.heartbeat_seconds = max(int(data['heartbeat_seconds']), 1)
+        except (TypeError, ValueError):
+            return jsonify({"message": "Invalid dead-band value"}), 400
+
+        success, message = policy.save()
+        if not success:
+            return jsonify({"message": message}), 500
+
+    return jsonify(dict(policy.to_dict(), device_id=device_id)), 200
+
+
+# --- API for Cache and Ingest Queue Statistics ---
+IN_PROCESS_CACHES = (imei_cache, token_cache, user_cache, device_access_cache, latest_version_cache,
+                     deadband_cache)
+
+
+@app.route('/api/stats/cache')
+@login_required
+def api_cache_stats():
+    return jsonify({
+        'caches': [c.stats() for c in IN_PROCESS_CACHES],
+        'ingest_queue': dict(ingest_queue.stats(), mode=INGEST_MODE),
+    }), 200
+
+
+# --- Prometheus Metrics (No Login Required; optional METRICS_TOKEN) ---
+def collect_runtime_gauges():
+    gauges = []
+    pool = get_db_pool()
+    if pool is not None:
+        stats = pool.get_stats()
+        for key in ('pool_min', 'pool_max', 'pool_size', 'pool_available', 'requests_waiting'):
+            gauges.append((f"coolmove_db_{key}", f"Connection pool {key.replace('_', ' ')}", {(): stats.get(key, 0)}))
+    if DATABASE_REPLICA_URLS:
+        replica_stats = [(p.name, p.get_stats()) for p in get_replica_pools()]
+        for key in ('pool_size', 'pool_available', 'requests_waiting'):
+            gauges.append((f"coolmove_db_replica_{key}", f"Replica connection pool {key.replace('_', ' ')}",
+                           {(('pool', name),): stats.get(key, 0) for name, stats in replica_stats}))
+    caches = [c.stats() for c in IN_PROCESS_CACHES]
+    for key in ('size', 'hits', 'misses'):
+        gauges.append((f"coolmove_cache_{key}", f"In-process cache {key}",
+                       {(('cache', c['name']),): c[key] for c in caches}))
+    queue_stats = ingest_queue.stats()
+    for key in ('queued', 'written', 'dropped', 'rejected_full'):
+        gauges.append((f"coolmove_ingest_queue_{key}", f"Write-behind ingest queue {key.replace('_', ' ')}",
+                       {(): queue_stats[key]}))
+    return gauges
+
+register_collector(collect_runtime_gauges)
+
+
+@app.route('/metrics')
+def metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        abort(401)
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 
 # --- API for Firmware Data (No Login Required) ---
 @app.route('/api/data', methods=['POST'])
 def receive_data():
-    # ... (Data receiving logic remains the same) ...
+    # Compact binary frames (see ingest.py) are negotiated by Content-Type
+    if request.mimetype == FRAME_CONTENT_TYPE:
+        return receive_frame()
+
     if not request.is_json:
+        record_rejected('receive_data', 'not_json')
         return jsonify({"message": "Expected JSON payload"}), 415
 
     data = request.get_json()
     
     try:
-        imei = data['imei']
-        lat = float(data['lat'])
-        lon = float(data['lon'])
-        temp = float(data['temp'])
-    except (KeyError, ValueError):
-        return jsonify({"message": "Invalid or missing data fields (imei, lat, lon, temp)"}), 400
+        imei, lat, lon, temp, gsm_time = parse_reading(data)
+    except PayloadError as e:
+        record_rejected('receive_data', 'invalid_payload')
+        return jsonify({"message": str(e)}), 400
+
+    # 2a. Write-behind mode: acknowledge now, the ingest writer stores it in a batch
+    if INGEST_MODE == 'async':
+        if imei_cache.get(imei, default=0) is None:
+            record_rejected('receive_data', 'unknown_device')
+            return jsonify({"message": "Device not found"}), 404 # Known-unknown IMEI (negative cache)
+        if not ingest_queue.submit((imei, lat, lon, temp, gsm_time)):
+            record_rejected('receive_data', 'queue_full')
+            response = jsonify({"message": "Server busy, retry later"})
+            response.headers['Retry-After'] = str(INGEST_RETRY_AFTER)
+            return response, 429
+        return jsonify({"message": "Data queued"}), 202
 
-    # 2. Securely insert data using the IMEI
-    success, message = Reading.insert_reading(imei, lat, lon, temp)
+    # 2b. Securely insert data using the IMEI
+    success, message = Reading.insert_reading(imei, lat, lon, temp, gsm_time)
 
     if success:
         return jsonify({"message": "Data recorded successfully"}), 200
     else:
         status_code = 404 if "Device not found" in message else 500
+        record_rejected('receive_data', 'unknown_device' if status_code == 404 else 'db_error')
         return jsonify({"message": message}), status_code
 
 
+def receive_frame():
+    """Stores the one or more samples of a binary frame, identified by the device token."""
+    # Never read more than the largest valid frame, whatever Content-Length says
+    if (request.content_length or 0) > MAX_FRAME_BYTES:
+        record_rejected('receive_data', 'too_large')
+        return jsonify({"message": "Payload too large"}), 413
+    body = request.stream.read(MAX_FRAME_BYTES + 1)
+    if len(body) > MAX_FRAME_BYTES:
+        record_rejected('receive_data', 'too_large')
+        return jsonify({"message": "Payload too large"}), 413
+    try:
+        token, samples = parse_frame(body)
+    except PayloadError as e:
+        record_rejected('receive_data', 'invalid_payload')
+        return jsonify({"message": str(e)}), 400
+
+    imei = Device.get_imei_by_token(token)
+    if imei is None:
+        record_rejected('receive_data', 'unknown_device', len(samples))
+        return jsonify({"message": "Device not found"}), 404
+    readings = [(imei, lat, lon, temp, gsm_time) for lat, lon, temp, gsm_time in samples]
+
+    if INGEST_MODE == 'async':
+        if not ingest_queue.submit_many(readings):
+            record_rejected('receive_data', 'queue_full', len(readings))
+            response = jsonify({"message": "Server busy, retry later"})
+            response.headers['Retry-After'] = str(INGEST_RETRY_AFTER)
+            return response, 429
+        return jsonify({"message": "Data queued"}), 202
+
+    # All samples belong to one device, so they succeed or fail together
+    ok, message = Reading.insert_readings(readings)[0]
+    if ok:
+        return jsonify({"message": "Data recorded successfully"}), 200
+    status_code = 404 if "Device not found" in message else 500
+    record_rejected('receive_data', 'unknown_device' if status_code == 404 else 'db_error', len(readings))
+    return jsonify({"message": message}), status_code
+
+
+# --- API for Device Tokens (used by binary ingest frames) ---
+@app.route('/api/token/<int:device_id>', methods=['GET', 'POST'])
+@login_required
+def api_device_token(device_id):
+    """GET returns the device token (issuing one on first use); POST rotates it."""
+    if not DeviceShare.user_can_access(current_user.id, device_id):
+        return jsonify({"error": "Device not authorized"}), 403
+
+    token = Device.get_token(device_id, rotate=request.method == 'POST')
+    if token is None:
+        return jsonify({"message": "Could not issue device token"}), 500
+    return jsonify({"device_id": device_id, "token": token.hex()}), 200
+
+
+# --- API for Buffered/Gateway Uploads (No Login Required) ---
+@app.route('/api/data/batch', methods=['POST'])
+def receive_data_batch():
+    """
+    Accepts many readings in one request, either as a JSON array or as
+    {"imei": ..., "readings": [...]} where the top-level IMEI is used for items
+    that don't carry their own. Each item may include a device-side "gsm_time".
+    """
+    if not request.is_json:
+        record_rejected('receive_data_batch', 'not_json')
+        return jsonify({"message": "Expected JSON payload"}), 415
+
+    data = request.get_json()
+    default_imei = None
+    if isinstance(data, dict):
+        default_imei = data.get('imei')
+        data = data.get('readings')
+    if not isinstance(data, list) or not data:
+        record_rejected('receive_data_batch', 'invalid_payload')
+        return jsonify({"message": "Expected a non-empty list of readings"}), 400
+    if len(data) > MAX_BATCH_SIZE:
+        record_rejected('receive_data_batch', 'batch_too_large')
+        return jsonify({"message": f"Batch too large (max {MAX_BATCH_SIZE} readings)"}), 413
+
+    # 1. Validate every item; invalid ones are reported but don't fail the batch
+    results = [None] * len(data)
+    valid = []
+    for index, item in enumerate(data):
+        try:
+            valid.append((index, parse_reading(item, default_imei)))
+        except PayloadError as e:
+            results[index] = (False, str(e))
+
+    # 2. Write all valid readings in one transaction
+    stored = Reading.insert_readings([reading for _, reading in valid])
+    for (index, _), outcome in zip(valid, stored):
+        results[index] = outcome
+
+    items = [
+        {'index': i, 'status': 'OK'} if ok else {'index': i, 'status': 'Error', 'message': message}
+        for i, (ok, message) in enumerate(results)
+    ]
+    accepted = sum(1 for ok, _ in results if ok)
+    for ok, message in results:
+        if not ok:
+            record_rejected('receive_data_batch', 'db_error' if message.startswith("Database")
+                            else 'unknown_device' if "Device not found" in message else 'invalid_payload')
+    # A database error rolls back the whole batch, so ask the gateway to retry it
+    status_code = 500 if any(not ok and message.startswith("Database") for ok, message in stored) else 200
+    return jsonify({"accepted": accepted, "rejected": len(results) - accepted, "results": items}), status_code
+
+
 # --- Run the App ---
 if __name__ == '__main__':
     # ... (App run logic remains the same) ...
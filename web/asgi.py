@@ -0,0 +1,392 @@
+# FILE: web/asgi.py
+"""
+Asyncio (ASGI) server for the device-facing endpoints, for deployments with
+many slow cellular connections:
+
+    POST /api/data                JSON or binary frame, same rules as receive_data
+    GET  /api/latest              latest state of the logged-in user's devices
+    GET  /api/latest/<device_id>
+    GET  /metrics                 this process's metrics (scrape it next to the Flask app's)
+
+Run it next to the Flask app (see Procfile) and route these paths to it:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8001
+
+Waiting on a client's body or on a query only parks a coroutine, so one
+process can hold thousands of open connections. Lookups and latest-state
+reads run on psycopg's AsyncConnectionPool with the same SQL as models.py.
+Writes go through Reading.insert_readings, so dead-band, rollups and the
+stream processors behave exactly as under Flask. In the default
+INGEST_MODE=sync they run in a worker thread before answering. With
+INGEST_MODE=async they go to the write-behind queue and the answer is 202.
+"""
+
+import os
+import json
+import asyncio
+from datetime import timezone
+from email.utils import format_datetime
+from http import HTTPStatus
+
+from dotenv import load_dotenv
+from psycopg_pool import AsyncConnectionPool
+
+from cache import MISSING
+from models import (Device, Reading, LatestReading, DeviceShare, latest_reading_json, latest_validators,
+                    get_db_pool, imei_cache, token_cache, device_access_cache, latest_version_cache,
+                    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_MAX_IDLE, DB_POOL_MAX_LIFETIME)
+from ingest import parse_reading, parse_frame, PayloadError, FRAME_CONTENT_TYPE
+from ingest_queue import ingest_queue, INGEST_MODE, INGEST_RETRY_AFTER
+from metrics import register_collector, render_metrics, record_ingest, record_rejected, METRICS_TOKEN
+import excursions # Registers the rule engine on Reading.on_storing
+import trips # Registers the trip segmenter on Reading.on_storing
+
+load_dotenv()
+
+# Per-device ingest counts for /metrics, as in app.py
+Reading.on_stored(record_ingest)
+
+# Largest request body read from a tracker (a full binary frame is ~3.6 KB)
+MAX_BODY_BYTES = int(os.environ.get('ASGI_MAX_BODY_BYTES', 64 * 1024))
+
+_pool = None
+
+
+# ----------------------------------------------------------------------
+# 1. DATABASE (async pool, SQL shared with models.py)
+# ----------------------------------------------------------------------
+
+async def open_pool():
+    global _pool
+    _pool = AsyncConnectionPool(
+        conninfo=os.environ['DATABASE_URL'],
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        timeout=DB_POOL_TIMEOUT,
+        max_idle=DB_POOL_MAX_IDLE,
+        max_lifetime=DB_POOL_MAX_LIFETIME,
+        check=AsyncConnectionPool.check_connection,
+        name='coolmove-async',
+        open=False,
+    )
+    await _pool.open()
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+async def fetch(sql, params, one=False):
+    async with _pool.connection() as conn:
+        cur = await conn.execute(sql, params)
+        return await (cur.fetchone() if one else cur.fetchall())
+
+
+async def resolve_device_id(imei):
+    """IMEI -> device id (None if unknown), through the same cache as Device.resolve_device_ids."""
+    device_id = imei_cache.get(imei)
+    if device_id is MISSING:
+        found = dict(await fetch(Device._RESOLVE_IMEIS_SQL, ([imei],)))
+        device_id = found.get(imei)
+        imei_cache.set(imei, device_id)
+    return device_id
+
+
+async def imei_for_token(token):
+    imei = token_cache.get(token)
+    if imei is MISSING:
+        row = await fetch(Device._IMEI_BY_TOKEN_SQL, (token,), one=True)
+        imei = row[0] if row else None
+        token_cache.set(token, imei)
+    return imei
+
+
+async def device_ids_for_user(user_id):
+    device_ids = device_access_cache.get(user_id)
+    if device_ids is MISSING:
+        device_ids = frozenset(row[0] for row in await fetch(DeviceShare._DEVICE_IDS_SQL, (user_id,)))
+        device_access_cache.set(user_id, device_ids)
+    return device_ids
+
+
+async def latest_versions(device_ids):
+    """Like Reading.get_latest_versions, through the same version cache."""
+    versions, misses = {}, []
+    for device_id in device_ids:
+        version = latest_version_cache.get(device_id)
+        if version is MISSING:
+            misses.append(device_id)
+        else:
+            versions[device_id] = version
+    if misses:
+        found = dict(await fetch(Reading._LATEST_VERSIONS_SQL, (misses,)))
+        for device_id in misses:
+            versions[device_id] = found.get(device_id)
+            latest_version_cache.set(device_id, versions[device_id])
+    return versions
+
+
+# ----------------------------------------------------------------------
+# 2. HTTP PLUMBING
+# ----------------------------------------------------------------------
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.body = body
+
+    @property
+    def mimetype(self):
+        return self.headers.get('content-type', '').split(';')[0].strip().lower()
+
+    @property
+    def is_json(self):
+        return self.mimetype == 'application/json' or self.mimetype.endswith('+json')
+
+    def cookie(self, name):
+        for part in self.headers.get('cookie', '').split(';'):
+            key, _, value = part.strip().partition('=')
+            if key == name:
+                return value
+        return None
+
+    def etag_matches(self, etag):
+        """Whether If-None-Match has `etag` (weak comparison, like Flask's contains_weak)."""
+        tags = [tag.strip() for tag in self.headers.get('if-none-match', '').split(',') if tag.strip()]
+        return '*' in tags or any(tag.removeprefix('W/').strip('"') == etag for tag in tags)
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+async def read_body(receive):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise BodyTooLarge()
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+def validator_headers(etag, last_modified):
+    """ETag, Last-Modified and Cache-Control as app.py's with_validators sets them."""
+    headers = [('ETag', f'W/"{etag}"'), ('Cache-Control', 'private, no-cache')]
+    if last_modified:
+        headers.append(('Last-Modified', format_datetime(last_modified.astimezone(timezone.utc), usegmt=True)))
+    return headers
+
+
+async def send_response(send, status, payload, headers=()):
+    """Sends a dict as JSON, a str as plain text (/metrics) or None as an empty body (304)."""
+    if payload is None:
+        body, content = b'', []
+    else:
+        if isinstance(payload, str):
+            body, content_type = payload.encode(), b'text/plain; version=0.0.4'
+        else:
+            body, content_type = json.dumps(payload).encode(), b'application/json'
+        content = [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': content + [(name.encode(), value.encode()) for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# ----------------------------------------------------------------------
+# 3. ENDPOINTS
+# ----------------------------------------------------------------------
+
+async def store(readings):
+    """Stores validated reading tuples per INGEST_MODE. Returns (status, payload, headers)."""
+    if INGEST_MODE == 'async':
+        if not ingest_queue.submit_many(readings):
+            record_rejected('receive_data', 'queue_full', len(readings))
+            return (HTTPStatus.TOO_MANY_REQUESTS, {"message": "Server busy, retry later"},
+                    [('Retry-After', str(INGEST_RETRY_AFTER))])
+        return HTTPStatus.ACCEPTED, {"message": "Data queued"}, []
+
+    ok, message = (await asyncio.to_thread(Reading.insert_readings, readings))[0]
+    if ok:
+        return HTTPStatus.OK, {"message": "Data recorded successfully"}, []
+    status = HTTPStatus.NOT_FOUND if "Device not found" in message else HTTPStatus.INTERNAL_SERVER_ERROR
+    record_rejected('receive_data', 'unknown_device' if status == HTTPStatus.NOT_FOUND else 'db_error',
+                    len(readings))
+    return status, {"message": message}, []
+
+
+async def receive_data(request):
+    """Same validation and answers as the Flask receive_data, for JSON and binary frames."""
+    try:
+        if request.mimetype == FRAME_CONTENT_TYPE:
+            token, samples = parse_frame(request.body)
+            imei = await imei_for_token(token)
+            readings = [(imei, lat, lon, temp, gsm_time) for lat, lon, temp, gsm_time in samples]
+        elif request.is_json:
+            try:
+                data = json.loads(request.body)
+            except ValueError:
+                raise PayloadError("Invalid JSON payload")
+            readings = [parse_reading(data)]
+            imei = readings[0][0]
+        else:
+            record_rejected('receive_data', 'not_json')
+            return HTTPStatus.UNSUPPORTED_MEDIA_TYPE, {"message": "Expected JSON payload"}, []
+    except PayloadError as e:
+        record_rejected('receive_data', 'invalid_payload')
+        return HTTPStatus.BAD_REQUEST, {"message": str(e)}, []
+
+    # Unknown trackers are turned away without touching the write path
+    if imei is None or await resolve_device_id(imei) is None:
+        record_rejected('receive_data', 'unknown_device', len(readings))
+        return HTTPStatus.NOT_FOUND, {"message": "Device not found"}, []
+    return await store(readings)
+
+
+def current_user_id(request):
+    """User id from the Flask session cookie (set by /login), or None."""
+    cookie = request.cookie(SESSION_COOKIE_NAME)
+    if not cookie:
+        return None
+    try:
+        session = _session_serializer.loads(cookie, max_age=SESSION_MAX_AGE)
+    except Exception:
+        return None
+    user_id = session.get('_user_id')
+    return int(user_id) if user_id is not None else None
+
+
+async def latest_readings(request, device_id=None):
+    user_id = current_user_id(request)
+    if user_id is None:
+        return HTTPStatus.UNAUTHORIZED, {"error": "Login required"}, []
+    device_ids = await device_ids_for_user(user_id)
+    no_data = {"status": "NoData", "message": "No readings found for this device"}
+
+    if device_id is not None:
+        if device_id not in device_ids:
+            return HTTPStatus.FORBIDDEN, {"error": "Device not authorized"}, []
+        device_ids = frozenset((device_id,))
+
+    # Unchanged since the client's copy? Answer 304 from the cached latest-state version
+    if 'if-none-match' in request.headers:
+        validators = latest_validators(await latest_versions(device_ids))
+        if request.etag_matches(validators[0]):
+            return HTTPStatus.NOT_MODIFIED, None, validator_headers(*validators)
+
+    if device_id is not None:
+        row = await fetch(Reading._LATEST_FOR_DEVICE_SQL, (device_id,), one=True)
+        readings = {device_id: LatestReading(*row)} if row else {}
+    else:
+        readings = {row[1]: LatestReading(*row) for row in await fetch(Reading._LATEST_FOR_USER_SQL, (user_id,))}
+    versions = {d: readings[d].received_at if d in readings else None for d in device_ids | readings.keys()}
+    for d, version in versions.items():
+        latest_version_cache.set(d, version)
+    validators = validator_headers(*latest_validators(versions))
+
+    if device_id is not None:
+        return HTTPStatus.OK, latest_reading_json(readings[device_id]) if readings else no_data, validators
+    devices = {str(d): latest_reading_json(readings[d]) if d in readings else no_data for d in versions}
+    return HTTPStatus.OK, {"devices": devices}, validators
+
+
+def metrics(request):
+    if METRICS_TOKEN and request.headers.get('authorization') != f"Bearer {METRICS_TOKEN}":
+        return HTTPStatus.UNAUTHORIZED, {"message": "Unauthorized"}, []
+    return HTTPStatus.OK, render_metrics(), []
+
+
+def collect_runtime_gauges():
+    """Pool, cache and queue stats of this process (app.py registers the Flask side's)."""
+    gauges = []
+    for prefix, pool in (('coolmove_db', get_db_pool()), ('coolmove_db_async', _pool)):
+        if pool is not None:
+            stats = pool.get_stats()
+            for key in ('pool_min', 'pool_max', 'pool_size', 'pool_available', 'requests_waiting'):
+                gauges.append((f"{prefix}_{key}", f"Connection pool {key.replace('_', ' ')}", {(): stats.get(key, 0)}))
+    caches = [c.stats() for c in (imei_cache, token_cache, device_access_cache, latest_version_cache)]
+    for key in ('size', 'hits', 'misses'):
+        gauges.append((f"coolmove_cache_{key}", f"In-process cache {key}",
+                       {(('cache', c['name']),): c[key] for c in caches}))
+    queue_stats = ingest_queue.stats()
+    for key in ('queued', 'written', 'dropped', 'rejected_full'):
+        gauges.append((f"coolmove_ingest_queue_{key}", f"Write-behind ingest queue {key.replace('_', ' ')}",
+                       {(): queue_stats[key]}))
+    return gauges
+
+register_collector(collect_runtime_gauges)
+
+
+async def route(request):
+    parts = request.path.rstrip('/').split('/')
+    if request.path == '/api/data':
+        if request.method != 'POST':
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"message": "Method not allowed"}, []
+        return await receive_data(request)
+    if request.path == '/metrics' and request.method == 'GET':
+        return metrics(request)
+    if parts[:3] == ['', 'api', 'latest'] and len(parts) <= 4 and request.method == 'GET':
+        if len(parts) == 3:
+            return await latest_readings(request)
+        if parts[3].isdigit():
+            return await latest_readings(request, int(parts[3]))
+    return HTTPStatus.NOT_FOUND, {"message": "Not found"}, []
+
+
+# Flask session cookies are signed with FLASK_SECRET_KEY; read them the way Flask does
+def _make_session_serializer():
+    from flask import Flask
+    from flask.sessions import SecureCookieSessionInterface
+    flask_app = Flask(__name__)
+    flask_app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'a-very-secret-default-key')
+    return (SecureCookieSessionInterface().get_signing_serializer(flask_app),
+            flask_app.config['SESSION_COOKIE_NAME'],
+            int(flask_app.permanent_session_lifetime.total_seconds()))
+
+_session_serializer, SESSION_COOKIE_NAME, SESSION_MAX_AGE = _make_session_serializer()
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await open_pool()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await close_pool()
+                # Drain the write-behind queue (blocking) before the process exits
+                await asyncio.to_thread(ingest_queue.stop)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+
+    try:
+        body = await read_body(receive)
+    except BodyTooLarge:
+        record_rejected('receive_data', 'too_large')
+        await send_response(send, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"message": "Payload too large"})
+        return
+    if body is None:
+        return # Client went away
+
+    try:
+        status, payload, headers = await route(Request(scope, body))
+    except Exception as e:
+        print(f"ASGI request failed: {e}")
+        status, payload, headers = HTTPStatus.INTERNAL_SERVER_ERROR, {"message": "Internal server error"}, []
+    await send_response(send, status, payload, headers)
@@ -0,0 +1,74 @@
+# FILE: web/cache.py
+
+import time
+import threading
+from collections import OrderedDict
+
+# Returned by TTLCache.get() when a key is not cached (None is a valid cached value)
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Small thread-safe in-process cache with a size bound (least recently used
+    entries are evicted first) and a per-entry time-to-live.
+
+    A value of None can be stored as a "negative" entry (e.g. "this IMEI does
+    not exist") and uses its own, usually shorter, TTL.
+
+    Each gunicorn worker has its own copy, so invalidation is local to the
+    process; the TTL bounds how stale other workers can be.
+    """
+    def __init__(self, name, maxsize=1024, ttl=300, negative_ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        ttl = self.negative_ttl if value is None else self.ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'name': self.name,
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+            }
@@ -0,0 +1,47 @@
+# FILE: web/cell_grid.py
+
+import math
+
+# The fleet spatial index (device_cells) numbers CELL_DEGREES squares row by
+# row (row * COLUMNS + column), so the cells around a point form one id range
+# per grid row.
+CELL_DEGREES = 0.1
+COLUMNS = 3600  # 360 / CELL_DEGREES
+ROWS = 1800     # 180 / CELL_DEGREES
+KM_PER_DEGREE = 111.32
+
+
+def cell_for(lat, lon):
+    """Grid cell id of a position, or None if it isn't a finite position on the globe."""
+    if not (math.isfinite(lat) and math.isfinite(lon) and -90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    row = min(int(math.floor((lat + 90) / CELL_DEGREES)), ROWS - 1) # lat 90 joins the top row
+    column = int(math.floor((lon + 180) / CELL_DEGREES)) % COLUMNS
+    return row * COLUMNS + column
+
+
+def cell_ranges(lat, lon, radius_km):
+    """(lows, highs) cell id ranges covering the circle's bounding box, split at the antimeridian."""
+    dlat = radius_km / KM_PER_DEGREE
+    dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    first_row = max(int(math.floor((lat - dlat + 90) / CELL_DEGREES)), 0)
+    last_row = min(int(math.floor((lat + dlat + 90) / CELL_DEGREES)), ROWS - 1)
+
+    if dlon >= 180:
+        spans = [(0, COLUMNS - 1)]
+    else:
+        west = int(math.floor((lon - dlon + 180) / CELL_DEGREES))
+        east = int(math.floor((lon + dlon + 180) / CELL_DEGREES))
+        if west < 0:
+            spans = [(0, east), (west + COLUMNS, COLUMNS - 1)]
+        elif east >= COLUMNS:
+            spans = [(west, COLUMNS - 1), (0, east - COLUMNS)]
+        else:
+            spans = [(west, east)]
+
+    lows, highs = [], []
+    for row in range(first_row, last_row + 1):
+        for west, east in spans:
+            lows.append(row * COLUMNS + west)
+            highs.append(row * COLUMNS + east)
+    return lows, highs
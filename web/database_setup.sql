@@ -4,6 +4,15 @@
 -- ONLY run this if you are setting up a fresh database.
 
 -- Drop tables if they exist (to allow safe re-running)
+DROP TABLE IF EXISTS trip_state;
+DROP TABLE IF EXISTS trips;
+DROP TABLE IF EXISTS device_cells;
+DROP TABLE IF EXISTS device_deadband;
+DROP TABLE IF EXISTS excursion_state;
+DROP TABLE IF EXISTS excursion_events;
+DROP TABLE IF EXISTS device_thresholds;
+DROP TABLE IF EXISTS reading_rollups;
+DROP TABLE IF EXISTS device_latest;
 DROP TABLE IF EXISTS readings;
 DROP TABLE IF EXISTS device_shares; -- New share table
 DROP TABLE IF EXISTS devices;
@@ -25,6 +34,10 @@ CREATE TABLE devices (
     device_name VARCHAR(100) NOT NULL,
     -- IMEI is the unique identifier from the physical tracker
     unique_imei VARCHAR(15) UNIQUE NOT NULL, 
+    -- Short random token identifying the tracker in binary ingest frames
+    -- (instead of the 15-digit IMEI). Issued via /api/token/<device_id>.
+    -- Existing databases: ALTER TABLE devices ADD COLUMN device_token BYTEA UNIQUE;
+    device_token BYTEA UNIQUE,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
 );
 
@@ -39,17 +52,239 @@ CREATE TABLE device_shares (
 );
 
 -- 4. READINGS Table (GPS/Temp Data)
+-- Partitioned by month on received_at (one table per month, e.g. readings_2025_01),
+-- so time-bounded queries only touch recent partitions and old months can be
+-- archived and dropped as a whole (see partitions.py).
+-- The partition key must be part of the primary key, hence (id, received_at).
 CREATE TABLE readings (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
     latitude DOUBLE PRECISION NOT NULL,
     longitude DOUBLE PRECISION NOT NULL,
     temperature DOUBLE PRECISION NOT NULL,
     gsm_time TIMESTAMP WITH TIME ZONE, -- Time from the GPS/GSM module
-    received_at TIMESTAMP WITH TIME ZONE DEFAULT NOW() -- Time received by the server
+    received_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(), -- Time received by the server
+    PRIMARY KEY (id, received_at)
+) PARTITION BY RANGE (received_at);
+
+-- Create index for faster data retrieval by device (created on every partition).
+-- id is included so keyset pagination on (received_at, id) is a pure index range scan.
+CREATE INDEX idx_readings_device_id_received_at ON readings (device_id, received_at DESC, id DESC);
+
+-- Creates the partition holding the (UTC) calendar month of month_start, if missing.
+-- Called here for the first months and then by partitions.py ahead of time.
+CREATE OR REPLACE FUNCTION create_readings_partition(month_start DATE) RETURNS TEXT AS $$
+DECLARE
+    start_date DATE := date_trunc('month', month_start)::DATE;
+    end_date DATE := (date_trunc('month', month_start) + INTERVAL '1 month')::DATE;
+    partition_name TEXT := format('readings_%s', to_char(start_date, 'YYYY_MM'));
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF readings FOR VALUES FROM (%L) TO (%L)',
+        partition_name,
+        start_date::TIMESTAMP AT TIME ZONE 'UTC',
+        end_date::TIMESTAMP AT TIME ZONE 'UTC'
+    );
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Current month and the next three
+SELECT create_readings_partition((date_trunc('month', NOW() AT TIME ZONE 'UTC') + make_interval(months => m))::DATE)
+FROM generate_series(0, 3) AS m;
+
+-- Existing (unpartitioned) databases: rename the old table, create the
+-- partitioned table and function above, create partitions covering the old
+-- data's months, then copy it over:
+--   ALTER TABLE readings RENAME TO readings_unpartitioned;
+--   ... run the statements above ...
+--   INSERT INTO readings SELECT * FROM readings_unpartitioned;
+--   SELECT setval(pg_get_serial_sequence('readings', 'id'), (SELECT MAX(id) FROM readings));
+
+-- 5. DEVICE_LATEST Table (Latest state per device)
+-- Upserted in the same transaction as every insert into readings, so the
+-- dashboard reads one row per device instead of scanning readings.
+-- last_fix_* / last_valid_temperature* skip the -999 sentinel values the
+-- firmware sends on GPS/sensor failure.
+CREATE TABLE device_latest (
+    device_id INTEGER PRIMARY KEY REFERENCES devices(id) ON DELETE CASCADE,
+    -- Last stored reading; NULL while only dead-band suppressed samples were seen
+    -- (existing databases: ALTER TABLE device_latest ALTER COLUMN reading_id DROP NOT NULL;)
+    reading_id INTEGER,
+    latitude DOUBLE PRECISION NOT NULL,
+    longitude DOUBLE PRECISION NOT NULL,
+    temperature DOUBLE PRECISION NOT NULL,
+    gsm_time TIMESTAMP WITH TIME ZONE,
+    received_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    last_fix_latitude DOUBLE PRECISION,
+    last_fix_longitude DOUBLE PRECISION,
+    last_fix_at TIMESTAMP WITH TIME ZONE,
+    last_valid_temperature DOUBLE PRECISION,
+    last_valid_temperature_at TIMESTAMP WITH TIME ZONE,
+    -- Samples not written to readings because of the device's dead-band policy
+    suppressed_count BIGINT NOT NULL DEFAULT 0
 );
 
--- Create index for faster data retrieval by device
-CREATE INDEX idx_readings_device_id_received_at ON readings (device_id, received_at DESC);
+-- Existing databases: create the table above, then backfill it with
+--   INSERT INTO device_latest (device_id, reading_id, latitude, longitude, temperature, gsm_time, received_at,
+--                              last_fix_latitude, last_fix_longitude, last_fix_at,
+--                              last_valid_temperature, last_valid_temperature_at)
+--   SELECT DISTINCT ON (r.device_id) r.device_id, r.id, r.latitude, r.longitude, r.temperature, r.gsm_time, r.received_at,
+--          f.latitude, f.longitude, f.received_at, t.temperature, t.received_at
+--   FROM readings r
+--   LEFT JOIN LATERAL (SELECT latitude, longitude, received_at FROM readings
+--                      WHERE device_id = r.device_id AND latitude > -999 AND longitude > -999
+--                      ORDER BY received_at DESC LIMIT 1) f ON TRUE
+--   LEFT JOIN LATERAL (SELECT temperature, received_at FROM readings
+--                      WHERE device_id = r.device_id AND temperature > -999
+--                      ORDER BY received_at DESC LIMIT 1) t ON TRUE
+--   ORDER BY r.device_id, r.received_at DESC, r.id DESC;
+
+-- 6. READING_ROLLUPS Table (Time-bucketed history)
+-- Per-device aggregates over 1-minute (60) and 1-hour (3600) buckets, updated
+-- incrementally with every insert. Long-range history is read from here.
+-- Readings are bucketed by when they were taken (gsm_time, capped at
+-- received_at), so a buffered backlog upload spreads over its real buckets.
+-- Positions are the first/last valid GPS fix in the bucket; the *_failures
+-- columns count -999 sentinel readings.
+CREATE TABLE reading_rollups (
+    device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+    bucket_seconds INTEGER NOT NULL,
+    bucket_start TIMESTAMP WITH TIME ZONE NOT NULL,
+    sample_count INTEGER NOT NULL,
+    temp_count INTEGER NOT NULL,
+    temp_min DOUBLE PRECISION,
+    temp_max DOUBLE PRECISION,
+    temp_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    first_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    last_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    first_latitude DOUBLE PRECISION,
+    first_longitude DOUBLE PRECISION,
+    last_latitude DOUBLE PRECISION,
+    last_longitude DOUBLE PRECISION,
+    temp_failures INTEGER NOT NULL DEFAULT 0,
+    gps_failures INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (device_id, bucket_seconds, bucket_start)
+);
+
+-- 7. DEVICE_THRESHOLDS Table (Per-device cold-chain rules)
+-- Devices without a row use DeviceThresholds.DEFAULTS in models.py.
+-- A NULL temp_max/temp_min/max_rate_per_minute disables that rule.
+CREATE TABLE device_thresholds (
+    device_id INTEGER PRIMARY KEY REFERENCES devices(id) ON DELETE CASCADE,
+    temp_max DOUBLE PRECISION,
+    temp_min DOUBLE PRECISION,
+    hysteresis DOUBLE PRECISION NOT NULL DEFAULT 0.5,
+    min_duration_seconds INTEGER NOT NULL DEFAULT 60,
+    max_rate_per_minute DOUBLE PRECISION,
+    sensor_failure_streak INTEGER NOT NULL DEFAULT 3,
+    gps_loss_streak INTEGER NOT NULL DEFAULT 12
+);
+
+-- 8. EXCURSION_EVENTS Table (Detected excursions)
+-- kind: temp_high, temp_low, rate_of_change, sensor_failure, gps_loss.
+-- ended_at is NULL while the excursion is still open.
+CREATE TABLE excursion_events (
+    id SERIAL PRIMARY KEY,
+    device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+    kind VARCHAR(20) NOT NULL,
+    started_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    ended_at TIMESTAMP WITH TIME ZONE,
+    start_reading_id INTEGER,
+    end_reading_id INTEGER,
+    peak_value DOUBLE PRECISION,
+    threshold DOUBLE PRECISION
+);
+
+CREATE INDEX idx_excursion_events_device_id_started_at ON excursion_events (device_id, started_at DESC);
+
+-- Rule engine progress per device (see ExcursionState in models.py), updated
+-- under a row lock in the same transaction as the readings. conditions maps
+-- each tracked kind to its pending breach/streak and open event id.
+CREATE TABLE excursion_state (
+    device_id INTEGER PRIMARY KEY REFERENCES devices(id) ON DELETE CASCADE,
+    conditions JSONB NOT NULL DEFAULT '{}',
+    last_temp DOUBLE PRECISION,
+    last_temp_at TIMESTAMP WITH TIME ZONE
+);
+
+-- 9. DEVICE_DEADBAND Table (Per-device storage compression)
+-- When enabled, a reading is only stored if it differs meaningfully from the
+-- last stored one (see DeviceDeadband in models.py) or the heartbeat elapsed.
+CREATE TABLE device_deadband (
+    device_id INTEGER PRIMARY KEY REFERENCES devices(id) ON DELETE CASCADE,
+    enabled BOOLEAN NOT NULL DEFAULT FALSE,
+    temp_delta DOUBLE PRECISION NOT NULL DEFAULT 0.3,
+    distance_m DOUBLE PRECISION NOT NULL DEFAULT 25,
+    heartbeat_seconds INTEGER NOT NULL DEFAULT 300
+);
+
+-- 10. DEVICE_CELLS Table (Spatial index of where devices have been)
+-- One row per device, ~11 km grid cell (0.1 degree, see DeviceCell in
+-- models.py) and hour with stored readings that had a GPS fix. "Which devices
+-- passed near this point" looks up the cells around the point first and only
+-- reads the matching device-hours from readings.
+CREATE TABLE device_cells (
+    cell INTEGER NOT NULL,
+    hour_start TIMESTAMP WITH TIME ZONE NOT NULL,
+    device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+    reading_count INTEGER NOT NULL,
+    PRIMARY KEY (cell, hour_start, device_id)
+);
+
+-- Latest positions inside a map bounding box
+CREATE INDEX idx_device_latest_last_fix ON device_latest (last_fix_latitude, last_fix_longitude);
+
+-- Existing databases: create the table and index above, then backfill with
+--   INSERT INTO device_cells (cell, hour_start, device_id, reading_count)
+--   SELECT FLOOR((latitude + 90) / 0.1)::int * 3600 + FLOOR((longitude + 180) / 0.1)::int % 3600,
+--          date_trunc('hour', received_at), device_id, COUNT(*)
+--   FROM readings WHERE latitude > -999 AND longitude > -999
+--   GROUP BY 1, 2, 3;
+
+-- 11. TRIPS Table (Trip segmentation and per-trip cold-chain summary)
+-- Maintained incrementally by trips.py: a trip starts when a device leaves the
+-- spot it rested at and ends once it stays within a small radius for the
+-- dwell time. ended_at is NULL while the trip is in progress; the *_seconds
+-- columns are time spent above temp_threshold (the device's temp_max when the
+-- trip ran) and with -999 sensor/GPS failure readings.
+CREATE TABLE trips (
+    id SERIAL PRIMARY KEY,
+    device_id INTEGER NOT NULL REFERENCES devices(id) ON DELETE CASCADE,
+    started_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    ended_at TIMESTAMP WITH TIME ZONE,
+    last_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    start_latitude DOUBLE PRECISION NOT NULL,
+    start_longitude DOUBLE PRECISION NOT NULL,
+    end_latitude DOUBLE PRECISION NOT NULL,
+    end_longitude DOUBLE PRECISION NOT NULL,
+    distance_m DOUBLE PRECISION NOT NULL DEFAULT 0,
+    sample_count INTEGER NOT NULL DEFAULT 0,
+    temp_count INTEGER NOT NULL DEFAULT 0,
+    temp_min DOUBLE PRECISION,
+    temp_max DOUBLE PRECISION,
+    temp_sum DOUBLE PRECISION NOT NULL DEFAULT 0,
+    temp_threshold DOUBLE PRECISION,
+    seconds_above_threshold DOUBLE PRECISION NOT NULL DEFAULT 0,
+    sensor_failure_seconds DOUBLE PRECISION NOT NULL DEFAULT 0,
+    gps_failure_seconds DOUBLE PRECISION NOT NULL DEFAULT 0
+);
+
+CREATE INDEX idx_trips_device_id_started_at ON trips (device_id, started_at DESC);
+
+-- Trip segmenter progress per device (see TripState in models.py), updated
+-- under a row lock in the same transaction as the readings.
+CREATE TABLE trip_state (
+    device_id INTEGER PRIMARY KEY REFERENCES devices(id) ON DELETE CASCADE,
+    trip_id INTEGER REFERENCES trips(id) ON DELETE SET NULL,
+    previous_at TIMESTAMP WITH TIME ZONE,
+    previous_temp DOUBLE PRECISION,
+    previous_has_fix BOOLEAN,
+    anchor_latitude DOUBLE PRECISION,
+    anchor_longitude DOUBLE PRECISION,
+    anchor_at TIMESTAMP WITH TIME ZONE,
+    last_fix_latitude DOUBLE PRECISION,
+    last_fix_longitude DOUBLE PRECISION
+);
 
 -- Example: To run this script: psql -d your_db_name -f web/database_setup.sql
\ No newline at end of file
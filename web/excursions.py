@@ -0,0 +1,204 @@
+# FILE: web/excursions.py
+
+from datetime import datetime
+
+from cache import TTLCache, MISSING
+from models import Reading, DeviceThresholds, ExcursionEvent, ExcursionState
+
+# Event kinds stored in excursion_events.kind
+TEMP_HIGH = 'temp_high'
+TEMP_LOW = 'temp_low'
+RATE_OF_CHANGE = 'rate_of_change'
+SENSOR_FAILURE = 'sensor_failure'
+GPS_LOSS = 'gps_loss'
+# Kinds with progress kept in excursion_state (rate_of_change is instantaneous)
+TRACKED_KINDS = (TEMP_HIGH, TEMP_LOW, SENSOR_FAILURE, GPS_LOSS)
+
+
+class _Condition:
+    """Tracks one rule for one device: a pending breach, then an open event until it clears."""
+    def __init__(self, data=None):
+        data = data or {}
+        pending_since = data.get('pending_since')
+        self.pending_since = datetime.fromisoformat(pending_since) if pending_since else None
+        self.pending_reading_id = data.get('pending_reading_id')
+        self.peak = data.get('peak')
+        self.count = data.get('count', 0)
+        self.event_id = data.get('event_id')
+
+    def reset(self):
+        self.pending_since = None
+        self.pending_reading_id = None
+        self.peak = None
+        self.count = 0
+
+    @property
+    def active(self):
+        return self.event_id is not None
+
+    def to_dict(self):
+        return {
+            'pending_since': self.pending_since.isoformat() if self.pending_since else None,
+            'pending_reading_id': self.pending_reading_id,
+            'peak': self.peak,
+            'count': self.count,
+            'event_id': self.event_id,
+        }
+
+
+class _DeviceState:
+    """Working copy of a locked excursion_state row."""
+    def __init__(self, row):
+        self.row = row
+        self.conditions = {kind: _Condition(row.conditions.get(kind)) for kind in TRACKED_KINDS}
+
+    def store(self):
+        self.row.conditions = {kind: cond.to_dict() for kind, cond in self.conditions.items()}
+        return self.row
+
+
+class ExcursionEngine:
+    """
+    Incremental cold-chain rule engine. Each stored reading is evaluated once
+    against its device's progress (O(1) per reading, no history queries):
+
+    - temp_high / temp_low: outside the limit for at least min_duration_seconds,
+      cleared once back inside by more than the hysteresis.
+    - rate_of_change: temperature moving faster than max_rate_per_minute.
+    - sensor_failure / gps_loss: that many consecutive -999 sentinel readings.
+
+    It runs inside the transaction that stores the readings (Reading.on_storing)
+    with the devices' excursion_state rows locked, so every process and worker
+    continues the same streaks and open events, and events commit or roll back
+    together with the readings. Only the thresholds are cached per process.
+    """
+    def __init__(self):
+        self._thresholds = TTLCache('thresholds', maxsize=10000, ttl=300)
+
+    def thresholds_for(self, device_id):
+        thresholds = self._thresholds.get(device_id)
+        if thresholds is MISSING:
+            thresholds = DeviceThresholds.get_for_device(device_id)
+            self._thresholds.set(device_id, thresholds)
+        return thresholds
+
+    def thresholds_for_devices(self, cur, device_ids):
+        """Like thresholds_for, loading the misses in one query with the caller's cursor."""
+        found, misses = {}, []
+        for device_id in device_ids:
+            thresholds = self._thresholds.get(device_id)
+            if thresholds is MISSING:
+                misses.append(device_id)
+            else:
+                found[device_id] = thresholds
+        if misses:
+            for device_id, thresholds in DeviceThresholds.load(cur, misses).items():
+                self._thresholds.set(device_id, thresholds)
+                found[device_id] = thresholds
+        return found
+
+    def invalidate_thresholds(self, device_id):
+        self._thresholds.invalidate(device_id)
+
+    def process(self, cur, readings):
+        device_ids = {reading.device_id for reading in readings}
+        rows = ExcursionState.lock(cur, device_ids)
+        states = {device_id: _DeviceState(row) for device_id, row in rows.items()}
+        self._adopt_open_events(cur, [states[d] for d, row in rows.items() if row.created])
+        limits = self.thresholds_for_devices(cur, device_ids)
+        for reading in readings:
+            self._evaluate(cur, states[reading.device_id], limits[reading.device_id], reading)
+        ExcursionState.save(cur, [state.store() for state in states.values()])
+
+    @staticmethod
+    def _adopt_open_events(cur, states):
+        """Devices seen for the first time keep events left open before excursion_state existed."""
+        if not states:
+            return
+        by_device = {state.row.device_id: state for state in states}
+        for event in ExcursionEvent.get_open(cur, by_device):
+            cond = by_device[event.device_id].conditions.get(event.kind)
+            if cond is not None and not cond.active:
+                cond.event_id = event.id
+                cond.peak = event.peak_value
+
+    def _evaluate(self, cur, state, limits, reading):
+        at = reading.sample_time
+        temp = reading.temperature if reading.has_valid_temperature else None
+
+        # 1. Temperature limits (with minimum duration and hysteresis)
+        if limits.temp_max is not None:
+            self._track(
+                cur, state.conditions[TEMP_HIGH], TEMP_HIGH, reading, at, temp, limits.temp_max,
+                breached=temp is not None and temp > limits.temp_max,
+                cleared=temp is not None and temp < limits.temp_max - limits.hysteresis,
+                min_duration=limits.min_duration_seconds, peak=max,
+            )
+        if limits.temp_min is not None:
+            self._track(
+                cur, state.conditions[TEMP_LOW], TEMP_LOW, reading, at, temp, limits.temp_min,
+                breached=temp is not None and temp < limits.temp_min,
+                cleared=temp is not None and temp > limits.temp_min + limits.hysteresis,
+                min_duration=limits.min_duration_seconds, peak=min,
+            )
+
+        # 2. Rate of change between consecutive valid temperatures
+        row = state.row
+        if temp is not None:
+            if limits.max_rate_per_minute is not None and row.last_temp is not None:
+                minutes = (at - row.last_temp_at).total_seconds() / 60
+                if minutes > 0:
+                    rate = (temp - row.last_temp) / minutes
+                    if abs(rate) > limits.max_rate_per_minute:
+                        event_id = ExcursionEvent.open(cur, reading.device_id, RATE_OF_CHANGE, at, reading.id,
+                                                       rate, limits.max_rate_per_minute)
+                        ExcursionEvent.close(cur, event_id, at, reading.id, rate)
+            row.last_temp, row.last_temp_at = temp, at
+
+        # 3. Sentinel streaks
+        self._track_streak(cur, state.conditions[SENSOR_FAILURE], SENSOR_FAILURE, reading, at,
+                           failed=temp is None, streak=limits.sensor_failure_streak)
+        self._track_streak(cur, state.conditions[GPS_LOSS], GPS_LOSS, reading, at,
+                           failed=not reading.has_gps_fix, streak=limits.gps_loss_streak)
+
+    @staticmethod
+    def _track(cur, cond, kind, reading, at, value, threshold, breached, cleared, min_duration, peak):
+        if cond.active:
+            if value is not None and breached:
+                cond.peak = value if cond.peak is None else peak(cond.peak, value)
+            if cleared:
+                ExcursionEvent.close(cur, cond.event_id, at, reading.id, cond.peak)
+                cond.event_id = None
+                cond.reset()
+            return
+
+        if breached:
+            if cond.pending_since is None:
+                cond.pending_since, cond.pending_reading_id = at, reading.id
+            cond.peak = value if cond.peak is None else peak(cond.peak, value)
+            if (at - cond.pending_since).total_seconds() >= min_duration:
+                cond.event_id = ExcursionEvent.open(cur, reading.device_id, kind, cond.pending_since,
+                                                    cond.pending_reading_id, cond.peak, threshold)
+        elif value is not None:
+            # Back inside the limit before the minimum duration: not an excursion
+            cond.reset()
+
+    @staticmethod
+    def _track_streak(cur, cond, kind, reading, at, failed, streak):
+        if not failed:
+            if cond.active:
+                ExcursionEvent.close(cur, cond.event_id, at, reading.id, cond.count)
+                cond.event_id = None
+            cond.reset()
+            return
+
+        if cond.pending_since is None:
+            cond.pending_since, cond.pending_reading_id = at, reading.id
+        cond.count += 1
+        if not cond.active and cond.count >= streak:
+            cond.event_id = ExcursionEvent.open(cur, reading.device_id, kind, cond.pending_since,
+                                                cond.pending_reading_id, cond.count, streak)
+
+
+excursion_engine = ExcursionEngine()
+Reading.on_storing(excursion_engine.process)
@@ -0,0 +1,82 @@
+# FILE: web/export.py
+
+import io
+import csv
+
+# Column names of the rows produced by Reading.iter_export
+EXPORT_COLUMNS = ('device_id', 'device_name', 'reading_id', 'received_at', 'gsm_time',
+                  'latitude', 'longitude', 'temperature')
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+
+def csv_chunks(chunks):
+    """Turns chunks of export rows into CSV text, one piece per chunk (header first)."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows(
+            (device_id, name, reading_id, received_at.isoformat(), gsm_time.isoformat() if gsm_time else '',
+             lat, lon, temp)
+            for device_id, name, reading_id, received_at, gsm_time, lat, lon, temp in rows
+        )
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file object that hands back whatever was written since the last take()."""
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def parquet_chunks(chunks):
+    """Turns chunks of export rows into a Parquet file streamed one row group per chunk."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('device_id', pa.int32()),
+        ('device_name', pa.string()),
+        ('reading_id', pa.int32()),
+        ('received_at', pa.timestamp('us', tz='UTC')),
+        ('gsm_time', pa.timestamp('us', tz='UTC')),
+        ('latitude', pa.float64()),
+        ('longitude', pa.float64()),
+        ('temperature', pa.float64()),
+    ])
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                schema=schema
+            ))
+            yield sink.take()
+    # Footer written on close
+    yield sink.take()
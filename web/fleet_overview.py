@@ -0,0 +1,149 @@
+# FILE: web/fleet_overview.py
+
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from models import Reading, ReadingRollup
+from excursions import excursion_engine
+from fleet_window import Window, out_of_range, WINDOW_SECONDS
+
+# A device that sent nothing for this long is shown as offline
+ONLINE_SECONDS = float(os.environ.get('FLEET_ONLINE_SECONDS', 600))
+
+
+def _add_reading(window, limits, reading, now):
+    temp = reading.temperature if reading.has_valid_temperature else None
+    window.add(reading.sample_time, 1, 1 if temp is not None else 0, temp or 0.0, temp, temp,
+               out_of_range(limits, temp, temp), now)
+    window.seen(reading.received_at)
+
+
+class FleetOverview:
+    """
+    Rolling 24h statistics per device (min/max/mean temperature, minutes out
+    of the configured range) kept in sliding windows that are updated on every
+    stored reading, so an overview of a whole fleet never aggregates readings.
+
+    Like the other stream processors, windows live in each worker process. A
+    worker seeds a device's window from the 1-minute rollups the first time
+    the device is viewed (or after it was silent for longer than the window).
+    When device_latest shows readings this worker didn't process (e.g. ones
+    stored by the ASGI ingest server), it folds in just the readings received
+    since its watermark. Both rollups and windows are bucketed by sample time.
+    """
+    def __init__(self):
+        self._windows = {}
+        # device_id -> ids of readings folded in while a catch-up query runs
+        self._catching_up = {}
+        self._lock = threading.Lock()
+
+    def process(self, readings):
+        now = datetime.now(timezone.utc)
+        # Thresholds may need a query: resolve them before taking the lock. A
+        # device not viewed yet needs none; the rollups will include its readings
+        # (or, for a window seeded meanwhile, the next catch-up will).
+        limits = {
+            device_id: excursion_engine.thresholds_for(device_id)
+            for device_id in {reading.device_id for reading in readings}
+            if device_id in self._windows
+        }
+        with self._lock:
+            for reading in readings:
+                window = self._windows.get(reading.device_id)
+                if window is None or reading.device_id not in limits:
+                    continue
+                _add_reading(window, limits[reading.device_id], reading, now)
+                folded = self._catching_up.get(reading.device_id)
+                if folded is not None and reading.id is not None:
+                    folded.add(reading.id)
+
+    def _seed(self, device_ids, now):
+        windows = {device_id: Window() for device_id in device_ids}
+        rollups, received = ReadingRollup.get_recent_for_devices(device_ids, 60, now - timedelta(seconds=WINDOW_SECONDS))
+        for device_id, window in windows.items():
+            limits = excursion_engine.thresholds_for(device_id)
+            for b in rollups.get(device_id, ()):
+                window.add(b.last_at, b.sample_count, b.temp_count, b.temp_sum or 0.0,
+                           b.temp_min, b.temp_max, out_of_range(limits, b.temp_min, b.temp_max), now)
+            window.seen(received.get(device_id))
+        return windows
+
+    def _catch_up(self, since_by_device, now):
+        """Folds in the readings received after each window's watermark (other processes' writes)."""
+        try:
+            readings, received = Reading.get_received_after(since_by_device)
+        except Exception:
+            with self._lock:
+                for device_id in since_by_device:
+                    del self._catching_up[device_id] # Retried on the next view
+            raise
+        limits = {device_id: excursion_engine.thresholds_for(device_id) for device_id in since_by_device}
+        with self._lock:
+            for device_id in since_by_device:
+                folded = self._catching_up.pop(device_id)
+                window = self._windows[device_id]
+                for reading in readings.get(device_id, ()):
+                    if reading.id not in folded:
+                        _add_reading(window, limits[device_id], reading, now)
+                # Dead-band suppressed samples aren't in readings but do move device_latest
+                window.seen(received.get(device_id))
+
+    def overview(self, devices, latest):
+        """
+        Overview of `devices` (Device objects) given their device_latest rows
+        ({device_id: LatestReading}). Returns (summary counts, per-device entries).
+        """
+        now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(seconds=WINDOW_SECONDS)
+        seed, behind = [], {}
+        with self._lock:
+            for d in devices:
+                window = self._windows.get(d.id)
+                if window is None:
+                    seed.append(d.id)
+                elif d.id in self._catching_up or d.id not in latest:
+                    continue
+                elif window.last_seen is None or window.last_seen < cutoff:
+                    if window.last_seen is None or window.last_seen < latest[d.id].received_at:
+                        seed.append(d.id) # Back after a long silence: cheaper to start over
+                elif window.last_seen < latest[d.id].received_at:
+                    behind[d.id] = window.last_seen
+                    self._catching_up[d.id] = set()
+        # Loaded outside the lock so ingest isn't held up
+        if behind:
+            self._catch_up(behind, now)
+        if seed:
+            seeded = self._seed(seed, now)
+            with self._lock:
+                for device_id, window in seeded.items():
+                    # A reading folded into the replaced window after the rollups
+                    # were read is newer than the seeded watermark: the next catch-up has it
+                    if device_id not in self._catching_up:
+                        self._windows[device_id] = window
+
+        entries = []
+        counts = {'online': 0, 'offline': 0, 'never_seen': 0, 'out_of_range': 0}
+        with self._lock:
+            for device in devices:
+                window = self._windows[device.id]
+                reading = latest.get(device.id)
+                last_seen = reading.received_at if reading else window.last_seen
+                entry = {'device_id': device.id, 'device_name': device.device_name}
+                entry.update(window.summary(now))
+                if last_seen is None:
+                    entry.update(last_seen=None, last_seen_seconds=None, status='never_seen')
+                else:
+                    age = max((now - last_seen).total_seconds(), 0)
+                    entry.update(last_seen=last_seen.strftime('%Y-%m-%d %H:%M:%S'), last_seen_seconds=int(age),
+                                 status='online' if age <= ONLINE_SECONDS else 'offline')
+                entry['current_temp'] = round(reading.temperature, 1) if reading and reading.has_valid_temperature else None
+                counts[entry['status']] += 1
+                if entry['minutes_out_of_range']:
+                    counts['out_of_range'] += 1
+                entries.append(entry)
+        return counts, entries
+
+
+fleet_overview = FleetOverview()
+Reading.on_stored(fleet_overview.process)
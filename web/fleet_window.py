@@ -0,0 +1,133 @@
+# FILE: web/fleet_window.py
+
+import os
+from collections import deque
+
+WINDOW_SECONDS = 24 * 3600
+# Window granularity: the oldest bucket leaves the window as a whole, so the
+# 24h statistics cover between 24h and 24h + BUCKET_SECONDS. A multiple of the
+# 1-minute rollups the windows are seeded from.
+BUCKET_SECONDS = 300
+# Out-of-range time is attributed from one sample to the next, capped at this
+MAX_SAMPLE_GAP_SECONDS = float(os.environ.get('FLEET_MAX_SAMPLE_GAP_SECONDS', 1800))
+
+
+class _Bucket:
+    __slots__ = ('start', 'samples', 'temp_count', 'temp_sum', 'temp_min', 'temp_max', 'out_of_range_seconds')
+
+    def __init__(self, start):
+        self.start = start
+        self.samples = 0
+        self.temp_count = 0
+        self.temp_sum = 0.0
+        self.temp_min = None
+        self.temp_max = None
+        self.out_of_range_seconds = 0.0
+
+
+def out_of_range(limits, low, high):
+    """Whether temperatures spanning [low, high] left the device's configured range."""
+    if low is None:
+        return False
+    return ((limits.temp_min is not None and low < limits.temp_min)
+            or (limits.temp_max is not None and high > limits.temp_max))
+
+
+class Window:
+    """
+    One device's last 24h as BUCKET_SECONDS buckets plus running totals.
+    Adding a sample and evicting a bucket are O(1); min/max are only
+    recomputed (over at most 24h / BUCKET_SECONDS buckets) when the bucket
+    holding the current extreme leaves the window.
+    """
+    def __init__(self):
+        self.buckets = deque()
+        self.samples = 0
+        self.temp_count = 0
+        self.temp_sum = 0.0
+        self.temp_min = None
+        self.temp_max = None
+        self.extremes_stale = False
+        self.out_of_range_seconds = 0.0
+        # Newest sample so far (device time), to attribute the time until the next one
+        self.last_at = None
+        self.last_out_of_range = False
+        # Newest server receive time folded in, compared against device_latest
+        self.last_seen = None
+
+    def seen(self, received_at):
+        """Moves the receive-time watermark forward (never back)."""
+        if received_at is not None and (self.last_seen is None or received_at > self.last_seen):
+            self.last_seen = received_at
+
+    def _bucket_for(self, epoch):
+        start = int(epoch) - int(epoch) % BUCKET_SECONDS
+        if not self.buckets or self.buckets[-1].start < start:
+            self.buckets.append(_Bucket(start))
+            return self.buckets[-1]
+        # Late sample: find (or insert) its bucket from the newest end
+        for index in range(len(self.buckets) - 1, -1, -1):
+            bucket = self.buckets[index]
+            if bucket.start == start:
+                return bucket
+            if bucket.start < start:
+                self.buckets.insert(index + 1, _Bucket(start))
+                return self.buckets[index + 1]
+        self.buckets.appendleft(_Bucket(start))
+        return self.buckets[0]
+
+    def add(self, at, samples, temp_count, temp_sum, low, high, out_of_range, now):
+        """Folds one sample (or a pre-aggregated rollup bucket) taken at `at` into the window."""
+        if at.timestamp() < now.timestamp() - WINDOW_SECONDS:
+            return # Buffered upload from before the window
+        bucket = self._bucket_for(at.timestamp())
+
+        if self.last_at is None or at >= self.last_at:
+            if self.last_at is not None and self.last_out_of_range:
+                seconds = min((at - self.last_at).total_seconds(), MAX_SAMPLE_GAP_SECONDS)
+                bucket.out_of_range_seconds += seconds
+                self.out_of_range_seconds += seconds
+            self.last_at, self.last_out_of_range = at, out_of_range
+
+        bucket.samples += samples
+        self.samples += samples
+        if temp_count:
+            bucket.temp_count += temp_count
+            bucket.temp_sum += temp_sum
+            bucket.temp_min = low if bucket.temp_min is None else min(bucket.temp_min, low)
+            bucket.temp_max = high if bucket.temp_max is None else max(bucket.temp_max, high)
+            self.temp_count += temp_count
+            self.temp_sum += temp_sum
+            if not self.extremes_stale:
+                self.temp_min = low if self.temp_min is None else min(self.temp_min, low)
+                self.temp_max = high if self.temp_max is None else max(self.temp_max, high)
+
+    def _evict(self, now):
+        cutoff = now.timestamp() - WINDOW_SECONDS
+        while self.buckets and self.buckets[0].start + BUCKET_SECONDS <= cutoff:
+            bucket = self.buckets.popleft()
+            self.samples -= bucket.samples
+            self.temp_count -= bucket.temp_count
+            self.temp_sum -= bucket.temp_sum
+            self.out_of_range_seconds -= bucket.out_of_range_seconds
+            if bucket.temp_count and (bucket.temp_min == self.temp_min or bucket.temp_max == self.temp_max):
+                self.extremes_stale = True
+
+    def summary(self, now):
+        self._evict(now)
+        if self.extremes_stale:
+            with_temps = [b for b in self.buckets if b.temp_count]
+            self.temp_min = min((b.temp_min for b in with_temps), default=None)
+            self.temp_max = max((b.temp_max for b in with_temps), default=None)
+            self.extremes_stale = False
+        out_of_range = max(self.out_of_range_seconds, 0.0)
+        # Still out of range since the last sample (capped like the gaps between samples)
+        if self.last_out_of_range and self.last_at is not None:
+            out_of_range += min(max((now - self.last_at).total_seconds(), 0.0), MAX_SAMPLE_GAP_SECONDS)
+        return {
+            'samples': self.samples,
+            'temp_min': round(self.temp_min, 1) if self.temp_count else None,
+            'temp_max': round(self.temp_max, 1) if self.temp_count else None,
+            'temp_avg': round(self.temp_sum / self.temp_count, 1) if self.temp_count else None,
+            'minutes_out_of_range': round(out_of_range / 60, 1),
+        }
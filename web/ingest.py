@@ -0,0 +1,137 @@
+# FILE: web/ingest.py
+
+import json
+import math
+import base64
+import struct
+from datetime import datetime, timezone
+
+# Largest number of readings accepted by a single /api/data/batch request.
+MAX_BATCH_SIZE = 1000
+
+class PayloadError(ValueError):
+    """Raised when a reading payload is missing fields or has invalid values."""
+
+
+# Firmware sends -999 for a position or temperature it could not read
+_SENTINEL = -999.0
+
+
+def check_values(lat, lon, temp):
+    """Rejects NaN/Infinity and positions off the globe (the -999 sentinel is allowed)."""
+    if not all(math.isfinite(v) for v in (lat, lon, temp)):
+        raise PayloadError("lat, lon and temp must be finite numbers")
+    if not (-90 <= lat <= 90 or lat == _SENTINEL) or not (-180 <= lon <= 180 or lon == _SENTINEL):
+        raise PayloadError("lat must be within [-90, 90] and lon within [-180, 180]")
+
+
+def parse_timestamp(value, field='gsm_time'):
+    """Parses an optional timestamp (ISO 8601 string or UNIX epoch seconds); naive values are UTC."""
+    if value is None or value == '':
+        return None
+    if isinstance(value, bool):
+        raise PayloadError(f"Invalid {field}")
+    try:
+        if isinstance(value, (int, float)) or str(value).replace('.', '', 1).isdigit():
+            return datetime.fromtimestamp(float(value), tz=timezone.utc)
+        parsed = datetime.fromisoformat(str(value))
+    except (ValueError, OverflowError, OSError):
+        raise PayloadError(f"Invalid {field} (expected ISO 8601 or epoch seconds)")
+    # Devices without a timezone report UTC (GSM network time)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def parse_reading(data, default_imei=None):
+    """
+    Validates one reading object as posted by the firmware.
+    Returns a tuple (imei, lat, lon, temp, gsm_time) or raises PayloadError.
+    """
+    if not isinstance(data, dict):
+        raise PayloadError("Reading must be a JSON object")
+    try:
+        imei = data.get('imei', default_imei)
+        if not imei:
+            raise KeyError('imei')
+        lat = float(data['lat'])
+        lon = float(data['lon'])
+        temp = float(data['temp'])
+    except (KeyError, ValueError, TypeError):
+        raise PayloadError("Invalid or missing data fields (imei, lat, lon, temp)")
+    check_values(lat, lon, temp)
+
+    gsm_time = parse_timestamp(data.get('gsm_time'))
+    return str(imei), lat, lon, temp, gsm_time
+
+
+# --- Compact binary frames (alternative to the firmware JSON) ---
+# POSTed to /api/data with Content-Type FRAME_CONTENT_TYPE. Little-endian:
+#   header  uint8 version (=1) | 8-byte device token | uint8 sample count (1-255)
+#   sample  int32 lat, int32 lon (1e-6 degrees) | int16 temp (0.01 C)
+#           | uint32 gsm_time (epoch seconds, 0 = unknown)
+# A one-sample frame is 24 bytes against ~80 for the JSON payload. The -999
+# position sentinel is sent as-is (-999000000); the temperature sentinel,
+# which does not fit an int16, is FRAME_TEMP_SENTINEL.
+FRAME_CONTENT_TYPE = 'application/vnd.coolmove.frame'
+FRAME_VERSION = 1
+DEVICE_TOKEN_BYTES = 8
+FRAME_TEMP_SENTINEL = -32768
+_FRAME_HEADER = struct.Struct('<B%dsB' % DEVICE_TOKEN_BYTES)
+_FRAME_SAMPLE = struct.Struct('<iihI')
+# Largest valid frame (255 samples); bodies are not read past this
+MAX_FRAME_BYTES = _FRAME_HEADER.size + 255 * _FRAME_SAMPLE.size
+
+
+def parse_frame(body):
+    """
+    Decodes a binary frame straight into reading tuples.
+    Returns (token, [(lat, lon, temp, gsm_time), ...]) or raises PayloadError.
+    """
+    if len(body) < _FRAME_HEADER.size:
+        raise PayloadError("Frame too short")
+    version, token, count = _FRAME_HEADER.unpack_from(body)
+    if version != FRAME_VERSION:
+        raise PayloadError(f"Unsupported frame version {version}")
+    if count == 0 or len(body) != _FRAME_HEADER.size + count * _FRAME_SAMPLE.size:
+        raise PayloadError("Frame length does not match its sample count")
+
+    samples = [
+        (lat / 1e6, lon / 1e6,
+         _SENTINEL if temp == FRAME_TEMP_SENTINEL else temp / 100,
+         datetime.fromtimestamp(gsm_time, tz=timezone.utc) if gsm_time else None)
+        for lat, lon, temp, gsm_time in _FRAME_SAMPLE.iter_unpack(memoryview(body)[_FRAME_HEADER.size:])
+    ]
+    for lat, lon, temp, _ in samples:
+        check_values(lat, lon, temp)
+    return token, samples
+
+
+def encode_frame(token, samples):
+    """
+    Builds a binary frame from (lat, lon, temp, gsm_time) samples, the inverse
+    of parse_frame (the firmware's side of the format, for tests and tools).
+    """
+    if not 1 <= len(samples) <= 255:
+        raise ValueError("A frame holds 1 to 255 samples")
+    parts = [_FRAME_HEADER.pack(FRAME_VERSION, token, len(samples))]
+    for lat, lon, temp, gsm_time in samples:
+        parts.append(_FRAME_SAMPLE.pack(
+            round(lat * 1e6), round(lon * 1e6),
+            FRAME_TEMP_SENTINEL if temp <= _SENTINEL else round(temp * 100),
+            int(gsm_time.timestamp()) if gsm_time else 0,
+        ))
+    return b''.join(parts)
+
+
+def encode_cursor(received_at, reading_id):
+    """Opaque pagination cursor for the (received_at, id) keyset."""
+    raw = json.dumps([received_at.isoformat(), reading_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        received_at, reading_id = json.loads(raw)
+        return datetime.fromisoformat(received_at), int(reading_id)
+    except (ValueError, TypeError):
+        raise PayloadError("Invalid cursor")
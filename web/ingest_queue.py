@@ -0,0 +1,166 @@
+# FILE: web/ingest_queue.py
+
+import os
+import time
+import queue
+import atexit
+import threading
+import psycopg
+
+from models import Reading
+
+# "sync" (default): /api/data writes before answering.
+# "async": /api/data queues the reading, answers 202 and a writer thread stores it.
+INGEST_MODE = os.environ.get('INGEST_MODE', 'sync').lower()
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 10000))
+INGEST_FLUSH_SIZE = int(os.environ.get('INGEST_FLUSH_SIZE', 500))        # readings per write
+INGEST_FLUSH_INTERVAL = float(os.environ.get('INGEST_FLUSH_INTERVAL', 1.0))  # max seconds a reading waits
+INGEST_DRAIN_TIMEOUT = float(os.environ.get('INGEST_DRAIN_TIMEOUT', 25))  # shutdown grace period
+# Longest pause between retries of a batch the database couldn't take
+INGEST_MAX_BACKOFF = float(os.environ.get('INGEST_MAX_BACKOFF', 30))
+# Suggested client back-off when the queue is full (Retry-After header)
+INGEST_RETRY_AFTER = 5
+
+
+def _rejects_data(error):
+    """Whether the database refused the readings themselves rather than failing to take them."""
+    if not isinstance(error, (psycopg.DataError, psycopg.IntegrityError)):
+        return False
+    # No partition for the month is a check violation too, but it's fixed by
+    # creating the partition (partitions.py), not by dropping readings
+    return not (error.diag.message_primary or '').startswith('no partition of relation')
+
+
+class IngestQueue:
+    """
+    Bounded in-process write-behind queue for validated readings.
+
+    A single writer thread flushes in batches through Reading.insert_readings
+    whenever INGEST_FLUSH_SIZE readings are waiting or INGEST_FLUSH_INTERVAL
+    has passed. Queued readings were already acknowledged, so a batch that
+    fails for any reason other than its data (database unreachable, missing
+    partition, ...) is retried until it goes in; meanwhile the queue fills up
+    and submitters get False (429 with Retry-After). A batch rejected for its
+    data is split in halves until the offending readings are isolated and
+    dropped, so one bad reading can't block the writer. On shutdown the queue
+    is drained before the process exits.
+    """
+    def __init__(self, maxsize=INGEST_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._submit_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.rejected_full = 0
+
+    def submit(self, reading):
+        """Queues an (imei, lat, lon, temp, gsm_time) tuple. Returns False when full (backpressure)."""
+        if self._stopping.is_set():
+            return False
+        self._ensure_writer()
+        try:
+            with self._submit_lock:
+                self._queue.put_nowait(reading)
+            return True
+        except queue.Full:
+            self.rejected_full += 1
+            return False
+
+    def submit_many(self, readings):
+        """Queues all readings or none of them (e.g. one multi-sample frame). Returns False when full."""
+        if self._stopping.is_set():
+            return False
+        self._ensure_writer()
+        # Submitters hold the lock and the writer only frees space, so the check holds
+        with self._submit_lock:
+            if self._queue.maxsize and self._queue.qsize() + len(readings) > self._queue.maxsize:
+                self.rejected_full += len(readings)
+                return False
+            for reading in readings:
+                self._queue.put_nowait(reading)
+        return True
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            'queued': self.qsize(),
+            'capacity': self._queue.maxsize,
+            'written': self.written,
+            'dropped': self.dropped,
+            'rejected_full': self.rejected_full,
+        }
+
+    def _ensure_writer(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        """Blocks for the first reading, then collects more until the batch is full or the interval ends."""
+        try:
+            batch = [self._queue.get(timeout=INGEST_FLUSH_INTERVAL)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + INGEST_FLUSH_INTERVAL
+        while len(batch) < INGEST_FLUSH_SIZE:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        backoff = 0.5
+        while True:
+            try:
+                results = Reading.insert_readings(batch, raise_errors=True)
+            except Exception as e:
+                if not _rejects_data(e):
+                    # The transaction was rolled back and nothing is wrong with the readings: retry
+                    print(f"Ingest writer: {e}. Retrying {len(batch)} readings in {backoff}s")
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, INGEST_MAX_BACKOFF)
+                    continue
+                # Rejected for its data (constraint, out-of-range value, ...): bisect
+                if len(batch) == 1:
+                    print(f"Ingest writer: dropping reading {batch[0]!r}: {e}")
+                    self.dropped += 1
+                    return
+                middle = len(batch) // 2
+                self._write(batch[:middle])
+                self._write(batch[middle:])
+                return
+
+            for ok, message in results:
+                if ok:
+                    self.written += 1
+                else:
+                    # e.g. "Device not found": retrying won't help
+                    self.dropped += 1
+            return
+
+    def stop(self, timeout=INGEST_DRAIN_TIMEOUT):
+        """Stops accepting work and waits for the writer to drain the queue."""
+        self._stopping.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+        if not self._queue.empty():
+            print(f"Ingest writer: {self._queue.qsize()} readings not written before shutdown")
+
+
+ingest_queue = IngestQueue()
+atexit.register(ingest_queue.stop)
@@ -0,0 +1,109 @@
+# FILE: web/live.py
+
+import os
+import json
+import time
+import queue
+import threading
+import psycopg
+
+# Channel used by Reading.insert_reading / insert_readings (pg_notify) for new readings.
+NOTIFY_CHANNEL = 'coolmove_readings'
+
+# Seconds between SSE heartbeat comments (keeps proxies from closing idle streams)
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+# Events buffered per browser session before it's considered too slow and dropped
+SSE_QUEUE_SIZE = 256
+# Each open stream holds one gunicorn thread for as long as the tab is open, so
+# keep well below the Procfile's --threads to leave room for ingest and pages.
+# Streams past the cap are refused (503) and the dashboard falls back to polling.
+SSE_MAX_STREAMS = int(os.environ.get('SSE_MAX_STREAMS', 8))
+
+
+class Subscription:
+    """One browser stream: a queue of reading events filtered to the user's devices."""
+    def __init__(self, device_ids):
+        self.device_ids = device_ids
+        self.queue = queue.Queue(maxsize=SSE_QUEUE_SIZE)
+        self.overflowed = False
+
+    def push(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # The client will reconnect and resume from its Last-Event-ID
+            self.overflowed = True
+
+
+class ReadingBroadcaster:
+    """
+    Fans out reading notifications to all subscribed streams of this worker.
+    A single background thread holds one dedicated LISTEN connection (outside
+    the pool) and is started on the first subscription.
+    """
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, device_ids):
+        """Returns a new Subscription, or None when this worker already serves SSE_MAX_STREAMS streams."""
+        sub = Subscription(device_ids)
+        with self._lock:
+            if len(self._subscriptions) >= SSE_MAX_STREAMS:
+                return None
+            self._subscriptions.add(sub)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen_forever, name='reading-listener', daemon=True)
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscriptions.discard(sub)
+
+    def publish(self, event):
+        device_id = event.get('device_id')
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for sub in subscriptions:
+            if device_id in sub.device_ids:
+                sub.push(event)
+
+    def _listen_forever(self):
+        backoff = 1
+        while True:
+            db_url = os.environ.get('DATABASE_URL')
+            try:
+                with psycopg.connect(conninfo=db_url, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {NOTIFY_CHANNEL}")
+                    backoff = 1
+                    while True:
+                        for notify in conn.notifies(timeout=SSE_HEARTBEAT_SECONDS):
+                            try:
+                                self.publish(json.loads(notify.payload))
+                            except ValueError:
+                                print(f"Ignoring malformed notification: {notify.payload!r}")
+                        with self._lock:
+                            if not self._subscriptions:
+                                # Nobody is listening any more; stop until the next subscribe()
+                                self._thread = None
+                                return
+            except Exception as e:
+                print(f"LISTEN connection error: {e}. Reconnecting in {backoff}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+
+
+broadcaster = ReadingBroadcaster()
+
+
+def sse_event(data, event=None, event_id=None):
+    """Formats one Server-Sent Events message."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
@@ -0,0 +1,316 @@
+# FILE: web/metrics.py
+
+import os
+import time
+import threading
+import functools
+import psycopg
+
+# Requests slower than this are printed with their trace (0 disables the log)
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))
+# Optional bearer token for /metrics (Prometheus can't log in through the form)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+# Model calls kept per request for the slow-request log
+MAX_TRACE_STEPS = 50
+
+_registry = []
+_collectors = []
+
+
+# ----------------------------------------------------------------------
+# 1. METRIC TYPES (Prometheus text exposition format)
+# ----------------------------------------------------------------------
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self, items):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def register_collector(collect):
+    """
+    Adds values computed at scrape time (pool, cache and queue stats).
+    `collect()` returns (name, help, {label tuple or (): value}) gauges.
+    """
+    _collectors.append(collect)
+
+
+def render_metrics():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        try:
+            gauges = collect()
+        except Exception as e:
+            print(f"Metrics collector failed: {e}")
+            continue
+        for name, help, samples in gauges:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples.items():
+                lines.append(f"{name}{_format_labels([k for k, _ in labels], [v for _, v in labels])} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+# --- Metrics recorded by the app ---
+http_request_duration = Histogram(
+    'coolmove_http_request_duration_seconds', 'Request latency by endpoint', ('endpoint', 'method', 'status'))
+http_request_db_queries = Histogram(
+    'coolmove_http_request_db_queries', 'Database round-trips per request', ('endpoint',), buckets=COUNT_BUCKETS)
+db_query_duration = Histogram(
+    'coolmove_db_query_duration_seconds', 'Time spent in execute/executemany', ('endpoint',))
+db_connection_wait = Histogram(
+    'coolmove_db_connection_wait_seconds', 'Time waiting for a pooled connection', ('endpoint',))
+db_connection_held = Histogram(
+    'coolmove_db_connection_held_seconds', 'Time a pooled connection was checked out', ('endpoint',))
+model_call_duration = Histogram(
+    'coolmove_model_call_duration_seconds', 'Latency of models.py methods', ('method',))
+ingest_readings = Counter(
+    'coolmove_ingest_readings_total', 'Readings stored (or dead-band suppressed) per device', ('device_id',))
+ingest_rejected = Counter(
+    'coolmove_ingest_rejected_total', 'Payloads rejected by the ingest endpoints', ('endpoint', 'reason'))
+
+
+# ----------------------------------------------------------------------
+# 2. PER-REQUEST TRACE
+# ----------------------------------------------------------------------
+
+_local = threading.local()
+# id(conn) -> (checked out at, endpoint); pooled connections outlive requests
+_checked_out = {}
+_checked_out_lock = threading.Lock()
+
+BACKGROUND = 'background'
+
+
+class RequestTrace:
+    """What one request spent its time on; lives in a thread-local for the request's duration."""
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.status = 500
+        self.queries = 0
+        self.query_time = 0.0
+        self.connection_wait = 0.0
+        self.connection_held = 0.0
+        self.steps = []
+
+    def summary(self):
+        elapsed_ms = (time.perf_counter() - self.started) * 1000
+        steps = ', '.join(f"{name}={seconds * 1000:.1f}ms" for name, seconds in self.steps)
+        return (f"{self.endpoint} {self.status} {elapsed_ms:.1f}ms queries={self.queries} "
+                f"db={self.query_time * 1000:.1f}ms conn_wait={self.connection_wait * 1000:.1f}ms "
+                f"conn_held={self.connection_held * 1000:.1f}ms [{steps}]")
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def _current_endpoint():
+    trace = current_trace()
+    return trace.endpoint if trace else BACKGROUND
+
+
+class InstrumentedCursor(psycopg.Cursor):
+    """Cursor that counts and times every round-trip (used as the pool's cursor_factory)."""
+    def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            record_query(time.perf_counter() - start)
+
+    def executemany(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().executemany(*args, **kwargs)
+        finally:
+            record_query(time.perf_counter() - start)
+
+
+def record_query(seconds):
+    trace = current_trace()
+    if trace is not None:
+        trace.queries += 1
+        trace.query_time += seconds
+    db_query_duration.observe(seconds, endpoint=_current_endpoint())
+
+
+def connection_acquired(conn, wait_seconds):
+    endpoint = _current_endpoint()
+    trace = current_trace()
+    if trace is not None:
+        trace.connection_wait += wait_seconds
+    db_connection_wait.observe(wait_seconds, endpoint=endpoint)
+    with _checked_out_lock:
+        _checked_out[id(conn)] = (time.perf_counter(), endpoint)
+
+
+def connection_released(conn):
+    with _checked_out_lock:
+        entry = _checked_out.pop(id(conn), None)
+    if entry is None:
+        return
+    held = time.perf_counter() - entry[0]
+    trace = current_trace()
+    if trace is not None:
+        trace.connection_held += held
+    db_connection_held.observe(held, endpoint=entry[1])
+
+
+def record_ingest(readings):
+    """Reading.on_stored listener: per-device ingest counts."""
+    for reading in readings:
+        ingest_readings.inc(device_id=reading.device_id)
+
+
+def record_rejected(endpoint, reason, amount=1):
+    ingest_rejected.inc(amount, endpoint=endpoint, reason=reason)
+
+
+# ----------------------------------------------------------------------
+# 3. INSTRUMENTATION HOOKS
+# ----------------------------------------------------------------------
+
+def _timed(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            model_call_duration.observe(elapsed, method=name)
+            trace = current_trace()
+            if trace is not None and len(trace.steps) < MAX_TRACE_STEPS:
+                trace.steps.append((name, elapsed))
+    return wrapper
+
+
+def instrument_methods(cls):
+    """Wraps the methods defined on `cls` (plain, class and static; not properties) with timing."""
+    for attr, value in list(vars(cls).items()):
+        if attr.startswith('__'):
+            continue
+        name = f"{cls.__name__}.{attr}"
+        if isinstance(value, classmethod):
+            setattr(cls, attr, classmethod(_timed(name, value.__func__)))
+        elif isinstance(value, staticmethod):
+            setattr(cls, attr, staticmethod(_timed(name, value.__func__)))
+        elif callable(value) and not isinstance(value, type):
+            setattr(cls, attr, _timed(name, value))
+    return cls
+
+
+def instrument_app(app):
+    """
+    Times every Flask request and logs slow ones. Metrics are per process:
+    every gunicorn worker and the uvicorn ingest server (asgi.py, which has its
+    own /metrics) count separately, so scrape each process and let Prometheus
+    sum them.
+    """
+    from flask import request
+
+    @app.before_request
+    def _start_trace():
+        _local.trace = RequestTrace(request.endpoint or 'unmatched')
+
+    @app.after_request
+    def _record_status(response):
+        trace = current_trace()
+        if trace is not None:
+            trace.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def _finish_trace(exc):
+        trace = current_trace()
+        if trace is None:
+            return
+        _local.trace = None
+        elapsed = time.perf_counter() - trace.started
+        http_request_duration.observe(elapsed, endpoint=trace.endpoint, method=request.method, status=trace.status)
+        http_request_db_queries.observe(trace.queries, endpoint=trace.endpoint)
+        if SLOW_REQUEST_MS and elapsed * 1000 >= SLOW_REQUEST_MS:
+            print(f"Slow request: {request.method} {trace.summary()}")
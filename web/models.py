@@ -1,23 +1,282 @@
 # FILE: web/models.py
 
 import os
+import json
+import math
+import hashlib
+import time
+import secrets
+import atexit
+from datetime import datetime, timezone
+import threading
+import itertools
 import psycopg
+from psycopg import sql
+from psycopg_pool import ConnectionPool
+from cache import TTLCache, MISSING
+from live import NOTIFY_CHANNEL
+from ingest import DEVICE_TOKEN_BYTES
+from cell_grid import cell_for, cell_ranges
+from metrics import InstrumentedCursor, connection_acquired, connection_released, instrument_methods
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
-# --- Database Connection Function ---
-def get_db_connection():
+# --- Database Connection Pool ---
+# One pool per process (i.e. per gunicorn worker). It is created lazily on the
+# first request so DATABASE_URL can still be set after import (see app.py).
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))          # seconds to wait for a free connection
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', 300))       # close idle connections above min_size
+DB_POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', 1800))  # recycle connections periodically
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """Returns the process-wide connection pool, creating it on first use."""
+    global _pool
+    if _pool is not None:
+        return _pool
+
     db_url = os.environ.get('DATABASE_URL')
     if not db_url:
         # Fallback for local testing without .env loaded
-        return None 
-        
-    try:
-        conn = psycopg.connect(conninfo=db_url)
+        return None
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(
+                conninfo=db_url,
+                min_size=DB_POOL_MIN_SIZE,
+                max_size=DB_POOL_MAX_SIZE,
+                timeout=DB_POOL_TIMEOUT,
+                max_idle=DB_POOL_MAX_IDLE,
+                max_lifetime=DB_POOL_MAX_LIFETIME,
+                # Health check: a connection dropped by the server (e.g. after a
+                # Postgres restart) is discarded instead of being handed out.
+                check=ConnectionPool.check_connection,
+                # Counts and times every query for /metrics
+                kwargs={'cursor_factory': InstrumentedCursor},
+                # Remembers commits for read-your-writes (see below)
+                connection_class=PrimaryConnection,
+                name='coolmove',
+                open=True,
+            )
+    return _pool
+
+def close_db_pool():
+    global _pool, _replica_pools
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+    for pool in _replica_pools or ():
+        pool.close()
+    _replica_pools = None
+
+atexit.register(close_db_pool)
+
+# --- Read Replicas (Optional) ---
+# Comma-separated DSNs of streaming replicas. Read-only model methods
+# (get_db_connection(readonly=True)) borrow from them round-robin; a replica
+# that can't hand out a connection is skipped for DB_REPLICA_RETRY_SECONDS and
+# the primary is used when none is available.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+DB_REPLICA_TIMEOUT = float(os.environ.get('DB_REPLICA_TIMEOUT', 2))       # fail over quickly to the next one
+DB_REPLICA_RETRY_SECONDS = float(os.environ.get('DB_REPLICA_RETRY_SECONDS', 30))
+# Read-your-writes: after a commit, reads on the same thread (i.e. the rest of
+# the request, or the ingest writer) stay on the primary for this long. app.py
+# carries it over to the user's next requests through the session.
+DB_READ_YOUR_WRITES_SECONDS = float(os.environ.get('DB_READ_YOUR_WRITES_SECONDS', 5))
+
+_replica_pools = None
+_replica_down_until = {}
+_replica_turn = itertools.count()
+_borrowed_from = {}  # id(conn) -> replica pool, for release_db_connection
+_borrowed_lock = threading.Lock()
+_routing = threading.local()
+
+
+class PrimaryConnection(psycopg.Connection):
+    """Primary connection that records the time of each commit on the committing thread."""
+    def commit(self):
+        super().commit()
+        _routing.wrote_at = time.time()
+
+
+def begin_request(primary_until=None):
+    """Resets read routing for a new request; reads use the primary until `primary_until` (epoch seconds)."""
+    _routing.wrote_at = None
+    _routing.primary_until = primary_until or 0
+
+
+def last_write_at():
+    """Epoch time of this thread's last commit since begin_request(), or None."""
+    return getattr(_routing, 'wrote_at', None)
+
+
+def _reads_need_primary():
+    now = time.time()
+    wrote_at = last_write_at()
+    return ((wrote_at is not None and now - wrote_at < DB_READ_YOUR_WRITES_SECONDS)
+            or now < getattr(_routing, 'primary_until', 0))
+
+
+def get_replica_pools():
+    """One pool per configured replica, created on first use ([] without replicas)."""
+    global _replica_pools
+    if _replica_pools is not None:
+        return _replica_pools
+    with _pool_lock:
+        if _replica_pools is None:
+            _replica_pools = [
+                ConnectionPool(
+                    conninfo=url,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_REPLICA_TIMEOUT,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    max_lifetime=DB_POOL_MAX_LIFETIME,
+                    check=ConnectionPool.check_connection,
+                    # A write routed here by mistake fails loudly, even against a non-replica
+                    kwargs={'cursor_factory': InstrumentedCursor, 'options': '-c default_transaction_read_only=on'},
+                    name=f'coolmove-replica-{index}',
+                    open=True,
+                )
+                for index, url in enumerate(DATABASE_REPLICA_URLS)
+            ]
+    return _replica_pools
+
+
+def _borrow_from_replica():
+    pools = get_replica_pools()
+    for _ in range(len(pools)):
+        index = next(_replica_turn) % len(pools)
+        if _replica_down_until.get(index, 0) > time.monotonic():
+            continue
+        start = time.perf_counter()
+        try:
+            conn = pools[index].getconn()
+        except Exception as e:
+            print(f"Replica {index} unavailable, reading from the primary: {e}")
+            _replica_down_until[index] = time.monotonic() + DB_REPLICA_RETRY_SECONDS
+            continue
+        connection_acquired(conn, time.perf_counter() - start)
+        with _borrowed_lock:
+            _borrowed_from[id(conn)] = pools[index]
         return conn
+    return None
+
+# --- In-Process Caches ---
+# IMEI -> device id, consulted on every ingest request. Unknown IMEIs are cached
+# too (for a shorter time) so a misconfigured tracker can't hammer the database.
+imei_cache = TTLCache(
+    'imei',
+    maxsize=int(os.environ.get('IMEI_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('IMEI_CACHE_TTL', 600)),
+    negative_ttl=float(os.environ.get('IMEI_CACHE_NEGATIVE_TTL', 30)),
+)
+
+# Binary-frame device token -> IMEI (same negative caching as the IMEI cache)
+token_cache = TTLCache(
+    'device_token',
+    maxsize=int(os.environ.get('IMEI_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('IMEI_CACHE_TTL', 600)),
+    negative_ttl=float(os.environ.get('IMEI_CACHE_NEGATIVE_TTL', 30)),
+)
+
+# Device id -> received_at of its device_latest row (None = no readings yet).
+# Conditional GETs on the latest/history APIs compare ETags against this
+# without querying. Entries are dropped whenever this process stores a reading;
+# the short TTL bounds how long readings stored by other workers go unnoticed.
+latest_version_cache = TTLCache(
+    'latest_version',
+    maxsize=int(os.environ.get('IMEI_CACHE_SIZE', 10000)),
+    ttl=float(os.environ.get('LATEST_VERSION_TTL', 5)),
+)
+
+# User records (login_manager.user_loader runs on every authenticated request)
+# and each user's set of authorized device ids (from device_shares). Kept
+# short-lived because other workers can't invalidate this process's copy.
+user_cache = TTLCache(
+    'user',
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 5000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 60)),
+    negative_ttl=5,
+)
+device_access_cache = TTLCache(
+    'device_access',
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 5000)),
+    ttl=float(os.environ.get('USER_CACHE_TTL', 60)),
+)
+
+# --- Database Connection Functions ---
+def get_db_connection(readonly=False):
+    """
+    Borrows a connection from the pool. Must be given back with release_db_connection().
+    readonly=True may borrow from a read replica instead (see DATABASE_REPLICA_URLS).
+    """
+    if readonly and DATABASE_REPLICA_URLS and not _reads_need_primary():
+        conn = _borrow_from_replica()
+        if conn is not None:
+            return conn
+
+    pool = get_db_pool()
+    if not pool:
+        return None
+
+    start = time.perf_counter()
+    try:
+        conn = pool.getconn()
     except Exception as e:
         print(f"DB Connection Error: {e}")
         return None
+    connection_acquired(conn, time.perf_counter() - start)
+    return conn
+
+def release_db_connection(conn):
+    """Returns a borrowed connection to the pool (replaces conn.close())."""
+    if conn is None:
+        return
+    # Read-only queries leave an open transaction behind; end it here so the
+    # connection goes back to the pool clean.
+    if conn.info.transaction_status != psycopg.pq.TransactionStatus.IDLE:
+        try:
+            conn.rollback()
+        except Exception:
+            pass
+    connection_released(conn)
+    with _borrowed_lock:
+        pool = _borrowed_from.pop(id(conn), None)
+    pool = pool or get_db_pool()
+    if pool:
+        pool.putconn(conn)
+    else:
+        conn.close()
+
+
+def time_range_filter(column, since=None, until=None):
+    """
+    " AND column >= %s AND column < %s" for the bounds of [since, until) that
+    are given, plus their parameters. Absent bounds are left out of the SQL
+    (rather than "%s IS NULL OR ..."), so plans psycopg auto-prepares still
+    use them as index bounds and for partition pruning.
+    """
+    column = sql.Identifier(*column.split('.'))
+    conditions, params = [], []
+    if since is not None:
+        conditions.append(sql.SQL(" AND {} >= %s").format(column))
+        params.append(since)
+    if until is not None:
+        conditions.append(sql.SQL(" AND {} < %s").format(column))
+        params.append(until)
+    return sql.Composed(conditions), params
+
+
+def transaction_now(cur):
+    """The current transaction's NOW(), i.e. the received_at of rows it stores."""
+    cur.execute("SELECT NOW()")
+    return cur.fetchone()[0]
 
 # ----------------------------------------------------------------------
 # 1. USER MODEL (Includes new create_user method for registration)
@@ -66,6 +325,7 @@ class User(UserMixin):
             )
             user_id = cur.fetchone()[0] # Get the ID of the new user
             conn.commit()
+            User.invalidate(user_id)
             return True, User(id=user_id, email=email, password_hash=password_hash, name=name)
             
         except psycopg.errors.UniqueViolation:
@@ -82,20 +342,37 @@ class User(UserMixin):
             return False, f"An unexpected error occurred during registration. Details: {e}"
             
         finally:
-            if conn: conn.close()
+            release_db_connection(conn)
     # -----------------------------------
 
     @classmethod
     def get_by_id(cls, user_id):
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+
+        user = user_cache.get(user_id)
+        if user is not MISSING:
+            return user
+
         conn = get_db_connection()
         if not conn: return None
         try:
             cur = conn.cursor()
             cur.execute("SELECT id, email, password_hash, name FROM users WHERE id = %s", (user_id,))
             user_data = cur.fetchone()
-            return cls(*user_data) if user_data else None
+            user = cls(*user_data) if user_data else None
+            user_cache.set(user_id, user)
+            return user
         finally:
-            if conn: conn.close()
+            release_db_connection(conn)
+
+    @staticmethod
+    def invalidate(user_id):
+        """Drops the cached user record and device authorizations (e.g. after registration)."""
+        user_cache.invalidate(int(user_id))
+        device_access_cache.invalidate(int(user_id))
 
     @classmethod
     def get_by_email(cls, email):
@@ -107,7 +384,7 @@ class User(UserMixin):
             user_data = cur.fetchone()
             return cls(*user_data) if user_data else None
         finally:
-            if conn: conn.close()
+            release_db_connection(conn)
 
 
 # ----------------------------------------------------------------------
@@ -116,6 +393,10 @@ class User(UserMixin):
 
 class Device:
     """Represents a record in the 'devices' table."""
+    # Ingest lookups, also run by the async server (asgi.py)
+    _RESOLVE_IMEIS_SQL = "SELECT unique_imei, id FROM devices WHERE unique_imei = ANY(%s)"
+    _IMEI_BY_TOKEN_SQL = "SELECT unique_imei FROM devices WHERE device_token = %s"
+
     def __init__(self, id, device_name, unique_imei, imei_suffix=None):
         self.id = id
         self.device_name = device_name
@@ -126,7 +407,7 @@ class Device:
     @classmethod
     def get_user_devices(cls, user_id):
         """Retrieves all devices shared with a specific user."""
-        conn = get_db_connection()
+        conn = get_db_connection(readonly=True)
         if not conn: return []
         try:
             cur = conn.cursor()
@@ -142,12 +423,12 @@ class Device:
             devices_data = cur.fetchall()
             return [cls(*data) for data in devices_data]
         finally:
-            if conn: conn.close()
+            release_db_connection(conn)
             
     @classmethod
     def get_by_id_and_user(cls, device_id, user_id):
         """Retrieves a device ensuring it is shared with the given user."""
-        conn = get_db_connection()
+        conn = get_db_connection(readonly=True)
         if not conn: return None
         try:
             cur = conn.cursor()
@@ -161,7 +442,7 @@ class Device:
             device_data = cur.fetchone()
             return cls(*device_data) if device_data else None
         finally:
-            if conn: conn.close()
+            release_db_connection(conn)
 
     @classmethod
     def get_by_imei(cls, imei):
@@ -178,29 +459,181 @@ class Device:
             # If found, return the Device object
             return cls(device_data[0], device_data[1], device_data[2]) if device_data else None
         finally:
-            if conn: conn.close()
+            release_db_connection(conn)
             
     @classmethod
-    def get_readings(cls, device_id, limit=50):
-        """Retrieves historical readings for a specific device."""
-        conn = get_db_connection()
+    def get_readings_page(cls, device_id, limit=100, since=None, until=None, after=None, ascending=False):
+        """
+        Keyset-paginated readings within [since, until), ordered by (received_at, id).
+        `after` is the (received_at, id) of the last row of the previous page; the
+        next page starts right after it, so every page is one index range scan
+        regardless of how deep into the history it is.
+        """
+        conn = get_db_connection(readonly=True)
         if not conn: return []
+        op, direction = ('>', 'ASC') if ascending else ('<', 'DESC')
+        filters, params = time_range_filter('received_at', since, until)
+        if after:
+            filters += sql.SQL(" AND (received_at, id) " + op + " (%s, %s)")
+            params += list(after)
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                sql.SQL("""
+                SELECT id, device_id, latitude, longitude, temperature, gsm_time, received_at
+                FROM readings
+                WHERE device_id = %s{filters}
+                ORDER BY received_at {direction}, id {direction}
+                LIMIT %s
+                """).format(filters=filters, direction=sql.SQL(direction)),
+                [device_id, *params, limit]
+            )
+            return [Reading(*data) for data in cur.fetchall()]
+        finally:
+            release_db_connection(conn)
+
+    @classmethod
+    def get_received_after(cls, since_by_device):
+        """
+        Readings received after a per-device time ({device_id: received_at}),
+        plus each device's device_latest receive time from the same snapshot.
+        Returns ({device_id: [Reading, oldest received first]}, {device_id: received_at}).
+        """
+        if not since_by_device:
+            return {}, {}
+        conn = get_db_connection(readonly=True)
+        if not conn: return {}, {}
+        device_ids, since = map(list, zip(*since_by_device.items()))
         try:
             cur = conn.cursor()
             cur.execute(
                 """
+                SELECT dl.device_id, dl.received_at,
+                    r.id, r.device_id, r.latitude, r.longitude, r.temperature, r.gsm_time, r.received_at
+                FROM unnest(%s::integer[], %s::timestamptz[]) AS s(device_id, since)
+                JOIN device_latest dl ON dl.device_id = s.device_id
+                LEFT JOIN readings r ON r.device_id = s.device_id AND r.received_at > s.since
+                ORDER BY dl.device_id, r.received_at, r.id
+                """,
+                (device_ids, since)
+            )
+            readings, received = {}, {}
+            for data in cur.fetchall():
+                received[data[0]] = data[1]
+                if data[2] is not None:
+                    readings.setdefault(data[0], []).append(cls(*data[2:]))
+            return readings, received
+        finally:
+            release_db_connection(conn)
+
+    @staticmethod
+    def resolve_device_ids(cur, imeis):
+        """
+        Maps IMEIs to device ids (None for unknown IMEIs) using the IMEI cache,
+        querying only the misses with the given cursor.
+        """
+        resolved = {}
+        misses = []
+        for imei in set(imeis):
+            device_id = imei_cache.get(imei)
+            if device_id is MISSING:
+                misses.append(imei)
+            else:
+                resolved[imei] = device_id
+
+        if misses:
+            cur.execute(Device._RESOLVE_IMEIS_SQL, (misses,))
+            found = dict(cur.fetchall())
+            for imei in misses:
+                resolved[imei] = found.get(imei)
+                imei_cache.set(imei, resolved[imei])
+        return resolved
+
+    @staticmethod
+    def get_imei_by_token(token):
+        """Maps a binary-frame device token to the device IMEI (None if unknown), cached."""
+        imei = token_cache.get(token)
+        if imei is not MISSING:
+            return imei
+        conn = get_db_connection()
+        if not conn: return None
+        try:
+            cur = conn.cursor()
+            cur.execute(Device._IMEI_BY_TOKEN_SQL, (token,))
+            row = cur.fetchone()
+            imei = row[0] if row else None
+            token_cache.set(token, imei)
+            return imei
+        finally:
+            release_db_connection(conn)
+
+    @staticmethod
+    def get_token(device_id, rotate=False):
+        """
+        Returns the device's binary-frame token, issuing one if it has none
+        (or a new one with rotate=True; the old token stops working).
+        """
+        conn = get_db_connection()
+        if not conn: return None
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT device_token FROM devices WHERE id = %s FOR UPDATE", (device_id,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            old_token = bytes(row[0]) if row[0] is not None else None
+            if old_token is not None and not rotate:
+                return old_token
+            while True:
+                token = secrets.token_bytes(DEVICE_TOKEN_BYTES)
+                cur.execute(
+                    """
+                    UPDATE devices SET device_token = %s
+                    WHERE id = %s AND NOT EXISTS (SELECT 1 FROM devices WHERE device_token = %s)
+                    """,
+                    (token, device_id, token)
+                )
+                if cur.rowcount:
+                    break
+            conn.commit()
+            if old_token is not None:
+                token_cache.invalidate(old_token)
+            token_cache.invalidate(token)
+            return token
+        except Exception as e:
+            conn.rollback()
+            print(f"Error issuing device token: {e}")
+            return None
+        finally:
+            release_db_connection(conn)
+
+    @staticmethod
+    def invalidate_imei(imei):
+        """Drops a cached IMEI mapping (call after creating or renaming a device)."""
+        imei_cache.invalidate(imei)
+
+    @classmethod
+    def get_readings(cls, device_id, limit=50, since=None, until=None):
+        """Retrieves historical readings for a specific device, newest first, optionally within [since, until)."""
+        conn = get_db_connection(readonly=True)
+        if not conn: return []
+        try:
+            cur = conn.cursor()
+            filters, params = time_range_filter('received_at', since, until)
+            cur.execute(
+                sql.SQL("""
                 SELECT id, device_id, latitude, longitude, temperature, gsm_time, received_at
                 FROM readings
-                WHERE device_id = %s
+                WHERE device_id = %s{filters}
                 ORDER BY received_at DESC
                 LIMIT %s
-                """,
-                (device_id, limit)
+                """).format(filters=filters),
+                [device_id, *params, limit]
             )
             readings_data = cur.fetchall()
             return [Reading(*data) for data in readings_data]
         finally:
-            if conn: conn.close()
+            release_db_connection(conn)
             
 # ----------------------------------------------------------------------
 # 3. DEVICE SHARE MODEL (NEW)
@@ -208,7 +641,33 @@ class Device:
 
 class DeviceShare:
     """Manages the relationship between a User and a Device."""
-    
+    # Also run by the async server (asgi.py)
+    _DEVICE_IDS_SQL = "SELECT device_id FROM device_shares WHERE user_id = %s"
+
+    @staticmethod
+    def get_device_ids_for_user(user_id):
+        """Returns the (cached) frozenset of device ids shared with a user."""
+        user_id = int(user_id)
+        device_ids = device_access_cache.get(user_id)
+        if device_ids is not MISSING:
+            return device_ids
+
+        conn = get_db_connection()
+        if not conn: return frozenset()
+        try:
+            cur = conn.cursor()
+            cur.execute(DeviceShare._DEVICE_IDS_SQL, (user_id,))
+            device_ids = frozenset(row[0] for row in cur.fetchall())
+            device_access_cache.set(user_id, device_ids)
+            return device_ids
+        finally:
+            release_db_connection(conn)
+
+    @staticmethod
+    def user_can_access(user_id, device_id):
+        """Authorization check for the polling APIs, served from the device access cache."""
+        return device_id in DeviceShare.get_device_ids_for_user(user_id)
+
     @staticmethod
     def link_user_to_device(user_id, device_id):
         """Links a user to a device in the device_shares table."""
@@ -229,14 +688,99 @@ class DeviceShare:
             conn.rollback()
             return False, f"Database error during linking: {e}"
         finally:
-            if conn: conn.close()
+            device_access_cache.invalidate(int(user_id))
+            release_db_connection(conn)
             
 # ----------------------------------------------------------------------
 # 4. READING MODEL (Minor change for real-time API)
 # ----------------------------------------------------------------------
 
+# Value the firmware sends for latitude, longitude and/or temperature when the
+# GPS has no fix or the temperature sensor failed (see esp32-coolmove/src/main.cpp).
+SENTINEL_VALUE = -999.0
+
+def is_sentinel(value):
+    return value is None or value <= SENTINEL_VALUE
+
+
 class Reading:
     """Represents a record in the 'readings' table (GPS and Sensor data)."""
+
+    # Inserts a batch of rows (parallel arrays), pg_notifies one event per new
+    # row in the same shape as the /api/latest JSON (delivered on commit, see
+    # live.py) and returns the stored rows.
+    _INSERT_SQL = """
+        WITH inserted AS (
+            INSERT INTO readings (device_id, latitude, longitude, temperature, gsm_time, received_at)
+            SELECT d, lat, lon, t, g, NOW()
+            FROM unnest(%s::int[], %s::float8[], %s::float8[], %s::float8[], %s::timestamptz[])
+                AS batch(d, lat, lon, t, g)
+            RETURNING id, device_id, latitude, longitude, temperature, gsm_time, received_at
+        )
+        SELECT id, device_id, latitude, longitude, temperature, gsm_time, received_at,
+            pg_notify(%s, json_build_object(
+                'id', id,
+                'device_id', device_id,
+                'temp', round(temperature::numeric, 1),
+                'lat', latitude,
+                'lon', longitude,
+                'time', to_char(received_at, 'YYYY-MM-DD HH24:MI:SS'),
+                'status', 'OK'
+            )::text)
+        FROM inserted
+        ORDER BY id
+    """
+
+    # Keeps one "latest state" row per device. The last valid GPS fix and
+    # temperature are only overwritten by non-sentinel values (NULL = keep).
+    # reading_id is the last *stored* reading (dead-band suppressed samples
+    # update the state but have no id, so a batch of only suppressed samples
+    # proposes NULL; the column is nullable because NOT NULL is checked on the
+    # proposed row before ON CONFLICT applies the COALESCE).
+    _UPSERT_LATEST_SQL = """
+        INSERT INTO device_latest (
+            device_id, reading_id, latitude, longitude, temperature, gsm_time, received_at,
+            last_fix_latitude, last_fix_longitude, last_fix_at,
+            last_valid_temperature, last_valid_temperature_at, suppressed_count
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (device_id) DO UPDATE SET
+            reading_id = COALESCE(EXCLUDED.reading_id, device_latest.reading_id),
+            latitude = EXCLUDED.latitude,
+            longitude = EXCLUDED.longitude,
+            temperature = EXCLUDED.temperature,
+            gsm_time = EXCLUDED.gsm_time,
+            received_at = EXCLUDED.received_at,
+            last_fix_latitude = COALESCE(EXCLUDED.last_fix_latitude, device_latest.last_fix_latitude),
+            last_fix_longitude = COALESCE(EXCLUDED.last_fix_longitude, device_latest.last_fix_longitude),
+            last_fix_at = COALESCE(EXCLUDED.last_fix_at, device_latest.last_fix_at),
+            last_valid_temperature = COALESCE(EXCLUDED.last_valid_temperature, device_latest.last_valid_temperature),
+            last_valid_temperature_at = COALESCE(EXCLUDED.last_valid_temperature_at, device_latest.last_valid_temperature_at),
+            suppressed_count = device_latest.suppressed_count + EXCLUDED.suppressed_count
+        WHERE device_latest.received_at <= EXCLUDED.received_at
+    """
+
+    _LATEST_COLUMNS = """
+        dl.reading_id, dl.device_id, dl.latitude, dl.longitude, dl.temperature, dl.gsm_time, dl.received_at,
+        dl.last_fix_latitude, dl.last_fix_longitude, dl.last_fix_at,
+        dl.last_valid_temperature, dl.last_valid_temperature_at, dl.suppressed_count
+    """
+    _LATEST_FOR_DEVICE_SQL = "SELECT " + _LATEST_COLUMNS + " FROM device_latest dl WHERE dl.device_id = %s"
+    _LATEST_FOR_USER_SQL = """
+        SELECT """ + _LATEST_COLUMNS + """
+        FROM device_shares ds
+        JOIN device_latest dl ON dl.device_id = ds.device_id
+        WHERE ds.user_id = %s
+    """
+    _LATEST_VERSIONS_SQL = "SELECT device_id, received_at FROM device_latest WHERE device_id = ANY(%s)"
+
+    # Callbacks run with the list of newly stored readings after each commit
+    # (see Reading.on_stored), e.g. for metrics and the fleet overview.
+    _listeners = []
+    # Stream processors whose state lives in the database run inside the
+    # storing transaction instead (see Reading.on_storing), e.g. excursions.py.
+    _processors = []
+
     def __init__(self, id, device_id, latitude, longitude, temperature, gsm_time, received_at):
         self.id = id
         self.device_id = device_id
@@ -245,61 +789,1312 @@ class Reading:
         self.temperature = temperature
         self.gsm_time = gsm_time
         self.received_at = received_at
+
+    @classmethod
+    def on_stored(cls, callback):
+        """Registers callback(readings) to run after every committed insert (oldest reading first)."""
+        cls._listeners.append(callback)
+        return callback
+
+    @classmethod
+    def on_storing(cls, callback):
+        """
+        Registers callback(cur, readings) to run inside every insert transaction,
+        after the readings, device_latest and rollups are written. Each callback
+        runs in a savepoint: other errors are logged and only undo that
+        callback's writes, while psycopg.OperationalError aborts the insert.
+        """
+        cls._processors.append(callback)
+        return callback
+
+    @classmethod
+    def _run_processors(cls, cur, readings):
+        for callback in cls._processors:
+            try:
+                with cur.connection.transaction():
+                    callback(cur, readings)
+            except psycopg.OperationalError:
+                raise
+            except Exception as e:
+                print(f"Reading processor {getattr(callback, '__name__', callback)} failed: {e}")
+
+    @classmethod
+    def _notify_listeners(cls, readings):
+        if not readings:
+            return
+        for callback in cls._listeners:
+            try:
+                callback(readings)
+            except Exception as e:
+                # A failing processor must never fail ingest
+                print(f"Reading listener {getattr(callback, '__name__', callback)} failed: {e}")
+
+    @property
+    def has_gps_fix(self):
+        return not (is_sentinel(self.latitude) or is_sentinel(self.longitude))
+
+    @property
+    def has_valid_temperature(self):
+        return not is_sentinel(self.temperature)
+
+    @property
+    def sample_time(self):
+        """
+        When the reading was taken: the device's GSM time for buffered backlog
+        uploads (which all share one received_at), never later than receipt
+        (a fast device clock would otherwise date samples in the future).
+        Rollups, excursions, trips and the fleet windows all use this.
+        """
+        if self.gsm_time is None:
+            return self.received_at
+        return min(self.gsm_time, self.received_at)
         
     @classmethod
     def get_latest_reading(cls, device_id):
-        """Retrieves the most recent sensor reading for a specific device."""
-        conn = get_db_connection()
+        """Retrieves the most recent sensor reading for a specific device (from device_latest)."""
+        conn = get_db_connection(readonly=True)
         if not conn: return None
+        try:
+            cur = conn.cursor()
+            cur.execute(cls._LATEST_FOR_DEVICE_SQL, (device_id,))
+            reading_data = cur.fetchone()
+            reading = LatestReading(*reading_data) if reading_data else None
+            latest_version_cache.set(device_id, reading.received_at if reading else None)
+            return reading
+        finally:
+            release_db_connection(conn)
+
+    @classmethod
+    def get_latest_readings_for_user(cls, user_id):
+        """
+        Retrieves the latest state of every device shared with a user in one
+        primary-key join against device_latest. Returns {device_id: LatestReading}.
+        """
+        conn = get_db_connection(readonly=True)
+        if not conn: return {}
+        try:
+            cur = conn.cursor()
+            cur.execute(cls._LATEST_FOR_USER_SQL, (user_id,))
+            readings = {data[1]: LatestReading(*data) for data in cur.fetchall()}
+            for device_id, reading in readings.items():
+                latest_version_cache.set(device_id, reading.received_at)
+            return readings
+        finally:
+            release_db_connection(conn)
+
+    @classmethod
+    def get_latest_in_bbox(cls, user_id, south=-90.0, west=-180.0, north=90.0, east=180.0):
+        """
+        Latest state of the user's devices whose last GPS fix lies in the box,
+        as (device_name, LatestReading) pairs. west > east means the box
+        crosses the antimeridian.
+        """
+        longitude_filter = ("dl.last_fix_longitude BETWEEN %s AND %s" if west <= east
+                            else "(dl.last_fix_longitude >= %s OR dl.last_fix_longitude <= %s)")
+        conn = get_db_connection(readonly=True)
+        if not conn: return []
         try:
             cur = conn.cursor()
             cur.execute(
                 """
-                SELECT id, device_id, latitude, longitude, temperature, gsm_time, received_at 
-                FROM readings 
-                WHERE device_id = %s 
-                ORDER BY received_at DESC 
-                LIMIT 1
-                """, 
-                (device_id,)
+                SELECT d.device_name, """ + cls._LATEST_COLUMNS + """
+                FROM device_shares ds
+                JOIN device_latest dl ON dl.device_id = ds.device_id
+                JOIN devices d ON d.id = ds.device_id
+                WHERE ds.user_id = %s
+                  AND dl.last_fix_latitude BETWEEN %s AND %s
+                  AND """ + longitude_filter + """
+                ORDER BY d.device_name
+                """,
+                (user_id, south, north, west, east)
             )
-            reading_data = cur.fetchone()
-            return cls(*reading_data) if reading_data else None
+            return [(data[0], LatestReading(*data[1:])) for data in cur.fetchall()]
+        finally:
+            release_db_connection(conn)
+
+    @staticmethod
+    def get_latest_versions(device_ids):
+        """
+        Returns {device_id: received_at of the latest state, or None}, from the
+        version cache where possible and one device_latest query for the rest.
+        """
+        versions = {}
+        misses = []
+        for device_id in device_ids:
+            version = latest_version_cache.get(device_id)
+            if version is MISSING:
+                misses.append(device_id)
+            else:
+                versions[device_id] = version
+        if not misses:
+            return versions
+
+        conn = get_db_connection(readonly=True)
+        if not conn:
+            versions.update((device_id, None) for device_id in misses)
+            return versions
+        try:
+            cur = conn.cursor()
+            cur.execute(Reading._LATEST_VERSIONS_SQL, (misses,))
+            found = dict(cur.fetchall())
+            for device_id in misses:
+                versions[device_id] = found.get(device_id)
+                latest_version_cache.set(device_id, versions[device_id])
+            return versions
+        finally:
+            release_db_connection(conn)
+
+    @staticmethod
+    def _forget_latest_versions(readings):
+        for device_id in {r.device_id for r in readings}:
+            latest_version_cache.invalidate(device_id)
+
+    # SSE resume never replays further back than this, which also keeps the
+    # query on the most recent readings partitions.
+    RESUME_WINDOW = '1 day'
+
+    @classmethod
+    def get_readings_after(cls, device_ids, last_id, limit=500):
+        """Readings with id > last_id for the given devices, oldest first (SSE resume)."""
+        conn = get_db_connection()
+        if not conn: return []
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT id, device_id, latitude, longitude, temperature, gsm_time, received_at
+                FROM readings
+                WHERE device_id = ANY(%s) AND id > %s
+                  AND received_at > NOW() - %s::interval
+                ORDER BY id
+                LIMIT %s
+                """,
+                (list(device_ids), last_id, cls.RESUME_WINDOW, limit)
+            )
+            return [cls(*data) for data in cur.fetchall()]
         finally:
-            if conn: conn.close()
+            release_db_connection(conn)
 
     @staticmethod
-    def insert_reading(imei, lat, lon, temp):
+    def iter_export(device_ids, since=None, until=None, chunk_size=5000):
+        """
+        Yields lists of (device_id, device_name, reading_id, received_at, gsm_time,
+        lat, lon, temp) rows for the given devices within [since, until), read from
+        a server-side (named) cursor so only one chunk is in memory at a time.
+        The pooled connection is held until the generator is exhausted or closed.
+        """
+        conn = get_db_connection(readonly=True)
+        if not conn:
+            raise RuntimeError("Database connection failed")
+        try:
+            with conn.cursor(name='readings_export') as cur:
+                cur.itersize = chunk_size
+                filters, params = time_range_filter('r.received_at', since, until)
+                cur.execute(
+                    sql.SQL("""
+                    SELECT r.device_id, d.device_name, r.id, r.received_at, r.gsm_time,
+                        r.latitude, r.longitude, r.temperature
+                    FROM readings r
+                    JOIN devices d ON d.id = r.device_id
+                    WHERE r.device_id = ANY(%s){filters}
+                    ORDER BY r.device_id, r.received_at, r.id
+                    """).format(filters=filters),
+                    [list(device_ids), *params]
+                )
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield rows
+        finally:
+            release_db_connection(conn)
+
+    @staticmethod
+    def insert_reading(imei, lat, lon, temp, gsm_time=None):
         """Inserts a new sensor reading, finding the device by IMEI first."""
         conn = get_db_connection()
         if not conn: return False, "Database connection failed"
         cur = conn.cursor()
+        device_id = None
         
         try:
-            # 1. Find the corresponding device_id using the unique IMEI
-            cur.execute("SELECT id FROM devices WHERE unique_imei = %s", (imei,))
-            device_id_result = cur.fetchone()
+            # 1. Find the corresponding device_id using the unique IMEI (cached)
+            device_id = Device.resolve_device_ids(cur, [imei])[imei]
             
-            if not device_id_result:
+            if device_id is None:
                 return False, "Device not found"
-                
-            device_id = device_id_result[0]
             
-            # 2. Insert the new reading. gsm_time is NULL as before.
+            # 2. Insert the new reading and update the device's latest state.
+            #    gsm_time is the optional device-side timestamp.
+            stored = Reading._store(cur, [(device_id, lat, lon, temp, gsm_time)])
+            conn.commit()
+            Reading._forget_latest_versions(stored)
+            Reading._notify_listeners(stored)
+            return True, "Reading saved"
+            
+        except Exception as e:
+            conn.rollback()
+            return False, f"Database error: {e}"
+            
+        finally:
+            release_db_connection(conn)
+
+    @staticmethod
+    def insert_readings(readings, raise_errors=False):
+        """
+        Inserts many readings in a single transaction (batch ingest).
+        `readings` is a list of (imei, lat, lon, temp, gsm_time) tuples, possibly
+        from several devices. Returns a list of (success, message), one per item.
+        With raise_errors, a failed transaction raises instead (after rollback)
+        so the caller can tell outages (psycopg.OperationalError) from bad data.
+        """
+        if not readings:
+            return []
+        conn = get_db_connection()
+        if not conn:
+            if raise_errors:
+                raise psycopg.OperationalError("Database connection failed")
+            return [(False, "Database connection failed")] * len(readings)
+        cur = conn.cursor()
+
+        try:
+            # 1. Resolve every distinct IMEI (cache first, then one query for the misses)
+            device_ids = Device.resolve_device_ids(cur, [r[0] for r in readings])
+
+            results = []
+            rows = []
+            for imei, lat, lon, temp, gsm_time in readings:
+                device_id = device_ids.get(imei)
+                if device_id is None:
+                    results.append((False, "Device not found"))
+                    continue
+                rows.append((device_id, lat, lon, temp, gsm_time))
+                results.append((True, "Reading saved"))
+
+            # 2. One multi-row INSERT for the whole batch
+            stored = Reading._store(cur, rows)
+            conn.commit()
+            Reading._forget_latest_versions(stored)
+            Reading._notify_listeners(stored)
+            return results
+
+        except Exception as e:
+            conn.rollback()
+            if raise_errors:
+                raise
+            return [(False, f"Database error: {e}")] * len(readings)
+
+        finally:
+            release_db_connection(conn)
+
+    @staticmethod
+    def _store(cur, rows):
+        """
+        Writes (device_id, lat, lon, temp, gsm_time) rows inside the caller's
+        transaction: rows the device's dead-band policy doesn't suppress go into
+        one multi-row INSERT, then every row (stored or not) updates the
+        device_latest and rollup aggregates. Returns Reading objects for all
+        rows in order; suppressed ones have id None.
+        """
+        if not rows:
+            return []
+        keep = DeviceDeadband.filter(cur, rows)
+        stored_rows = [row for row, k in zip(rows, keep) if k]
+
+        stored = []
+        if stored_rows:
+            device_col, lat_col, lon_col, temp_col, time_col = map(list, zip(*stored_rows))
+            cur.execute(Reading._INSERT_SQL, (device_col, lat_col, lon_col, temp_col, time_col, NOTIFY_CHANNEL))
+            stored = [Reading(*data[:7]) for data in cur.fetchall()]
+
+        # Suppressed samples are not written to readings but still count as received
+        # (at the same NOW() as stored rows, or device_latest's ordering breaks)
+        now = transaction_now(cur) if not all(keep) else None
+        stored_iter = iter(stored)
+        readings = [
+            next(stored_iter) if k else Reading(None, *row, now)
+            for row, k in zip(rows, keep)
+        ]
+        suppressed = [r for r in readings if r.id is None]
+        if suppressed:
+            cur.executemany("SELECT pg_notify(%s, %s)", [
+                (NOTIFY_CHANNEL, json.dumps({
+                    'id': None, 'device_id': r.device_id, 'temp': round(r.temperature, 1),
+                    'lat': r.latitude, 'lon': r.longitude,
+                    'time': r.received_at.astimezone().strftime('%Y-%m-%d %H:%M:%S'), 'status': 'OK',
+                }))
+                for r in suppressed
+            ])
+
+        # Fold the batch into one latest-state row per device
+        latest = {}
+        for reading in readings:
+            state = latest.setdefault(reading.device_id, {'fix': None, 'temp': None, 'stored_id': None, 'suppressed': 0})
+            state['reading'] = reading
+            if reading.id is None:
+                state['suppressed'] += 1
+            else:
+                state['stored_id'] = reading.id
+            if reading.has_gps_fix:
+                state['fix'] = reading
+            if reading.has_valid_temperature:
+                state['temp'] = reading
+
+        # Sorted so concurrent batches lock rows in the same order
+        cur.executemany(Reading._UPSERT_LATEST_SQL, [
+            (
+                device_id, state['stored_id'], state['reading'].latitude, state['reading'].longitude,
+                state['reading'].temperature, state['reading'].gsm_time, state['reading'].received_at,
+                state['fix'].latitude if state['fix'] else None,
+                state['fix'].longitude if state['fix'] else None,
+                state['fix'].received_at if state['fix'] else None,
+                state['temp'].temperature if state['temp'] else None,
+                state['temp'].received_at if state['temp'] else None,
+                state['suppressed'],
+            )
+            for device_id, state in sorted(latest.items())
+        ])
+
+        ReadingRollup.accumulate(cur, readings)
+        DeviceCell.accumulate(cur, readings)
+        Reading._run_processors(cur, readings)
+        return readings
+
+
+class LatestReading(Reading):
+    """A row of 'device_latest': the newest reading plus the last valid GPS fix and temperature."""
+    def __init__(self, id, device_id, latitude, longitude, temperature, gsm_time, received_at,
+                 last_fix_latitude=None, last_fix_longitude=None, last_fix_at=None,
+                 last_valid_temperature=None, last_valid_temperature_at=None, suppressed_count=0):
+        super().__init__(id, device_id, latitude, longitude, temperature, gsm_time, received_at)
+        self.suppressed_count = suppressed_count
+        self.last_fix_latitude = last_fix_latitude
+        self.last_fix_longitude = last_fix_longitude
+        self.last_fix_at = last_fix_at
+        self.last_valid_temperature = last_valid_temperature
+        self.last_valid_temperature_at = last_valid_temperature_at
+
+
+def latest_reading_json(reading):
+    """JSON shape of a reading in the latest/stream APIs (shared by app.py and asgi.py)."""
+    data = {
+        'temp': round(reading.temperature, 1),
+        'lat': reading.latitude,
+        'lon': reading.longitude,
+        'time': reading.received_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'status': 'OK'
+    }
+    # Latest-state rows also remember the last values that weren't -999 sentinels
+    if getattr(reading, 'last_fix_at', None):
+        data['last_fix'] = {
+            'lat': reading.last_fix_latitude,
+            'lon': reading.last_fix_longitude,
+            'time': reading.last_fix_at.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+    if getattr(reading, 'suppressed_count', None):
+        data['suppressed'] = reading.suppressed_count
+    if getattr(reading, 'last_valid_temperature_at', None):
+        data['last_valid_temp'] = {
+            'temp': round(reading.last_valid_temperature, 1),
+            'time': reading.last_valid_temperature_at.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+    return data
+
+
+def latest_validators(versions, *extra):
+    """
+    Weak ETag and Last-Modified for a response built from the given devices'
+    latest state ({device_id: received_at or None}) plus any `extra` request
+    parameters that shape the body (shared by app.py and asgi.py).
+    """
+    key = repr((sorted((d, v.isoformat() if v else None) for d, v in versions.items()), extra))
+    etag = hashlib.sha1(key.encode()).hexdigest()[:20]
+    last_modified = max((v for v in versions.values() if v), default=None)
+    return etag, last_modified
+
+
+# ----------------------------------------------------------------------
+# 5. READING ROLLUP MODEL (Time-bucketed history)
+# ----------------------------------------------------------------------
+
+class ReadingRollup:
+    """
+    Represents a record in the 'reading_rollups' table: per-device aggregates
+    over a fixed time bucket, maintained incrementally on every insert.
+    """
+    # Bucket sizes in seconds, finest first (1 minute, 1 hour)
+    RESOLUTIONS = (60, 3600)
+
+    _UPSERT_SQL = """
+        INSERT INTO reading_rollups AS r (
+            device_id, bucket_seconds, bucket_start, sample_count,
+            temp_count, temp_min, temp_max, temp_sum,
+            first_at, last_at, first_latitude, first_longitude, last_latitude, last_longitude,
+            temp_failures, gps_failures
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (device_id, bucket_seconds, bucket_start) DO UPDATE SET
+            sample_count = r.sample_count + EXCLUDED.sample_count,
+            temp_count = r.temp_count + EXCLUDED.temp_count,
+            temp_min = LEAST(r.temp_min, EXCLUDED.temp_min),
+            temp_max = GREATEST(r.temp_max, EXCLUDED.temp_max),
+            temp_sum = r.temp_sum + EXCLUDED.temp_sum,
+            first_at = LEAST(r.first_at, EXCLUDED.first_at),
+            last_at = GREATEST(r.last_at, EXCLUDED.last_at),
+            first_latitude = COALESCE(r.first_latitude, EXCLUDED.first_latitude),
+            first_longitude = COALESCE(r.first_longitude, EXCLUDED.first_longitude),
+            last_latitude = COALESCE(EXCLUDED.last_latitude, r.last_latitude),
+            last_longitude = COALESCE(EXCLUDED.last_longitude, r.last_longitude),
+            temp_failures = r.temp_failures + EXCLUDED.temp_failures,
+            gps_failures = r.gps_failures + EXCLUDED.gps_failures
+    """
+
+    def __init__(self, device_id, bucket_seconds, bucket_start, sample_count,
+                 temp_count, temp_min, temp_max, temp_sum,
+                 first_at, last_at, first_latitude, first_longitude, last_latitude, last_longitude,
+                 temp_failures, gps_failures):
+        self.device_id = device_id
+        self.bucket_seconds = bucket_seconds
+        self.bucket_start = bucket_start
+        self.sample_count = sample_count
+        self.temp_count = temp_count
+        self.temp_min = temp_min
+        self.temp_max = temp_max
+        self.temp_sum = temp_sum
+        self.first_at = first_at
+        self.last_at = last_at
+        self.first_latitude = first_latitude
+        self.first_longitude = first_longitude
+        self.last_latitude = last_latitude
+        self.last_longitude = last_longitude
+        self.temp_failures = temp_failures
+        self.gps_failures = gps_failures
+
+    @property
+    def temp_avg(self):
+        return self.temp_sum / self.temp_count if self.temp_count else None
+
+    @staticmethod
+    def bucket_start_for(timestamp, bucket_seconds):
+        epoch = int(timestamp.timestamp())
+        return datetime.fromtimestamp(epoch - epoch % bucket_seconds, tz=timezone.utc)
+
+    @classmethod
+    def accumulate(cls, cur, readings):
+        """Folds newly stored readings into every rollup resolution (inside the caller's transaction)."""
+        buckets = {}
+        for reading in sorted(readings, key=lambda r: r.sample_time):
+            at = reading.sample_time
+            for bucket_seconds in cls.RESOLUTIONS:
+                key = (reading.device_id, bucket_seconds, cls.bucket_start_for(at, bucket_seconds))
+                b = buckets.get(key)
+                if b is None:
+                    b = buckets[key] = {
+                        'count': 0, 'temp_count': 0, 'temp_min': None, 'temp_max': None, 'temp_sum': 0.0,
+                        'first_at': at, 'last_at': at,
+                        'first_fix': None, 'last_fix': None, 'temp_failures': 0, 'gps_failures': 0,
+                    }
+                b['count'] += 1
+                b['last_at'] = at
+                if reading.has_valid_temperature:
+                    t = reading.temperature
+                    b['temp_count'] += 1
+                    b['temp_sum'] += t
+                    b['temp_min'] = t if b['temp_min'] is None else min(b['temp_min'], t)
+                    b['temp_max'] = t if b['temp_max'] is None else max(b['temp_max'], t)
+                else:
+                    b['temp_failures'] += 1
+                if reading.has_gps_fix:
+                    b['first_fix'] = b['first_fix'] or reading
+                    b['last_fix'] = reading
+                else:
+                    b['gps_failures'] += 1
+
+        # Sorted so concurrent batches lock rows in the same order
+        cur.executemany(cls._UPSERT_SQL, [
+            (
+                device_id, bucket_seconds, bucket_start, b['count'],
+                b['temp_count'], b['temp_min'], b['temp_max'], b['temp_sum'],
+                b['first_at'], b['last_at'],
+                b['first_fix'].latitude if b['first_fix'] else None,
+                b['first_fix'].longitude if b['first_fix'] else None,
+                b['last_fix'].latitude if b['last_fix'] else None,
+                b['last_fix'].longitude if b['last_fix'] else None,
+                b['temp_failures'], b['gps_failures'],
+            )
+            for (device_id, bucket_seconds, bucket_start), b in sorted(buckets.items())
+        ])
+
+    @classmethod
+    def get_range(cls, device_id, bucket_seconds, since, until):
+        """Retrieves rollup buckets of one resolution within [since, until), oldest first."""
+        conn = get_db_connection(readonly=True)
+        if not conn: return []
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT device_id, bucket_seconds, bucket_start, sample_count,
+                    temp_count, temp_min, temp_max, temp_sum,
+                    first_at, last_at, first_latitude, first_longitude, last_latitude, last_longitude,
+                    temp_failures, gps_failures
+                FROM reading_rollups
+                WHERE device_id = %s AND bucket_seconds = %s AND bucket_start >= %s AND bucket_start < %s
+                ORDER BY bucket_start
+                """,
+                (device_id, bucket_seconds, cls.bucket_start_for(since, bucket_seconds), until)
+            )
+            return [cls(*data) for data in cur.fetchall()]
+        finally:
+            release_db_connection(conn)
+
+    @classmethod
+    def get_recent_for_devices(cls, device_ids, bucket_seconds, since):
+        """
+        Rollup buckets of one resolution from `since` on for several devices,
+        plus the device_latest receive time they include (read in the same
+        statement, so both come from one snapshot).
+        Returns ({device_id: [buckets, oldest first]}, {device_id: received_at}).
+        """
+        if not device_ids:
+            return {}, {}
+        conn = get_db_connection(readonly=True)
+        if not conn: return {}, {}
+        try:
+            cur = conn.cursor()
             cur.execute(
                 """
-                INSERT INTO readings (device_id, latitude, longitude, temperature, gsm_time, received_at) 
-                VALUES (%s, %s, %s, %s, NULL, NOW())
+                SELECT dl.device_id, dl.received_at,
+                    r.device_id, r.bucket_seconds, r.bucket_start, r.sample_count,
+                    r.temp_count, r.temp_min, r.temp_max, r.temp_sum,
+                    r.first_at, r.last_at, r.first_latitude, r.first_longitude, r.last_latitude, r.last_longitude,
+                    r.temp_failures, r.gps_failures
+                FROM device_latest dl
+                LEFT JOIN reading_rollups r
+                    ON r.device_id = dl.device_id AND r.bucket_seconds = %s AND r.bucket_start >= %s
+                WHERE dl.device_id = ANY(%s)
+                ORDER BY dl.device_id, r.bucket_start
                 """,
-                (device_id, lat, lon, temp)
+                (bucket_seconds, cls.bucket_start_for(since, bucket_seconds), list(device_ids))
+            )
+            buckets, received = {}, {}
+            for data in cur.fetchall():
+                received[data[0]] = data[1]
+                if data[2] is not None:
+                    buckets.setdefault(data[0], []).append(cls(*data[2:]))
+            return buckets, received
+        finally:
+            release_db_connection(conn)
+
+    @classmethod
+    def pick_resolution(cls, device_id, since, until, max_points):
+        """
+        Chooses the finest resolution whose point count over [since, until) fits
+        in max_points: 0 (raw readings), then each rollup size in RESOLUTIONS.
+        Falls back to the coarsest rollup when nothing fits.
+        """
+        conn = get_db_connection(readonly=True)
+        if not conn: return cls.RESOLUTIONS[-1]
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT bucket_seconds, COUNT(*), SUM(sample_count)
+                FROM reading_rollups
+                WHERE device_id = %s AND bucket_start >= %s AND bucket_start < %s
+                GROUP BY bucket_seconds
+                """,
+                (device_id, cls.bucket_start_for(since, cls.RESOLUTIONS[-1]), until)
+            )
+            counts = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+        finally:
+            release_db_connection(conn)
+
+        # The finest rollup's sample total approximates the raw row count
+        raw_count = counts.get(cls.RESOLUTIONS[0], (0, 0))[1] or 0
+        if raw_count <= max_points:
+            return 0
+        for bucket_seconds in cls.RESOLUTIONS:
+            if counts.get(bucket_seconds, (0, 0))[0] <= max_points:
+                return bucket_seconds
+        return cls.RESOLUTIONS[-1]
+
+
+# ----------------------------------------------------------------------
+# 6. EXCURSION MODELS (Cold-chain alerting)
+# ----------------------------------------------------------------------
+
+class DeviceThresholds:
+    """Represents a record in the 'device_thresholds' table (per-device alert rules)."""
+    # Used for devices without a row; 30.0 matches the dashboard's "hot" colour
+    DEFAULTS = {
+        'temp_max': float(os.environ.get('DEFAULT_TEMP_MAX', 30.0)),
+        'temp_min': None,
+        'hysteresis': 0.5,
+        'min_duration_seconds': 60,
+        'max_rate_per_minute': None,
+        'sensor_failure_streak': 3,
+        'gps_loss_streak': 12,
+    }
+    FIELDS = tuple(DEFAULTS)
+
+    def __init__(self, device_id, **values):
+        self.device_id = device_id
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field, self.DEFAULTS[field]))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def get_for_device(cls, device_id):
+        conn = get_db_connection()
+        if not conn: return cls(device_id)
+        try:
+            return cls.load(conn.cursor(), [device_id])[device_id]
+        finally:
+            release_db_connection(conn)
+
+    @classmethod
+    def load(cls, cur, device_ids):
+        """Thresholds of several devices with the given cursor (defaults where there's no row)."""
+        cur.execute(
+            "SELECT device_id, " + ", ".join(cls.FIELDS) + " FROM device_thresholds WHERE device_id = ANY(%s)",
+            (list(device_ids),)
+        )
+        found = {data[0]: cls(data[0], **dict(zip(cls.FIELDS, data[1:]))) for data in cur.fetchall()}
+        return {device_id: found.get(device_id) or cls(device_id) for device_id in device_ids}
+
+    def save(self):
+        conn = get_db_connection()
+        if not conn: return False, "Database connection failed."
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO device_thresholds (device_id, " + ", ".join(self.FIELDS) + ") "
+                "VALUES (%s" + ", %s" * len(self.FIELDS) + ") "
+                "ON CONFLICT (device_id) DO UPDATE SET "
+                + ", ".join(f"{field} = EXCLUDED.{field}" for field in self.FIELDS),
+                (self.device_id, *(getattr(self, field) for field in self.FIELDS))
             )
             conn.commit()
-            return True, "Reading saved"
-            
+            return True, "Thresholds saved."
         except Exception as e:
             conn.rollback()
             return False, f"Database error: {e}"
-            
         finally:
-            if conn:
-                conn.close()
\ No newline at end of file
+            release_db_connection(conn)
+
+
+class ExcursionEvent:
+    """Represents a record in the 'excursion_events' table."""
+    def __init__(self, id, device_id, kind, started_at, ended_at, start_reading_id, end_reading_id,
+                 peak_value, threshold):
+        self.id = id
+        self.device_id = device_id
+        self.kind = kind
+        self.started_at = started_at
+        self.ended_at = ended_at
+        self.start_reading_id = start_reading_id
+        self.end_reading_id = end_reading_id
+        self.peak_value = peak_value
+        self.threshold = threshold
+
+    @staticmethod
+    def open(cur, device_id, kind, started_at, start_reading_id, peak_value, threshold):
+        cur.execute(
+            """
+            INSERT INTO excursion_events (device_id, kind, started_at, start_reading_id, peak_value, threshold)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            (device_id, kind, started_at, start_reading_id, peak_value, threshold)
+        )
+        return cur.fetchone()[0]
+
+    @staticmethod
+    def close(cur, event_id, ended_at, end_reading_id, peak_value):
+        cur.execute(
+            """
+            UPDATE excursion_events SET ended_at = %s, end_reading_id = %s, peak_value = %s
+            WHERE id = %s
+            """,
+            (ended_at, end_reading_id, peak_value, event_id)
+        )
+
+    @classmethod
+    def get_open(cls, cur, device_ids):
+        """Events of the given devices that are still open, with the given cursor."""
+        cur.execute(
+            """
+            SELECT id, device_id, kind, started_at, ended_at, start_reading_id, end_reading_id,
+                peak_value, threshold
+            FROM excursion_events
+            WHERE device_id = ANY(%s) AND ended_at IS NULL
+            """,
+            (list(device_ids),)
+        )
+        return [cls(*data) for data in cur.fetchall()]
+
+    @classmethod
+    def get_for_devices(cls, device_ids, active_only=False, limit=100):
+        """Most recent events of the given devices, newest first."""
+        conn = get_db_connection()
+        if not conn: return []
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT id, device_id, kind, started_at, ended_at, start_reading_id, end_reading_id,
+                    peak_value, threshold
+                FROM excursion_events
+                WHERE device_id = ANY(%s) AND (NOT %s OR ended_at IS NULL)
+                ORDER BY started_at DESC
+                LIMIT %s
+                """,
+                (list(device_ids), active_only, limit)
+            )
+            return [cls(*data) for data in cur.fetchall()]
+        finally:
+            release_db_connection(conn)
+
+
+class ExcursionState:
+    """
+    Represents a record in the 'excursion_state' table: the rule engine's
+    per-device progress (pending breaches, streak counts, open event ids and
+    the last valid temperature), so any process storing readings continues
+    where the previous one left off.
+    """
+    def __init__(self, device_id, conditions=None, last_temp=None, last_temp_at=None, created=False):
+        self.device_id = device_id
+        self.conditions = conditions or {}
+        self.last_temp = last_temp
+        self.last_temp_at = last_temp_at
+        self.created = created  # No row existed before this transaction
+
+    @classmethod
+    def lock(cls, cur, device_ids):
+        """
+        Loads (creating if needed) and row-locks the state of the given devices
+        until the caller's transaction ends. Returns {device_id: ExcursionState}.
+        """
+        device_ids = sorted(set(device_ids)) # Lock in a consistent order
+        cur.execute(
+            """
+            INSERT INTO excursion_state (device_id) SELECT unnest(%s::integer[])
+            ON CONFLICT (device_id) DO NOTHING
+            RETURNING device_id
+            """,
+            (device_ids,)
+        )
+        created = {data[0] for data in cur.fetchall()}
+        cur.execute(
+            """
+            SELECT device_id, conditions, last_temp, last_temp_at
+            FROM excursion_state WHERE device_id = ANY(%s)
+            ORDER BY device_id
+            FOR UPDATE
+            """,
+            (device_ids,)
+        )
+        return {data[0]: cls(*data, created=data[0] in created) for data in cur.fetchall()}
+
+    @staticmethod
+    def save(cur, states):
+        cur.executemany(
+            "UPDATE excursion_state SET conditions = %s::jsonb, last_temp = %s, last_temp_at = %s WHERE device_id = %s",
+            [(json.dumps(s.conditions), s.last_temp, s.last_temp_at, s.device_id)
+             for s in sorted(states, key=lambda s: s.device_id)]
+        )
+
+# ----------------------------------------------------------------------
+# 7. DEAD-BAND STORAGE POLICY (Suppress redundant readings)
+# ----------------------------------------------------------------------
+
+# Per-device policies (the last stored sample they compare against is read
+# in the storing transaction, see DeviceDeadband.filter)
+deadband_cache = TTLCache('deadband', maxsize=10000, ttl=300)
+
+class DeviceDeadband:
+    """
+    Represents a record in the 'device_deadband' table. When enabled, a reading
+    is only written to 'readings' if, compared to the last stored one, the
+    temperature moved more than temp_delta, the position moved more than
+    distance_m, a -999 sensor/GPS failure state changed, or heartbeat_seconds
+    elapsed. Suppressed readings still update device_latest and the rollups.
+    """
+    DEFAULTS = {
+        'enabled': os.environ.get('DEADBAND_DEFAULT_ENABLED', '0') == '1',
+        'temp_delta': 0.3,
+        'distance_m': 25.0,
+        'heartbeat_seconds': 300,
+    }
+    FIELDS = tuple(DEFAULTS)
+
+    def __init__(self, device_id, **values):
+        self.device_id = device_id
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field, self.DEFAULTS[field]))
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def get_for_device(cls, device_id):
+        conn = get_db_connection()
+        if not conn: return cls(device_id)
+        try:
+            return cls._load(conn.cursor(), [device_id])[device_id]
+        finally:
+            release_db_connection(conn)
+
+    @classmethod
+    def _load(cls, cur, device_ids):
+        cur.execute(
+            "SELECT device_id, " + ", ".join(cls.FIELDS) + " FROM device_deadband WHERE device_id = ANY(%s)",
+            (list(device_ids),)
+        )
+        found = {data[0]: cls(data[0], **dict(zip(cls.FIELDS, data[1:]))) for data in cur.fetchall()}
+        return {device_id: found.get(device_id) or cls(device_id) for device_id in device_ids}
+
+    def save(self):
+        conn = get_db_connection()
+        if not conn: return False, "Database connection failed."
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO device_deadband (device_id, " + ", ".join(self.FIELDS) + ") "
+                "VALUES (%s" + ", %s" * len(self.FIELDS) + ") "
+                "ON CONFLICT (device_id) DO UPDATE SET "
+                + ", ".join(f"{field} = EXCLUDED.{field}" for field in self.FIELDS),
+                (self.device_id, *(getattr(self, field) for field in self.FIELDS))
+            )
+            conn.commit()
+            deadband_cache.invalidate(self.device_id)
+            return True, "Dead-band policy saved."
+        except Exception as e:
+            conn.rollback()
+            return False, f"Database error: {e}"
+        finally:
+            release_db_connection(conn)
+
+    @classmethod
+    def filter(cls, cur, rows):
+        """Returns one bool per (device_id, lat, lon, temp, gsm_time) row: True = store it."""
+        device_ids = {row[0] for row in rows}
+
+        # 1. Policies (cached; one query for the misses)
+        policies = {}
+        for device_id in device_ids:
+            policy = deadband_cache.get(device_id)
+            if policy is not MISSING:
+                policies[device_id] = policy
+        missing = device_ids - policies.keys()
+        if missing:
+            for device_id, policy in cls._load(cur, missing).items():
+                deadband_cache.set(device_id, policy)
+                policies[device_id] = policy
+
+        enabled = {device_id for device_id, policy in policies.items() if policy.enabled}
+        if not enabled:
+            return [True] * len(rows)
+
+        # 2. Last stored sample of each enabled device. The device_latest rows
+        #    of the whole batch are locked first (in device order, like the
+        #    upsert later on), so concurrent batches for a device take turns
+        #    and each compares against what the previous one stored.
+        cur.execute(
+            "SELECT device_id FROM device_latest WHERE device_id = ANY(%s) ORDER BY device_id FOR UPDATE",
+            (sorted(device_ids),)
+        )
+        cur.execute(
+            """
+            SELECT d.device_id, r.latitude, r.longitude, r.temperature, COALESCE(r.gsm_time, r.received_at)
+            FROM unnest(%s::integer[]) AS d(device_id)
+            CROSS JOIN LATERAL (
+                SELECT latitude, longitude, temperature, gsm_time, received_at
+                FROM readings
+                WHERE device_id = d.device_id
+                ORDER BY received_at DESC, id DESC
+                LIMIT 1
+            ) r
+            """,
+            (list(enabled),)
+        )
+        refs = {data[0]: data[1:] for data in cur.fetchall()}
+        now = transaction_now(cur) # Samples without gsm_time are dated like stored rows
+
+        # 3. Decide row by row; a stored row becomes the next reference
+        keep = []
+        for device_id, lat, lon, temp, gsm_time in rows:
+            at = gsm_time or now
+            if device_id not in enabled:
+                keep.append(True)
+                continue
+            ref = refs.get(device_id)
+            store = ref is None or cls._significant(policies[device_id], ref, lat, lon, temp, at)
+            if store:
+                refs[device_id] = (lat, lon, temp, at)
+            keep.append(store)
+        return keep
+
+    @staticmethod
+    def _significant(policy, ref, lat, lon, temp, at):
+        ref_lat, ref_lon, ref_temp, ref_at = ref
+        if (at - ref_at).total_seconds() >= policy.heartbeat_seconds:
+            return True
+        # Sensor or GPS failure state changed (either direction)
+        if is_sentinel(temp) != is_sentinel(ref_temp):
+            return True
+        gps_lost, ref_gps_lost = is_sentinel(lat) or is_sentinel(lon), is_sentinel(ref_lat) or is_sentinel(ref_lon)
+        if gps_lost != ref_gps_lost:
+            return True
+        if not is_sentinel(temp) and abs(temp - ref_temp) > policy.temp_delta:
+            return True
+        if not gps_lost and haversine_m(ref_lat, ref_lon, lat, lon) > policy.distance_m:
+            return True
+        return False
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Great-circle distance in metres."""
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * 6371000.0 * math.asin(math.sqrt(a))
+
+
+# ----------------------------------------------------------------------
+# 8. FLEET SPATIAL INDEX (Grid cells devices have passed through)
+# ----------------------------------------------------------------------
+
+class DeviceCell:
+    """
+    Represents the 'device_cells' table: one row per device, grid cell and hour
+    with stored readings that had a GPS fix, maintained on every insert like
+    the rollups. Cells are CELL_DEGREES squares numbered row by row
+    (row * COLUMNS + column), so the cells around a point form one id range
+    per grid row (see cell_grid.py).
+    """
+    HOUR = 3600
+    MAX_RADIUS_KM = float(os.environ.get('FLEET_MAX_RADIUS_KM', 500))
+
+    _UPSERT_SQL = """
+        INSERT INTO device_cells AS c (cell, hour_start, device_id, reading_count)
+        VALUES (%s, %s, %s, %s)
+        ON CONFLICT (cell, hour_start, device_id) DO UPDATE SET
+            reading_count = c.reading_count + EXCLUDED.reading_count
+    """
+
+    @classmethod
+    def accumulate(cls, cur, readings):
+        """Records the cells of newly stored readings (inside the caller's transaction)."""
+        counts = {}
+        for reading in readings:
+            # Dead-band suppressed samples (id None) aren't in readings to refine against
+            if reading.id is None or not reading.has_gps_fix:
+                continue
+            cell = cell_for(reading.latitude, reading.longitude)
+            if cell is None:
+                continue # Never fail the insert over an impossible position
+            key = (cell, ReadingRollup.bucket_start_for(reading.received_at, cls.HOUR), reading.device_id)
+            counts[key] = counts.get(key, 0) + 1
+        if counts:
+            # Sorted so concurrent batches lock rows in the same order
+            cur.executemany(cls._UPSERT_SQL, [key + (n,) for key, n in sorted(counts.items())])
+
+    @classmethod
+    def find_devices_near(cls, user_id, lat, lon, radius_km, since, until):
+        """
+        Devices shared with the user that have a stored reading within radius_km
+        of (lat, lon) during [since, until), closest first. The cell index picks
+        the candidate device-hours; only those are read from readings and
+        checked with the exact (haversine) distance.
+        """
+        lows, highs = cell_ranges(lat, lon, radius_km)
+        conn = get_db_connection(readonly=True)
+        if not conn: return []
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                WITH candidates AS (
+                    SELECT DISTINCT c.device_id, c.hour_start
+                    FROM unnest(%s::int[], %s::int[]) AS g(low, high)
+                    JOIN device_cells c ON c.cell BETWEEN g.low AND g.high
+                    JOIN device_shares ds ON ds.device_id = c.device_id AND ds.user_id = %s
+                    WHERE c.hour_start >= %s AND c.hour_start < %s
+                ),
+                hits AS (
+                    SELECT r.device_id, r.received_at,
+                           2 * 6371.0 * asin(LEAST(1.0, sqrt(
+                               power(sin(radians(r.latitude - %s) / 2), 2) +
+                               cos(radians(%s)) * cos(radians(r.latitude)) *
+                               power(sin(radians(r.longitude - %s) / 2), 2)
+                           ))) AS distance_km
+                    FROM candidates k
+                    JOIN readings r ON r.device_id = k.device_id
+                        AND r.received_at >= k.hour_start AND r.received_at < k.hour_start + interval '1 hour'
+                    WHERE r.received_at >= %s AND r.received_at < %s
+                      AND r.latitude > -999 AND r.longitude > -999
+                )
+                SELECT h.device_id, d.device_name, MIN(h.distance_km),
+                       MIN(h.received_at), MAX(h.received_at), COUNT(*)
+                FROM hits h
+                JOIN devices d ON d.id = h.device_id
+                WHERE h.distance_km <= %s
+                GROUP BY h.device_id, d.device_name
+                ORDER BY 3
+                """,
+                (lows, highs, user_id, ReadingRollup.bucket_start_for(since, cls.HOUR), until,
+                 lat, lat, lon, since, until, radius_km)
+            )
+            return [
+                {'device_id': device_id, 'device_name': name, 'min_distance_km': distance,
+                 'first_at': first_at, 'last_at': last_at, 'readings': count}
+                for device_id, name, distance, first_at, last_at, count in cur.fetchall()
+            ]
+        finally:
+            release_db_connection(conn)
+
+
+# ----------------------------------------------------------------------
+# 9. TRIPS (Segmented journeys with cold-chain aggregates, see trips.py)
+# ----------------------------------------------------------------------
+
+class Trip:
+    """Represents a record in the 'trips' table."""
+    _COLUMNS = """
+        id, device_id, started_at, ended_at, last_at,
+        start_latitude, start_longitude, end_latitude, end_longitude, distance_m,
+        sample_count, temp_count, temp_min, temp_max, temp_sum, temp_threshold,
+        seconds_above_threshold, sensor_failure_seconds, gps_failure_seconds
+    """
+
+    # Accumulated columns, written as increments (see update)
+    _ADDITIVE = ('distance_m', 'sample_count', 'temp_count', 'temp_sum',
+                 'seconds_above_threshold', 'sensor_failure_seconds', 'gps_failure_seconds')
+
+    def __init__(self, id, device_id, started_at, ended_at, last_at,
+                 start_latitude, start_longitude, end_latitude, end_longitude, distance_m=0.0,
+                 sample_count=0, temp_count=0, temp_min=None, temp_max=None, temp_sum=0.0, temp_threshold=None,
+                 seconds_above_threshold=0.0, sensor_failure_seconds=0.0, gps_failure_seconds=0.0):
+        self.id = id
+        self.device_id = device_id
+        self.started_at = started_at
+        self.ended_at = ended_at
+        self.last_at = last_at
+        self.start_latitude = start_latitude
+        self.start_longitude = start_longitude
+        self.end_latitude = end_latitude
+        self.end_longitude = end_longitude
+        self.distance_m = distance_m
+        self.sample_count = sample_count
+        self.temp_count = temp_count
+        self.temp_min = temp_min
+        self.temp_max = temp_max
+        self.temp_sum = temp_sum
+        self.temp_threshold = temp_threshold
+        self.seconds_above_threshold = seconds_above_threshold
+        self.sensor_failure_seconds = sensor_failure_seconds
+        self.gps_failure_seconds = gps_failure_seconds
+        self._saved = self._accumulated()
+
+    def _accumulated(self):
+        return {field: getattr(self, field) for field in self._ADDITIVE}
+
+    @property
+    def temp_avg(self):
+        return self.temp_sum / self.temp_count if self.temp_count else None
+
+    @property
+    def duration_seconds(self):
+        return ((self.ended_at or self.last_at) - self.started_at).total_seconds()
+
+    def _values(self):
+        return (self.device_id, self.started_at, self.ended_at, self.last_at,
+                self.start_latitude, self.start_longitude, self.end_latitude, self.end_longitude, self.distance_m,
+                self.sample_count, self.temp_count, self.temp_min, self.temp_max, self.temp_sum, self.temp_threshold,
+                self.seconds_above_threshold, self.sensor_failure_seconds, self.gps_failure_seconds)
+
+    def insert(self, cur):
+        cur.execute(
+            """
+            INSERT INTO trips (
+                device_id, started_at, ended_at, last_at,
+                start_latitude, start_longitude, end_latitude, end_longitude, distance_m,
+                sample_count, temp_count, temp_min, temp_max, temp_sum, temp_threshold,
+                seconds_above_threshold, sensor_failure_seconds, gps_failure_seconds
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id
+            """,
+            self._values()
+        )
+        self.id = cur.fetchone()[0]
+        self._saved = self._accumulated()
+
+    def update(self, cur):
+        """
+        Writes what changed since the trip was loaded or last written: totals as
+        increments, extremes with LEAST/GREATEST, and an ended trip never reopens.
+        """
+        deltas = [getattr(self, field) - self._saved[field] for field in self._ADDITIVE]
+        cur.execute(
+            """
+            UPDATE trips SET
+                distance_m = distance_m + %s, sample_count = sample_count + %s,
+                temp_count = temp_count + %s, temp_sum = temp_sum + %s,
+                seconds_above_threshold = seconds_above_threshold + %s,
+                sensor_failure_seconds = sensor_failure_seconds + %s,
+                gps_failure_seconds = gps_failure_seconds + %s,
+                temp_min = LEAST(temp_min, %s), temp_max = GREATEST(temp_max, %s),
+                last_at = GREATEST(last_at, %s), end_latitude = %s, end_longitude = %s,
+                ended_at = COALESCE(ended_at, %s)
+            WHERE id = %s
+            """,
+            (*deltas, self.temp_min, self.temp_max, self.last_at, self.end_latitude, self.end_longitude,
+             self.ended_at, self.id)
+        )
+        self._saved = self._accumulated()
+
+    @classmethod
+    def lock(cls, cur, trip_ids):
+        """Loads and row-locks trips (inside the caller's transaction). Returns {id: Trip}."""
+        if not trip_ids:
+            return {}
+        cur.execute(
+            "SELECT " + cls._COLUMNS + " FROM trips WHERE id = ANY(%s) ORDER BY id FOR UPDATE",
+            (sorted(trip_ids),)
+        )
+        return {data[0]: cls(*data) for data in cur.fetchall()}
+
+    @staticmethod
+    def get_open_ids(cur, device_ids):
+        """{device_id: id} of each device's most recent trip still in progress."""
+        cur.execute(
+            """
+            SELECT DISTINCT ON (device_id) device_id, id
+            FROM trips WHERE device_id = ANY(%s) AND ended_at IS NULL
+            ORDER BY device_id, started_at DESC
+            """,
+            (list(device_ids),)
+        )
+        return dict(cur.fetchall())
+
+    @classmethod
+    def get_for_devices(cls, device_ids, since=None, until=None, limit=100):
+        """Trips of the given devices that started within [since, until), newest first."""
+        conn = get_db_connection(readonly=True)
+        if not conn: return []
+        try:
+            cur = conn.cursor()
+            filters, params = time_range_filter('started_at', since, until)
+            cur.execute(
+                sql.SQL("SELECT " + cls._COLUMNS + """
+                FROM trips
+                WHERE device_id = ANY(%s){filters}
+                ORDER BY started_at DESC
+                LIMIT %s
+                """).format(filters=filters),
+                [list(device_ids), *params, limit]
+            )
+            return [cls(*data) for data in cur.fetchall()]
+        finally:
+            release_db_connection(conn)
+
+    @staticmethod
+    def get_summary(device_ids, since=None, until=None):
+        """Compliance totals over the trips of the given devices that started within [since, until)."""
+        conn = get_db_connection(readonly=True)
+        if not conn: return None
+        try:
+            cur = conn.cursor()
+            filters, params = time_range_filter('started_at', since, until)
+            cur.execute(
+                sql.SQL("""
+                SELECT COUNT(*), COUNT(*) FILTER (WHERE seconds_above_threshold > 0),
+                    COALESCE(SUM(distance_m), 0),
+                    COALESCE(SUM(EXTRACT(EPOCH FROM COALESCE(ended_at, last_at) - started_at)), 0),
+                    MIN(temp_min), MAX(temp_max), SUM(temp_sum) / NULLIF(SUM(temp_count), 0),
+                    COALESCE(SUM(seconds_above_threshold), 0),
+                    COALESCE(SUM(sensor_failure_seconds), 0), COALESCE(SUM(gps_failure_seconds), 0)
+                FROM trips
+                WHERE device_id = ANY(%s){filters}
+                """).format(filters=filters),
+                [list(device_ids), *params]
+            )
+            (trips, trips_above, distance_m, duration, temp_min, temp_max, temp_avg,
+             above, sensor_failure, gps_failure) = cur.fetchone()
+            return {
+                'trips': trips,
+                'trips_above_threshold': trips_above,
+                'distance_km': round(float(distance_m) / 1000, 3),
+                'duration_minutes': round(float(duration) / 60, 1),
+                'temp_min': temp_min,
+                'temp_max': temp_max,
+                'temp_avg': round(temp_avg, 2) if temp_avg is not None else None,
+                'minutes_above_threshold': round(float(above) / 60, 1),
+                'sensor_failure_minutes': round(float(sensor_failure) / 60, 1),
+                'gps_failure_minutes': round(float(gps_failure) / 60, 1),
+            }
+        finally:
+            release_db_connection(conn)
+
+
+class TripState:
+    """
+    Represents a record in the 'trip_state' table: the trip segmenter's
+    per-device progress (trip in progress, previous sample, where the device
+    has been resting), so any process storing readings continues it.
+    """
+    FIELDS = ('trip_id', 'previous_at', 'previous_temp', 'previous_has_fix',
+              'anchor_latitude', 'anchor_longitude', 'anchor_at', 'last_fix_latitude', 'last_fix_longitude')
+
+    def __init__(self, device_id, *values, created=False):
+        self.device_id = device_id
+        for field, value in zip(self.FIELDS, values):
+            setattr(self, field, value)
+        self.created = created  # No row existed before this transaction
+
+    @classmethod
+    def lock(cls, cur, device_ids):
+        """
+        Loads (creating if needed) and row-locks the state of the given devices
+        until the caller's transaction ends. Returns {device_id: TripState}.
+        """
+        device_ids = sorted(set(device_ids)) # Lock in a consistent order
+        cur.execute(
+            """
+            INSERT INTO trip_state (device_id) SELECT unnest(%s::integer[])
+            ON CONFLICT (device_id) DO NOTHING
+            RETURNING device_id
+            """,
+            (device_ids,)
+        )
+        created = {data[0] for data in cur.fetchall()}
+        cur.execute(
+            "SELECT device_id, " + ", ".join(cls.FIELDS) + """
+            FROM trip_state WHERE device_id = ANY(%s)
+            ORDER BY device_id
+            FOR UPDATE
+            """,
+            (device_ids,)
+        )
+        return {data[0]: cls(*data, created=data[0] in created) for data in cur.fetchall()}
+
+    @classmethod
+    def save(cls, cur, states):
+        cur.executemany(
+            "UPDATE trip_state SET " + ", ".join(f"{field} = %s" for field in cls.FIELDS) + " WHERE device_id = %s",
+            [tuple(getattr(s, field) for field in cls.FIELDS) + (s.device_id,)
+             for s in sorted(states, key=lambda s: s.device_id)]
+        )
+
+
+# --- Instrumentation ---
+# Every model method shows up in /metrics and in slow-request traces
+for _model in (User, Device, DeviceShare, Reading, LatestReading, ReadingRollup,
+               DeviceThresholds, ExcursionEvent, ExcursionState, DeviceDeadband, DeviceCell, Trip, TripState):
+    instrument_methods(_model)
@@ -0,0 +1,162 @@
+# FILE: web/partitions.py
+
+import os
+import re
+import gzip
+import time
+import threading
+from datetime import date, datetime, timezone
+
+from psycopg import sql
+
+from models import get_db_connection, release_db_connection
+
+# Months of readings partitions kept created ahead of the current month
+PARTITION_MONTHS_AHEAD = int(os.environ.get('PARTITION_MONTHS_AHEAD', 3))
+# Whole months of raw readings to keep (older partitions are archived and
+# dropped; history remains available from reading_rollups). 0 keeps everything.
+READINGS_RETENTION_MONTHS = int(os.environ.get('READINGS_RETENTION_MONTHS', 0))
+# Where partitions are archived before they are dropped. Must be durable
+# storage (e.g. a mounted persistent disk): the app's own filesystem is wiped
+# on every deploy/restart on hosts like Render. Without it nothing is dropped.
+READINGS_ARCHIVE_DIR = os.environ.get('READINGS_ARCHIVE_DIR') or None
+# In-app maintenance: run once shortly after start, then on this interval (seconds)
+PARTITION_MAINTENANCE = os.environ.get('PARTITION_MAINTENANCE', '1') == '1'
+PARTITION_MAINTENANCE_INTERVAL = float(os.environ.get('PARTITION_MAINTENANCE_INTERVAL', 6 * 3600))
+
+# pg_advisory_lock key so only one worker/process runs maintenance at a time
+_ADVISORY_LOCK_KEY = 0x636F6F6C  # "cool"
+_PARTITION_NAME = re.compile(r'^readings_(\d{4})_(\d{2})$')
+
+
+def current_month():
+    """First day of the current UTC month (partitions are UTC months)."""
+    return datetime.now(timezone.utc).date().replace(day=1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def list_partitions(cur):
+    """Returns {month (date): partition name} for the attached readings partitions."""
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'readings'::regclass
+        """
+    )
+    partitions = {}
+    for (name,) in cur.fetchall():
+        match = _PARTITION_NAME.match(name)
+        if match:
+            partitions[date(int(match.group(1)), int(match.group(2)), 1)] = name
+    return partitions
+
+
+def ensure_future_partitions(cur, months_ahead=PARTITION_MONTHS_AHEAD):
+    """Creates the current month's partition and the next months_ahead ones (idempotent)."""
+    this_month = current_month()
+    created = []
+    for offset in range(months_ahead + 1):
+        cur.execute("SELECT create_readings_partition(%s)", (add_months(this_month, offset),))
+        created.append(cur.fetchone()[0])
+    return created
+
+
+def archive_partition(conn, name, archive_dir):
+    """
+    Exports one partition to <archive_dir>/<name>.csv.gz with COPY, then
+    detaches and drops it. The file is complete on disk before anything is dropped.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    tmp_path = path + '.tmp'
+
+    cur = conn.cursor()
+    with open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb') as archive:
+            with cur.copy(sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(sql.Identifier(name))) as copy:
+                for chunk in copy:
+                    archive.write(chunk)
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(tmp_path, path)
+
+    cur.execute(sql.SQL("ALTER TABLE readings DETACH PARTITION {}").format(sql.Identifier(name)))
+    cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+    conn.commit()
+    return path
+
+
+def run_maintenance(months_ahead=PARTITION_MONTHS_AHEAD, retention_months=READINGS_RETENTION_MONTHS,
+                    archive_dir=READINGS_ARCHIVE_DIR):
+    """Pre-creates future partitions and applies the retention policy. Returns a summary dict."""
+    conn = get_db_connection()
+    if not conn:
+        return {'error': "Database connection failed"}
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (_ADVISORY_LOCK_KEY,))
+        if not cur.fetchone()[0]:
+            conn.commit()
+            return {'skipped': "Maintenance already running elsewhere"}
+        try:
+            created = ensure_future_partitions(cur, months_ahead)
+            conn.commit()
+
+            archived = []
+            if retention_months > 0 and not archive_dir:
+                return {'partitions': created, 'archived': archived,
+                        'error': "READINGS_RETENTION_MONTHS is set but READINGS_ARCHIVE_DIR is not; "
+                                 "old partitions were kept"}
+            if retention_months > 0:
+                oldest_kept = add_months(current_month(), -retention_months)
+                for month, name in sorted(list_partitions(cur).items()):
+                    if month < oldest_kept:
+                        archived.append(archive_partition(conn, name, archive_dir))
+                # The spatial index must not point at readings that are gone
+                cur.execute("DELETE FROM device_cells WHERE hour_start < %s", (oldest_kept,))
+                conn.commit()
+            return {'partitions': created, 'archived': archived}
+        finally:
+            # A failed statement leaves the transaction aborted; end it so the
+            # unlock runs (the lock is per session and the connection is pooled)
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s)", (_ADVISORY_LOCK_KEY,))
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return {'error': f"Partition maintenance failed: {e}"}
+    finally:
+        release_db_connection(conn)
+
+
+_scheduler = None
+
+def start_maintenance_scheduler(interval=PARTITION_MAINTENANCE_INTERVAL):
+    """Runs run_maintenance() in a daemon thread every `interval` seconds (once per process)."""
+    global _scheduler
+    if _scheduler is not None or not PARTITION_MAINTENANCE:
+        return
+
+    def loop():
+        time.sleep(10) # Let the app finish starting
+        while True:
+            result = run_maintenance()
+            if result.get('error') or result.get('archived'):
+                print(f"Partition maintenance: {result}")
+            time.sleep(interval)
+
+    _scheduler = threading.Thread(target=loop, name='partition-maintenance', daemon=True)
+    _scheduler.start()
+
+
+# Example: python partitions.py  (e.g. from a cron job / scheduled task)
+if __name__ == '__main__':
+    from dotenv import load_dotenv
+    load_dotenv()
+    print(run_maintenance())
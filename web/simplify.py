@@ -0,0 +1,116 @@
+# FILE: web/simplify.py
+
+import math
+import numpy as np
+
+# Same "too hot" limit the dashboard highlights
+EXCURSION_TEMP_C = 30.0
+# Default deviation allowed when simplifying, in screen pixels at the given zoom
+TOLERANCE_PIXELS = 1.5
+# Leaflet zoom levels the tolerance is defined for
+MIN_ZOOM = 0
+MAX_ZOOM = 22
+# Web Mercator ground resolution at zoom 0 on the equator (metres per pixel)
+_METERS_PER_PIXEL_Z0 = 156543.03392
+_METERS_PER_DEGREE = 111320.0
+_SENTINEL = -999.0
+
+
+def zoom_tolerance_m(zoom, latitude, pixels=TOLERANCE_PIXELS):
+    """Ground distance covered by `pixels` screen pixels at a Leaflet zoom level (clamped to MIN_ZOOM..MAX_ZOOM)."""
+    zoom = min(max(zoom, MIN_ZOOM), MAX_ZOOM)
+    return pixels * _METERS_PER_PIXEL_Z0 * math.cos(math.radians(latitude)) / (2 ** zoom)
+
+
+def _significance(x, y):
+    """
+    Douglas-Peucker significance of every vertex: the deviation at which it
+    would be kept. Distances for each split are computed with NumPy over the
+    whole sub-segment. A child never ranks above its parent, so thresholding
+    by tolerance and taking the top-N vertices give consistent results.
+    """
+    n = len(x)
+    sig = np.zeros(n)
+    sig[0] = sig[-1] = np.inf
+    stack = [(0, n - 1, np.inf)]
+    while stack:
+        i, j, parent = stack.pop()
+        if j - i < 2:
+            continue
+        xs = x[i + 1:j] - x[i]
+        ys = y[i + 1:j] - y[i]
+        dx, dy = x[j] - x[i], y[j] - y[i]
+        length = math.hypot(dx, dy)
+        if length == 0:
+            d = np.hypot(xs, ys)
+        else:
+            d = np.abs(dy * xs - dx * ys) / length
+        k = int(np.argmax(d))
+        split = i + 1 + k
+        sig[split] = min(d[k], parent)
+        stack.append((i, split, sig[split]))
+        stack.append((split, j, sig[split]))
+    return sig
+
+
+def _excursion_mask(temps, limit):
+    """Marks the first, hottest and last point of every run above the temperature limit."""
+    hot = (temps > limit) & (temps > _SENTINEL)
+    keep = np.zeros(len(temps), dtype=bool)
+    if not hot.any():
+        return keep
+    edges = np.diff(np.concatenate(([0], hot.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1) - 1
+    keep[starts] = True
+    keep[ends] = True
+    for start, end in zip(starts, ends):
+        keep[start + int(np.argmax(temps[start:end + 1]))] = True
+    return keep
+
+
+def simplify_route(points, zoom=None, tolerance_m=None, target_count=None, excursion_temp=EXCURSION_TEMP_C):
+    """
+    Simplifies a route (list of dicts with 'lat', 'lon', 'temp', oldest first)
+    before it is serialized for the map.
+
+    - Points with a -999 sentinel position are dropped.
+    - With target_count, the most significant vertices are kept up to that count;
+      otherwise vertices deviating less than tolerance_m metres (or the
+      equivalent of TOLERANCE_PIXELS at `zoom`) are removed.
+    - The start, the end and temperature-excursion points are always kept.
+    """
+    points = [p for p in points if p['lat'] > _SENTINEL and p['lon'] > _SENTINEL]
+    if len(points) < 3 or (tolerance_m is None and zoom is None and target_count is None):
+        return points
+
+    lat = np.fromiter((p['lat'] for p in points), dtype=float, count=len(points))
+    lon = np.fromiter((p['lon'] for p in points), dtype=float, count=len(points))
+    # Rollup points carry the bucket maximum, which is what matters for excursions
+    temps = np.fromiter(
+        (p['temp'] if p.get('temp_max') is None else p['temp_max'] for p in points),
+        dtype=float, count=len(points)
+    )
+
+    # Local equirectangular projection to metres (fine for route-sized extents)
+    mean_lat = float(lat.mean())
+    x = lon * _METERS_PER_DEGREE * math.cos(math.radians(mean_lat))
+    y = lat * _METERS_PER_DEGREE
+
+    sig = _significance(x, y)
+    forced = _excursion_mask(temps, excursion_temp)
+    sig[forced] = np.inf
+
+    if target_count is not None:
+        target_count = max(int(target_count), 2)
+        if target_count >= len(points):
+            return points
+        keep = np.zeros(len(points), dtype=bool)
+        keep[np.argpartition(-sig, target_count - 1)[:target_count]] = True
+        keep |= forced
+    else:
+        if tolerance_m is None:
+            tolerance_m = zoom_tolerance_m(zoom, mean_lat)
+        keep = sig >= tolerance_m
+
+    return [points[i] for i in np.flatnonzero(keep)]
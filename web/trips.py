@@ -0,0 +1,164 @@
+# FILE: web/trips.py
+
+import os
+
+from models import Reading, Trip, TripState, haversine_m
+from excursions import excursion_engine
+
+# A device is at rest while it stays within STOP_RADIUS_M of where it stopped;
+# after STOP_DWELL_SECONDS at rest the trip ends.
+STOP_RADIUS_M = float(os.environ.get('TRIP_STOP_RADIUS_M', 200))
+STOP_DWELL_SECONDS = float(os.environ.get('TRIP_STOP_DWELL_SECONDS', 600))
+# No samples for longer than this ends the trip at the last sample
+MAX_SAMPLE_GAP_SECONDS = float(os.environ.get('TRIP_MAX_SAMPLE_GAP_SECONDS', 1800))
+
+
+class _Sample:
+    """What the previous sample said, for attributing the time until the next one."""
+    def __init__(self, at, temp, has_fix):
+        self.at = at
+        self.temp = temp
+        self.has_fix = has_fix
+
+
+def _point(lat, lon):
+    return (lat, lon) if lat is not None else None
+
+
+class _DeviceState:
+    """Working copy of a locked trip_state row and the device's open trip."""
+    def __init__(self, row, trip=None):
+        self.row = row
+        self.trip = trip
+        self.previous = _Sample(row.previous_at, row.previous_temp, row.previous_has_fix) if row.previous_at else None
+        # Where (lat, lon) and since when the device has been within STOP_RADIUS_M
+        self.anchor = _point(row.anchor_latitude, row.anchor_longitude)
+        self.anchor_at = row.anchor_at
+        self.last_fix = _point(row.last_fix_latitude, row.last_fix_longitude)
+        if row.created and trip is not None:
+            # Trip left open before trip_state existed: resume from where it ended
+            self.anchor = self.last_fix = (trip.end_latitude, trip.end_longitude)
+            self.anchor_at = trip.last_at
+
+    def store(self):
+        row = self.row
+        row.trip_id = self.trip.id if self.trip is not None else None
+        previous = self.previous
+        row.previous_at = previous.at if previous else None
+        row.previous_temp = previous.temp if previous else None
+        row.previous_has_fix = previous.has_fix if previous else None
+        row.anchor_latitude, row.anchor_longitude = self.anchor or (None, None)
+        row.anchor_at = self.anchor_at
+        row.last_fix_latitude, row.last_fix_longitude = self.last_fix or (None, None)
+        return row
+
+
+class TripSegmenter:
+    """
+    Incremental trip segmentation. Each stored reading is folded once into its
+    device's in-memory state and open trip (O(1) per reading, no history
+    queries); only changed trips are written, one row update per device per
+    batch:
+
+    - A trip starts at the last sample before the device moves more than
+      STOP_RADIUS_M away from where it was resting.
+    - It ends once the device stays within STOP_RADIUS_M for STOP_DWELL_SECONDS
+      (ended_at is the arrival time; the dwell samples confirming the stop are
+      still counted), or when no sample arrives for MAX_SAMPLE_GAP_SECONDS.
+    - Time between two samples is attributed to the earlier one: above the
+      device's temp_max, sensor failure (-999 temperature) or GPS loss.
+
+    Like the excursion engine, it runs inside the transaction that stores the
+    readings (Reading.on_storing) with the devices' trip_state rows and open
+    trips locked, so every process and worker continues the same trips, and
+    trip rows only receive increments relative to what was loaded.
+    """
+    def process(self, cur, readings):
+        device_ids = {reading.device_id for reading in readings}
+        rows = TripState.lock(cur, device_ids)
+        created = [device_id for device_id, row in rows.items() if row.created]
+        if created:
+            for device_id, trip_id in Trip.get_open_ids(cur, created).items():
+                rows[device_id].trip_id = trip_id
+        trips = Trip.lock(cur, [row.trip_id for row in rows.values() if row.trip_id is not None])
+        states = {device_id: _DeviceState(row, trips.get(row.trip_id)) for device_id, row in rows.items()}
+        limits = excursion_engine.thresholds_for_devices(cur, device_ids)
+
+        changed = {} # id(trip) -> trip, in first-change order
+        for reading in readings:
+            for trip in self._evaluate(states[reading.device_id], limits[reading.device_id].temp_max, reading):
+                changed.setdefault(id(trip), trip)
+        for trip in changed.values():
+            if trip.id is None:
+                trip.insert(cur)
+            else:
+                trip.update(cur)
+        TripState.save(cur, [state.store() for state in states.values()])
+
+    def _evaluate(self, state, threshold, reading):
+        changed = []
+        at = reading.sample_time
+        temp = reading.temperature if reading.has_valid_temperature else None
+        previous = state.previous
+        gap = (at - previous.at).total_seconds() if previous else 0
+        if gap < 0:
+            return changed # Older than what we've already seen (late buffered upload)
+
+        # 1. A long silence ends the trip at the last sample
+        if state.trip is not None and gap > MAX_SAMPLE_GAP_SECONDS:
+            state.trip.ended_at = state.trip.last_at
+            changed.append(state.trip)
+            state.trip = None
+            previous = None
+
+        # 2. Movement: leaving the resting spot starts a trip, dwelling ends it
+        if reading.has_gps_fix:
+            position = (reading.latitude, reading.longitude)
+            if state.anchor is None:
+                state.anchor, state.anchor_at = position, at
+            elif haversine_m(*state.anchor, *position) > STOP_RADIUS_M:
+                if state.trip is None:
+                    started_at = previous.at if previous else at
+                    state.trip = Trip(None, reading.device_id, started_at, None, started_at,
+                                      state.anchor[0], state.anchor[1], state.anchor[0], state.anchor[1],
+                                      temp_threshold=threshold)
+                    state.last_fix = state.anchor
+                state.anchor, state.anchor_at = position, at
+            elif state.trip is not None and (at - state.anchor_at).total_seconds() >= STOP_DWELL_SECONDS:
+                trip = state.trip
+                trip.ended_at = max(state.anchor_at, trip.started_at)
+                changed.append(trip)
+                state.trip = None
+
+        # 3. Fold the sample into the trip in progress
+        trip = state.trip
+        if trip is not None:
+            if previous is not None and previous.at >= trip.started_at:
+                seconds = min(gap, MAX_SAMPLE_GAP_SECONDS)
+                if previous.temp is None:
+                    trip.sensor_failure_seconds += seconds
+                elif trip.temp_threshold is not None and previous.temp > trip.temp_threshold:
+                    trip.seconds_above_threshold += seconds
+                if not previous.has_fix:
+                    trip.gps_failure_seconds += seconds
+            trip.sample_count += 1
+            trip.last_at = at
+            if temp is not None:
+                trip.temp_count += 1
+                trip.temp_sum += temp
+                trip.temp_min = temp if trip.temp_min is None else min(trip.temp_min, temp)
+                trip.temp_max = temp if trip.temp_max is None else max(trip.temp_max, temp)
+            if reading.has_gps_fix:
+                position = (reading.latitude, reading.longitude)
+                if state.last_fix is not None:
+                    trip.distance_m += haversine_m(*state.last_fix, *position)
+                state.last_fix = position
+                trip.end_latitude, trip.end_longitude = position
+            changed.append(trip)
+
+        state.previous = _Sample(at, temp, reading.has_gps_fix)
+        return changed
+
+
+trip_segmenter = TripSegmenter()
+Reading.on_storing(trip_segmenter.process)